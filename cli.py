@@ -0,0 +1,269 @@
+import argparse
+import json
+import logging
+import sys
+
+from model import batch, daemon, stepscan
+
+
+def run_convert(args):
+    # Imported here so that commands that don't convert (e.g. submit) don't have to load OCC
+    from model import pipeline
+
+    if not args.mjcf and not args.graph:
+        print("Nothing to export, specify --mjcf and/or --graph")
+        return 1
+    if args.subtree and not args.input.lower().endswith(pipeline.STEP_EXTENSIONS):
+        print("--subtree only works with STEP files, a project file is always converted as a whole")
+        return 1
+    result = pipeline.convert(args.input, mjcf_dir=args.mjcf, graph_dir=args.graph,
+                              render_graphs=not args.no_graph_images, subtrees=args.subtree,
+                              **export_options(args, mjcf=bool(args.mjcf)))
+    if 'mjcf' in result:
+        print(f"MJCF written to {result['mjcf']}")
+    if 'linear_graph' in result:
+        print(f"Linear graph written to {result['linear_graph']}")
+    return 0
+
+
+def run_scan(args):
+    scans = [stepscan.scan_step(f_path) for f_path in args.input]
+    if args.json:
+        print(json.dumps([scan.to_dict() for scan in scans], indent=4))
+        return 0
+    for scan in scans:
+        statistics = scan.part_statistics()
+        costs = scan.estimate_costs()
+        file_name = scan.header.get('FILE_NAME', [''])
+        schema = scan.header.get('FILE_SCHEMA', [['']])
+        print(f"{scan.f_path} ({scan.file_size / 1e6:.1f} MB, scanned in {scan.scan_seconds:.2f} s)")
+        print(f"  Name: {file_name[0]}, schema: {schema[0][0] if schema[0] else ''}")
+        if len(file_name) > 5:
+            print(f"  Originating system: {file_name[5]}")
+        print(f"  {scan.entity_count} entities, {scan.face_count} faces, {statistics['distinct_parts']} distinct parts, "
+              f"{statistics['part_instances']} part instances")
+        print(f"  Estimated seconds: load {costs['load']:.1f}, mesh {costs['mesh']:.1f}, "
+              f"export {costs['export']:.1f}, total {costs['total']:.1f}")
+        for line in scan.tree_lines(max_depth=args.depth):
+            print("    " + line)
+        if args.entities:
+            for entity_type, count in scan.entity_counts.most_common(args.entities):
+                print(f"  {count:10d} {entity_type}")
+    return 0
+
+
+def run_batch(args):
+    summary = batch.run_batch(args.manifest, args.output, workers=args.workers, exports=args.export,
+                              render_graphs=args.graph_images, retry_failed=not args.skip_failed,
+                              largest_first=not args.manifest_order, scan_costs=args.scan_costs,
+                              options=export_options(args, mjcf='mjcf' in args.export))
+    return 0 if summary['failed'] == 0 and summary['remaining'] == 0 else 1
+
+
+def run_clear_cache(args):
+    # Imported here, the cache keys need OCC
+    from model import doccache, meshcache
+
+    if args.only != 'meshes':
+        doccache.clear_cache()
+        print(f"Cleared the STEP document cache in {doccache.CACHE_DIR}")
+    if args.only != 'documents':
+        meshcache.clear_cache()
+        print(f"Cleared the mesh cache in {meshcache.CACHE_DIR}")
+    return 0
+
+
+def run_serve(args):
+    conversion_daemon = daemon.ConversionDaemon(socket_path=args.socket, port=args.port, max_models=args.max_models)
+    conversion_daemon.serve()
+    return 0
+
+
+def run_submit(args):
+    params = {}
+    for param in args.params:
+        key, _, value = param.partition('=')
+        try:
+            params[key] = json.loads(value)
+        except json.JSONDecodeError:
+            params[key] = value
+    client = daemon.DaemonClient(socket_path=args.socket, port=args.port)
+    print(json.dumps(client.request(args.daemon_command, **params), indent=4))
+    return 0
+
+
+def export_options(args, mjcf=True):
+    """Options for the exporters (see ConversionClass and MJCFGenerator) from the command line arguments. The options
+    only MJCFGenerator takes are left out unless mjcf is set."""
+    options = {}
+    if args.deduplicate:
+        options['deduplicate'] = True
+        options['dedup_tolerance'] = args.dedup_tolerance
+    if args.mass_workers is not None:
+        options['mass_workers'] = args.mass_workers
+    if args.merge_fixed:
+        options['merge_fixed'] = True
+    if args.mass_engine != 'brep':
+        options['mass_engine'] = args.mass_engine
+        options['mesh_deflection'] = args.mesh_deflection
+        options['mass_cross_check'] = args.mass_cross_check
+    if not mjcf:
+        return options
+
+    if args.mesh_workers is not None:
+        options['mesh_workers'] = args.mesh_workers
+    if args.no_mesh_cache:
+        options['mesh_cache'] = False
+    options['collision'] = args.collision
+    options['max_hulls'] = args.max_hulls
+    options['concavity'] = args.concavity
+    if args.primitives:
+        options['primitives'] = True
+        options['min_fill_ratio'] = args.min_fill_ratio
+    options['contact_exclusion_hops'] = args.contact_exclusion_hops
+    options['stl_deflection'] = args.stl_deflection
+    options['stl_angular_deflection'] = args.stl_angular_deflection
+    options['stl_min_deflection'] = args.stl_min_deflection
+    if args.max_body_triangles is not None:
+        options['max_body_triangles'] = args.max_body_triangles
+    if args.max_model_triangles is not None:
+        options['max_model_triangles'] = args.max_model_triangles
+    return options
+
+
+def add_export_arguments(parser):
+    parser.add_argument('--deduplicate', action='store_true',
+                        help="Share mass properties and meshes between geometrically identical parts")
+    parser.add_argument('--dedup-tolerance', type=float, default=1e-4,
+                        help="Relative tolerance when comparing parts for --deduplicate (default: 1e-4)")
+    parser.add_argument('--mesh-workers', type=int, default=None, metavar='N',
+                        help="Mesh and write the MJCF STL files in N processes (default: CADCONVERSION_MESH_WORKERS "
+                             "or 1)")
+    parser.add_argument('--no-mesh-cache', action='store_true',
+                        help="Mesh every part again instead of reusing unchanged meshes from the mesh cache")
+    parser.add_argument('--collision', choices=['mesh', 'hull', 'decomposition'], default='hull',
+                        help="Collision geoms of the MJCF export: the visual mesh, its convex hull (default) or an "
+                             "approximate convex decomposition")
+    parser.add_argument('--max-hulls', type=int, default=8, metavar='N',
+                        help="Maximum number of convex hulls per part with --collision decomposition (default: 8)")
+    parser.add_argument('--concavity', type=float, default=0.05,
+                        help="With --collision decomposition, stop splitting a part when its hulls exceed its volume "
+                             "by at most this fraction (default: 0.05)")
+    parser.add_argument('--primitives', action='store_true',
+                        help="Collide with a box, cylinder, capsule or sphere fitted from the faces of a part where "
+                             "one fits, instead of meshes")
+    parser.add_argument('--min-fill-ratio', type=float, default=0.95,
+                        help="Fraction of a fitted primitive a part has to fill for --primitives (default: 0.95)")
+    parser.add_argument('--contact-exclusion-hops', type=int, default=1, metavar='N',
+                        help="Exclude contacts between MJCF bodies at most N joints apart, 0 keeps all contacts "
+                             "(default: 1, directly jointed bodies)")
+    parser.add_argument('--stl-deflection', type=float, default=0.001,
+                        help="Deflection of the STL meshes relative to the bounding box diagonal of each body "
+                             "(default: 0.001)")
+    parser.add_argument('--stl-min-deflection', type=float, default=0.5, metavar='MM',
+                        help="Smallest deflection of the STL meshes in mm (default: 0.5)")
+    parser.add_argument('--stl-angular-deflection', type=float, default=0.5,
+                        help="Angular deflection of the STL meshes in radians (default: 0.5)")
+    parser.add_argument('--max-body-triangles', type=int, default=None, metavar='N',
+                        help="Mesh bodies with more than N triangles again with a larger deflection")
+    parser.add_argument('--max-model-triangles', type=int, default=None, metavar='N',
+                        help="Share a budget of N triangles between the STL meshes of the model")
+    parser.add_argument('--merge-fixed', action='store_true',
+                        help="Merge parts connected by Fixed joints into one body (MJCF) or link (linear graph)")
+    parser.add_argument('--mass-workers', type=int, default=None, metavar='N',
+                        help="Compute mass properties in N processes (default: CADCONVERSION_MASS_WORKERS or 1)")
+    parser.add_argument('--mass-engine', choices=['brep', 'mesh'], default='brep',
+                        help="Integrate mass properties exactly over the B-rep, or approximate them faster from a "
+                             "triangulation (default: brep)")
+    parser.add_argument('--mesh-deflection', type=float, default=0.01,
+                        help="Relative deflection of the triangulation for --mass-engine mesh (default: 0.01)")
+    parser.add_argument('--mass-cross-check', action='store_true',
+                        help="With --mass-engine mesh, log the relative errors against the exact mass properties")
+
+
+def add_daemon_address_arguments(parser):
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument('--socket', metavar='PATH', help="UNIX socket of the daemon")
+    address.add_argument('--port', type=int, help="Port of the daemon on localhost")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Convert STEP models to MJCF and linear graphs without the GUI")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Print debug log messages")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert_parser = subparsers.add_parser('convert', help="Convert a single STEP or saved project file")
+    convert_parser.add_argument('input', help="STEP file (.stp/.step) or project file (.json) saved from the GUI")
+    convert_parser.add_argument('--mjcf', metavar='DIR', help="Export an MJCF model and its meshes to DIR")
+    convert_parser.add_argument('--graph', metavar='DIR', help="Export the linear graph (data.json) to DIR")
+    convert_parser.add_argument('--no-graph-images', action='store_true',
+                                help="Don't render the rotation and translation graphs with graphviz")
+    convert_parser.add_argument('--subtree', action='append', metavar='NAME',
+                                help="Only load and convert the parts of the component (assembly) with this name or "
+                                     "uid, can be given several times (STEP files only)")
+    add_export_arguments(convert_parser)
+    convert_parser.set_defaults(func=run_convert)
+
+    scan_parser = subparsers.add_parser('scan', help="Preview the product tree and conversion cost of STEP files "
+                                                     "without translating them")
+    scan_parser.add_argument('input', nargs='+', help="STEP files")
+    scan_parser.add_argument('--depth', type=int, default=None, help="Only print the tree down to this depth")
+    scan_parser.add_argument('--entities', type=int, default=0, metavar='N',
+                             help="Print the N most common entity types")
+    scan_parser.add_argument('--json', action='store_true', help="Print the scan results as json")
+    scan_parser.set_defaults(func=run_scan)
+
+    batch_parser = subparsers.add_parser('batch', help="Convert all STEP files in a manifest with worker processes")
+    batch_parser.add_argument('manifest', help="Text file with one STEP path per line, or a json list of paths")
+    batch_parser.add_argument('--output', required=True, metavar='DIR',
+                              help="Output folder, gets one sub folder per file and the status journal")
+    batch_parser.add_argument('--workers', type=int, default=None,
+                              help="Number of worker processes (default: number of CPUs)")
+    batch_parser.add_argument('--export', nargs='+', choices=['mjcf', 'graph'], default=['mjcf'],
+                              help="Exporters to run for each file (default: mjcf)")
+    batch_parser.add_argument('--graph-images', action='store_true',
+                              help="Render the rotation and translation graphs with graphviz")
+    batch_parser.add_argument('--manifest-order', action='store_true',
+                              help="Convert files in manifest order, instead of the largest first")
+    batch_parser.add_argument('--scan-costs', action='store_true',
+                              help="Order the files by their estimated conversion cost, scanning every file first, "
+                                   "instead of by file size")
+    batch_parser.add_argument('--skip-failed', action='store_true',
+                              help="Don't retry files that failed in a previous run")
+    add_export_arguments(batch_parser)
+    batch_parser.set_defaults(func=run_batch)
+
+    clear_cache_parser = subparsers.add_parser('clear-cache', help="Remove all cached STEP documents and STL meshes")
+    clear_cache_parser.add_argument('--only', choices=['documents', 'meshes'],
+                                    help="Only clear the STEP document cache or the mesh cache")
+    clear_cache_parser.set_defaults(func=run_clear_cache)
+
+    serve_parser = subparsers.add_parser('serve', help="Run a conversion daemon that keeps parsed models in memory")
+    add_daemon_address_arguments(serve_parser)
+    serve_parser.add_argument('--max-models', type=int, default=8, help="Number of parsed models to keep in memory")
+    serve_parser.set_defaults(func=run_serve)
+
+    submit_parser = subparsers.add_parser('submit', help="Send a job to a running conversion daemon")
+    add_daemon_address_arguments(submit_parser)
+    submit_parser.add_argument('daemon_command',
+                               help="ping, load, mass_properties, export_mjcf, export_linear_graph, stats or shutdown")
+    submit_parser.add_argument('params', nargs='*', metavar='KEY=VALUE',
+                               help="Job parameters, e.g. path=model.step output_dir=out")
+    submit_parser.set_defaults(func=run_submit)
+
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    # The model loggers are set to DEBUG, so the level has to be applied on the handler
+    handler = logging.StreamHandler()
+    handler.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(levelname)s: %(message)s"))
+    logging.basicConfig(level=logging.DEBUG, handlers=[handler])
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,7 +7,7 @@ from model.modelupdate import Watcher
 
 from model import docmodel
 
-from PyQt5.QtWidgets import QApplication
+from PyQt5.QtWidgets import QApplication, QMessageBox
 
 serializer = Serializer()
 watcher = None
@@ -19,16 +19,15 @@ def open_doc():
     if result is None:
         return
     win.tree_view.clearSelection()
+    dm.close()  # The project replaces the current model
+    win.discard_saved_revision()
     win.joint_dict, dm.part_dict, dm.label_dict, dm.parent_dict, f_path = result
 
     if os.path.exists(f_path):
         win.file_to_watch = f_path
 
-        new_dm = docmodel.DocModel()
-        docmodel.load_step_at_top_fpath(new_dm, f_path)
-
-        if not docmodel.same_doc_model(dm, new_dm):
-            result = win.show_update_model_popup()
+        # Offers to update the model once the STEP file has been loaded, if it was changed since the project was saved
+        win.check_step_revision(f_path)
 
         if watcher is None:
             watcher = Watcher(f_path, win)
@@ -47,7 +46,11 @@ def open_doc():
 
 
 def save_doc():
-    serializer.save_model(win.joint_dict, dm.part_dict, dm.label_dict, dm.parent_dict, win.file_to_watch)
+    win.load_all_components()  # Parts that are not loaded yet would be missing from the saved project
+    try:
+        serializer.save_model(win.joint_dict, dm.part_dict, dm.label_dict, dm.parent_dict, win.file_to_watch)
+    except ValueError as e:
+        QMessageBox.warning(win, "Save project", f"The project was not saved:\n{e}")
 
 
 def add_joint():
@@ -57,33 +60,48 @@ def add_joint():
 def load_step_at_top():
     """Load STEP file and assign it to self.doc
         This effectively allows step to be a surrogate for file save/load."""
-    global watcher
-    global step_file_loaded
+    load_step(structure_only=False)
+
+
+def load_step_structure():
+    """Load only the product tree of a STEP file, the parts are loaded later with 'Load components'"""
+    load_step(structure_only=True)
+
+
+def load_step(structure_only):
+    f_path = docmodel.select_step_file()
+    if not f_path:
+        return
 
     win.tree_view.clearSelection()
+    win.load_step_file(f_path, on_finished=lambda: step_loaded(f_path), structure_only=structure_only)
 
-    f_path = docmodel.load_step_at_top(dm)
 
-    if f_path:
-        win.joint_dict = {}
-        win.hide_list = set()
+def step_loaded(f_path):
+    global watcher
+
+    if watcher is None:
+        watcher = Watcher(f_path, win)
+    else:
+        watcher.stop()
+        watcher.watch_new_file(f_path)
+    win.file_to_watch = f_path
+    watcher.run()
+    win.fit_all()
 
-        if watcher is None:
-            watcher = Watcher(f_path, win)
-        else:
-            watcher.stop()
-            watcher.watch_new_file(f_path)
-        win.file_to_watch = f_path
-        watcher.run()
-        win.build_tree()
-        win.redraw()
-        win.fit_all()
+
+def load_components():
+    win.load_selected_components()
 
 
 def merge_shapes():
     win.merge_shapes()
 
 
+def fuse_shapes():
+    win.merge_shapes(fuse=True)
+
+
 def delete_components():
     win.delete_components()
 
@@ -100,6 +118,10 @@ def update_model():
     win.load_saved_modified_step()
 
 
+def memory_report():
+    win.show_memory_report()
+
+
 def export_linear_graph():
     lgc = LinearGraphConverter(dm.part_dict, win.joint_dict)
     directory_path = lgc.get_graph_folder()
@@ -126,12 +148,16 @@ if __name__ == "__main__":
     win.add_function_to_menu("File", "Save file", save_doc)
     file_menu.addSeparator()
     win.add_function_to_menu("File", "Load STEP", load_step_at_top)
+    win.add_function_to_menu("File", "Load STEP structure", load_step_structure)
 
     edit_menu = win.add_menu("Model")
     win.add_function_to_menu("Model", "Update model", update_model)
+    win.add_function_to_menu("Model", "Memory report", memory_report)
 
+    win.tree_view.component_pop_menu.addAction("Load components", load_components)
     win.tree_view.component_pop_menu.addAction("Change material", win.change_material_window)
     win.tree_view.component_pop_menu.addAction("Combine components", merge_shapes)
+    win.tree_view.component_pop_menu.addAction("Fuse components", fuse_shapes)
     win.tree_view.component_pop_menu.addAction("Delete components", delete_components)
     win.tree_view.component_pop_menu.addAction("Move to top", move_to_top)
 
@@ -0,0 +1,195 @@
+import json
+import logging
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from . import stepscan
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)  # set to DEBUG | INFO | ERROR
+
+JOURNAL_NAME = 'journal.jsonl'
+
+
+def read_manifest(manifest_path):
+    """Read the list of STEP files to convert. The manifest is either a json list of paths (or an object with a
+    "files" list), or a text file with one path per line where empty lines and lines starting with # are ignored.
+    Relative paths are resolved against the folder of the manifest."""
+    with open(manifest_path, 'r') as file:
+        content = file.read()
+
+    if manifest_path.lower().endswith('.json'):
+        data = json.loads(content)
+        paths = data["files"] if isinstance(data, dict) else data
+    else:
+        paths = [line.strip() for line in content.splitlines()]
+        paths = [path for path in paths if path and not path.startswith('#')]
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    return [os.path.normpath(os.path.join(base_dir, path)) for path in paths]
+
+
+def job_names(f_paths):
+    """Name of the output folder for each file, the file name without extension. Files with the same name get a
+    numbered suffix in manifest order, so names stay the same when a run is resumed."""
+    names = {}
+    used = {}
+    for f_path in f_paths:
+        stem = os.path.splitext(os.path.basename(f_path))[0]
+        count = used.get(stem, 0)
+        used[stem] = count + 1
+        names[f_path] = stem if count == 0 else f"{stem}_{count}"
+    return names
+
+
+class BatchJournal:
+    """Append-only status journal with one json line per finished file. The last entry of a file decides its
+    status, so an interrupted run can be resumed by skipping the files that are already done."""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}  # Latest entry keyed by file path
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        line = ''
+        with open(self.path, 'r') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line that was cut off when the previous run was interrupted
+                    logger.warning("Ignoring unreadable journal line: %s", line.strip())
+                    continue
+                self.entries[entry["file"]] = entry
+        if line and not line.endswith('\n'):
+            # Terminate the cut off line so that new entries start on a line of their own
+            with open(self.path, 'a') as file:
+                file.write('\n')
+
+    def status(self, f_path):
+        entry = self.entries.get(f_path)
+        return entry["status"] if entry else None
+
+    def record(self, entry):
+        self.entries[entry["file"]] = entry
+        with open(self.path, 'a') as file:
+            file.write(json.dumps(entry) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+
+def convert_job(f_path, output_dir, exports, render_graphs, options):
+    """Convert one file in a worker process. Never raises, failures are returned as a 'failed' entry."""
+    # Imported here so that the main process doesn't have to load OCC
+    from .conversion import MJCFGenerator, common_options
+    from .pipeline import export_linear_graph, load_model
+
+    start = time.perf_counter()
+    timings = {}
+    dm = None
+    try:
+        dm, joint_dict = load_model(f_path)
+        timings['load'] = time.perf_counter() - start
+
+        if 'mjcf' in exports:
+            stage_start = time.perf_counter()
+            mjcf_gen = MJCFGenerator(dm.part_dict, joint_dict, output_dir=os.path.join(output_dir, 'mjcf'),
+                                     **options)
+            timings['inertia'] = time.perf_counter() - stage_start
+            stage_start = time.perf_counter()
+            mjcf_gen.generate()
+            timings['mjcf'] = time.perf_counter() - stage_start
+
+        if 'graph' in exports:
+            stage_start = time.perf_counter()
+            export_linear_graph(dm.part_dict, joint_dict, os.path.join(output_dir, 'graph'), render_graphs,
+                                **common_options(options))
+            timings['graph'] = time.perf_counter() - stage_start
+
+        entry = {'status': 'done', 'parts': len(dm.part_dict)}
+    except Exception as e:
+        entry = {'status': 'failed', 'error': f"{type(e).__name__}: {e}", 'traceback': traceback.format_exc()}
+    finally:
+        if dm is not None:
+            dm.close()  # Workers are reused, failed jobs must not keep their document either
+
+    entry.update({'file': f_path, 'output_dir': output_dir,
+                  'seconds': time.perf_counter() - start, 'timings': timings, 'finished': time.time()})
+    return entry
+
+
+def run_batch(manifest_path, output_dir, workers=None, exports=('mjcf',), render_graphs=False, retry_failed=True,
+              largest_first=True, scan_costs=False, options=None):
+    """Convert all files in the manifest using a pool of worker processes. Every finished file is written to the
+    journal in output_dir, files that are already done are skipped. With largest_first, files are submitted in order
+    of decreasing size, or of decreasing estimated cost with scan_costs (see stepscan.largest_first). options are
+    passed on to the exporters.
+    Returns a summary dict."""
+    options = options or {}
+    f_paths = read_manifest(manifest_path)
+    names = job_names(f_paths)
+    os.makedirs(output_dir, exist_ok=True)
+    journal = BatchJournal(os.path.join(output_dir, JOURNAL_NAME))
+
+    pending = []
+    skipped = 0
+    for f_path in f_paths:
+        status = journal.status(f_path)
+        if status == 'done' or (status == 'failed' and not retry_failed):
+            skipped += 1
+        else:
+            pending.append(f_path)
+    logger.info("%i files in manifest, %i already processed, %i to convert", len(f_paths), skipped, len(pending))
+    if largest_first and len(pending) > 1:
+        pending = stepscan.largest_first(pending, scan=scan_costs)
+
+    done = failed = 0
+    busy_seconds = 0.0
+    start = time.perf_counter()
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(convert_job, f_path, os.path.join(output_dir, names[f_path]),
+                                       tuple(exports), render_graphs, options): f_path for f_path in pending}
+            try:
+                for future in as_completed(futures):
+                    entry = future.result()
+                    journal.record(entry)
+                    busy_seconds += entry['seconds']
+                    if entry['status'] == 'done':
+                        done += 1
+                        stages = ', '.join(f"{stage} {seconds:.1f} s" for stage, seconds in entry['timings'].items())
+                        logger.info("[%i/%i] %s done in %.1f s (%s)", done + failed, len(pending),
+                                    entry['file'], entry['seconds'], stages)
+                    else:
+                        failed += 1
+                        logger.error("[%i/%i] %s failed after %.1f s: %s", done + failed, len(pending),
+                                     entry['file'], entry['seconds'], entry['error'])
+            except BrokenProcessPool:
+                # A worker died (e.g. crashed inside OCC), unfinished files are picked up again on resume
+                logger.error("Worker process terminated abruptly, %i files were not converted. "
+                             "Run the batch again to resume.", len(pending) - done - failed)
+
+    wall_seconds = time.perf_counter() - start
+    finished = done + failed
+    summary = {
+        'total': len(f_paths),
+        'skipped': skipped,
+        'done': done,
+        'failed': failed,
+        'remaining': len(pending) - finished,
+        'wall_seconds': wall_seconds,
+        'files_per_minute': 60 * finished / wall_seconds if finished and wall_seconds > 0 else 0.0,
+        'mean_seconds_per_file': busy_seconds / finished if finished else 0.0,
+    }
+    logger.info("Batch finished: %i done, %i failed, %i skipped, %i remaining in %.1f s "
+                "(%.2f files/min, %.1f s per file)", done, failed, skipped, summary['remaining'], wall_seconds,
+                summary['files_per_minute'], summary['mean_seconds_per_file'])
+    return summary
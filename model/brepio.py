@@ -0,0 +1,66 @@
+import os
+import tempfile
+
+from OCC.Core import BRepTools
+from OCC.Core import BinTools
+from OCC.Core.BRep import BRep_Builder
+from OCC.Core.BinTools import BinTools_FormatVersion_CURRENT
+from OCC.Core.TopTools import TopTools_FormatVersion_CURRENT
+from OCC.Core.TopoDS import TopoDS_Shape
+
+
+def temp_brep_path(suffix=".brep"):
+    """Unique temporary file for BREP data, so that several processes can (de)serialize at the same time"""
+    fd, temp_shape_file = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    return temp_shape_file
+
+
+def shape_to_brep_bytes(shape, with_triangles=True):
+    """Serialize shape to the BREP format. Without triangles the result only depends on the exact geometry, not on
+    whether (and how finely) the shape has been meshed."""
+    temp_shape_file = temp_brep_path()
+    try:
+        BRepTools.breptools_Write(shape, temp_shape_file, with_triangles, False, TopTools_FormatVersion_CURRENT)
+        with open(temp_shape_file, "rb") as file:
+            return file.read()
+    finally:
+        os.remove(temp_shape_file)
+
+
+def brep_bytes_to_shape(data):
+    """Read a shape serialized with shape_to_brep_bytes"""
+    temp_shape_file = temp_brep_path()
+    try:
+        with open(temp_shape_file, "wb") as file:
+            file.write(data)
+        shape = TopoDS_Shape()
+        BRepTools.breptools_Read(shape, temp_shape_file, BRep_Builder())
+        return shape
+    finally:
+        os.remove(temp_shape_file)
+
+
+def shape_to_binary_bytes(shape, with_triangles=False):
+    """Serialize shape to the binary BREP format. Unlike the text format, which rounds reals to 15 digits, the binary
+    format stores the geometry exactly."""
+    temp_shape_file = temp_brep_path(".bbrep")
+    try:
+        BinTools.bintools_Write(shape, temp_shape_file, with_triangles, False, BinTools_FormatVersion_CURRENT)
+        with open(temp_shape_file, "rb") as file:
+            return file.read()
+    finally:
+        os.remove(temp_shape_file)
+
+
+def binary_bytes_to_shape(data):
+    """Read a shape serialized with shape_to_binary_bytes"""
+    temp_shape_file = temp_brep_path(".bbrep")
+    try:
+        with open(temp_shape_file, "wb") as file:
+            file.write(data)
+        shape = TopoDS_Shape()
+        BinTools.bintools_Read(shape, temp_shape_file)
+        return shape
+    finally:
+        os.remove(temp_shape_file)
@@ -0,0 +1,186 @@
+import os
+
+import numpy as np
+
+from .tessellation import read_binary_stl, write_binary_stl
+
+# Collision geometry of the MJCF export: the visual mesh itself, its convex hull, or an approximate convex
+# decomposition into several hulls
+COLLISION_MODES = ('mesh', 'hull', 'decomposition')
+DEFAULT_MAX_HULLS = 8
+# The decomposition stops when the hulls together are at most this fraction larger than the mesh
+DEFAULT_CONCAVITY = 0.05
+
+
+def mesh_volume(vertices, triangles):
+    """Volume enclosed by a closed, outward oriented triangle mesh"""
+    if not len(triangles):
+        return 0.0
+    a, b, c = (vertices[triangles[:, k]] for k in range(3))
+    return np.einsum('ij,ij->', a, np.cross(b, c)) / 6
+
+
+def convex_hull(points, tolerance=1e-9):
+    """Convex hull of points (n, 3) with quickhull. Returns the vertices (k, 3) and triangles (m, 3, indices into the
+    vertices) of the hull, ordered counterclockwise seen from outside, or None if the points are (nearly) flat. Points
+    closer than tolerance times the size of the point cloud to the hull are considered inside."""
+    points = np.unique(np.asarray(points, dtype=float).reshape(-1, 3), axis=0)
+    if len(points) < 4:
+        return None
+    epsilon = tolerance * np.max(points.max(axis=0) - points.min(axis=0))
+
+    # Initial tetrahedron from extreme points
+    first = int(points[:, 0].argmin())
+    second = int(np.linalg.norm(points - points[first], axis=1).argmax())
+    direction = points[second] - points[first]
+    third = int(np.linalg.norm(np.cross(points - points[first], direction), axis=1).argmax())
+    normal = np.cross(direction, points[third] - points[first])
+    if np.linalg.norm(normal) <= epsilon * np.linalg.norm(direction):
+        return None
+    heights = (points - points[first]) @ normal / np.linalg.norm(normal)
+    fourth = int(np.abs(heights).argmax())
+    if abs(heights[fourth]) <= epsilon:
+        return None
+    if heights[fourth] > 0:
+        second, third = third, second  # The fourth point is now below the base, whose normal points up and out
+    simplex = [(first, second, third), (first, fourth, second), (second, fourth, third), (third, fourth, first)]
+
+    faces = {}      # Face id: (a, b, c), counterclockwise seen from outside
+    planes = {}     # Face id: (unit normal, offset)
+    outside = {}    # Face id: indices of the points in front of the face
+    edge_faces = {}  # Directed edge (a, b): id of the face it belongs to
+    next_id = 0
+
+    def add_face(a, b, c, candidates):
+        """Add a face and assign it the candidates in front of it. Returns the remaining candidates."""
+        nonlocal next_id
+        face_id = next_id
+        next_id += 1
+        face_normal = np.cross(points[b] - points[a], points[c] - points[a])
+        length = np.linalg.norm(face_normal)
+        face_normal = face_normal / length if length > 0 else face_normal
+        faces[face_id] = (a, b, c)
+        planes[face_id] = (face_normal, face_normal @ points[a])
+        for edge in ((a, b), (b, c), (c, a)):
+            edge_faces[edge] = face_id
+        distances = points[candidates] @ face_normal - planes[face_id][1]
+        in_front = distances > epsilon
+        outside[face_id] = candidates[in_front]
+        return candidates[~in_front]
+
+    candidates = np.setdiff1d(np.arange(len(points)), [first, second, third, fourth])
+    for a, b, c in simplex:
+        candidates = add_face(a, b, c, candidates)
+
+    pending = [face_id for face_id in faces if len(outside[face_id])]
+    while pending:
+        face_id = pending.pop()
+        if face_id not in faces or not len(outside[face_id]):
+            continue
+        face_normal, offset = planes[face_id]
+        distances = points[outside[face_id]] @ face_normal - offset
+        apex = int(outside[face_id][distances.argmax()])
+
+        # The faces seen from the apex form a connected region, its boundary is the horizon
+        visible = {face_id}
+        queue = [face_id]
+        horizon = []
+        while queue:
+            current = queue.pop()
+            a, b, c = faces[current]
+            for edge in ((a, b), (b, c), (c, a)):
+                neighbor = edge_faces[edge[::-1]]
+                if neighbor in visible:
+                    continue
+                neighbor_normal, neighbor_offset = planes[neighbor]
+                if points[apex] @ neighbor_normal - neighbor_offset > epsilon:
+                    visible.add(neighbor)
+                    queue.append(neighbor)
+                else:
+                    horizon.append(edge)
+
+        orphans = np.concatenate([outside[visible_id] for visible_id in visible])
+        orphans = orphans[orphans != apex]
+        for visible_id in visible:
+            a, b, c = faces.pop(visible_id)
+            for edge in ((a, b), (b, c), (c, a)):
+                if edge_faces.get(edge) == visible_id:
+                    del edge_faces[edge]
+            del planes[visible_id], outside[visible_id]
+
+        for a, b in horizon:
+            new_id = next_id
+            orphans = add_face(a, b, apex, orphans)
+            if len(outside[new_id]):
+                pending.append(new_id)
+
+    hull_triangles = np.array(list(faces.values()), dtype=np.int64)
+    used, hull_triangles = np.unique(hull_triangles, return_inverse=True)
+    return points[used], hull_triangles.reshape(-1, 3)
+
+
+def convex_decomposition(vertices, triangles, max_hulls=DEFAULT_MAX_HULLS, concavity=DEFAULT_CONCAVITY):
+    """Approximate convex decomposition of a closed triangle mesh into at most max_hulls convex hulls (see
+    convex_hull). Starting from the hull of the whole mesh, the piece with the largest hull is cut in two at the
+    median of its triangle centers, along the axis that reduces the hull volume most, until the hulls are at most
+    concavity larger than the mesh. Both pieces keep whole triangles, so neighboring hulls overlap instead of leaving
+    gaps. Returns a list of hulls (vertices, triangles)."""
+    hull = convex_hull(vertices[triangles])
+    if hull is None:
+        return []
+    volume = abs(mesh_volume(vertices, triangles))
+    pieces = [(np.arange(len(triangles)), hull, mesh_volume(*hull))]
+    final = []  # Pieces that can't be cut any further
+
+    while pieces and len(pieces) + len(final) < max_hulls:
+        if sum(piece[2] for piece in pieces + final) <= (1 + concavity) * volume:
+            break
+        pieces.sort(key=lambda piece: piece[2])
+        indices, hull, hull_volume = pieces.pop()
+        centers = vertices[triangles[indices]].mean(axis=1)
+
+        best = None
+        for axis in range(3):
+            below = centers[:, axis] <= np.median(centers[:, axis])
+            if below.all() or not below.any():
+                continue
+            halves = [indices[below], indices[~below]]
+            hulls = [convex_hull(vertices[triangles[half]]) for half in halves]
+            if any(half_hull is None for half_hull in hulls):
+                continue
+            volumes = [mesh_volume(*half_hull) for half_hull in hulls]
+            if best is None or sum(volumes) < sum(best[2]):
+                best = (halves, hulls, volumes)
+
+        if best is None:
+            final.append((indices, hull, hull_volume))
+        else:
+            pieces.extend(zip(*best))
+    return [piece[1] for piece in pieces + final]
+
+
+def collision_files(stl_file, count):
+    """Names of the STL files of the count collision hulls of the visual mesh stl_file"""
+    stem = os.path.splitext(stl_file)[0]
+    return [f'{stem}_collision_{index}.stl' for index in range(count)]
+
+
+def write_collision_meshes(stl_file, mode='hull', max_hulls=DEFAULT_MAX_HULLS, concavity=DEFAULT_CONCAVITY):
+    """Write the collision hulls of the visual mesh stl_file next to it, as the convex hull of its vertices ('hull')
+    or an approximate convex decomposition ('decomposition'). The hulls are in the same frame and units as the visual
+    mesh. Returns the names of the written files, none if the mesh is flat."""
+    vertices, triangles = read_binary_stl(stl_file)
+    if mode == 'hull':
+        hull = convex_hull(vertices)
+        hulls = [] if hull is None else [hull]
+    elif mode == 'decomposition':
+        hulls = convex_decomposition(vertices, triangles, max_hulls, concavity)
+    else:
+        raise ValueError(f"Unknown collision mode {mode}, expected one of {', '.join(COLLISION_MODES[1:])}")
+
+    files = collision_files(stl_file, len(hulls))
+    for hull_file, (hull_vertices, hull_triangles) in zip(files, hulls):
+        if os.path.lexists(hull_file):
+            os.remove(hull_file)  # May be a hard link into the mesh cache
+        write_binary_stl(hull_file, hull_vertices, hull_triangles)
+    return files
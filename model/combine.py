@@ -0,0 +1,99 @@
+import logging
+
+import numpy as np
+from OCC.Core.BRep import BRep_Builder
+from OCC.Core.BRepAlgoAPI import BRepAlgoAPI_Fuse
+from OCC.Core.TopTools import TopTools_ListOfShape
+from OCC.Core.TopoDS import TopoDS_Compound
+
+from .massprops import (combine_mass_properties, relative_frame, scale_mass_properties, transform_inertia,
+                        usable_mass_properties)
+from .structures import UnitMassProperties
+from .workers import compute_mass_properties
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)  # set to DEBUG | INFO | ERROR
+
+# Shapes closer than this (mm) are glued by fuse_shapes, so that touching parts don't leave slivers
+DEFAULT_FUZZY_VALUE = 1e-4
+
+
+def collect_part_uids(uids, part_dict, parent_dict):
+    """uids of the parts in the components uids, assemblies replaced by all parts below them, without duplicates"""
+    part_uids = {}
+    pending = list(uids)[::-1]
+    while pending:
+        uid = pending.pop()
+        if uid in part_dict:
+            part_uids[uid] = None
+        elif uid in parent_dict:
+            pending.extend(parent_dict[uid][::-1])
+    return list(part_uids)
+
+
+def make_compound(shapes):
+    """Compound of shapes, without any boolean operation"""
+    builder = BRep_Builder()
+    compound = TopoDS_Compound()
+    builder.MakeCompound(compound)
+    for shape in shapes:
+        if not shape.IsNull():
+            builder.Add(compound, shape)
+    return compound
+
+
+def fuse_shapes(shapes, fuzzy_value=DEFAULT_FUZZY_VALUE, parallel=True):
+    """Boolean union of all shapes in one multi-argument operation. Raises RuntimeError if the operation fails."""
+    shapes = [shape for shape in shapes if not shape.IsNull()]
+    if len(shapes) < 2:
+        return make_compound(shapes)
+    arguments = TopTools_ListOfShape()
+    arguments.Append(shapes[0])
+    tools = TopTools_ListOfShape()
+    for shape in shapes[1:]:
+        tools.Append(shape)
+
+    fuse = BRepAlgoAPI_Fuse()
+    fuse.SetArguments(arguments)
+    fuse.SetTools(tools)
+    fuse.SetRunParallel(parallel)
+    fuse.SetFuzzyValue(fuzzy_value)
+    fuse.SetNonDestructive(True)  # The input shapes are still displayed and may be shared with other parts
+    fuse.Build()
+    if fuse.HasErrors() or not fuse.IsDone():
+        raise RuntimeError(f"Fusing {len(shapes)} shapes failed")
+    fuse.SimplifyResult()
+    return fuse.Shape()
+
+
+def combine_parts(parts, loc, fuse=False, fuzzy_value=DEFAULT_FUZZY_VALUE, workers=None):
+    """Combine parts into one shape with its local frame given by loc. Returns the shape, its mass and its unit
+    density mass properties.
+
+    The shape is a compound of the part shapes, or their boolean union if fuse is set. The mass properties are not
+    computed from the combined shape, but aggregated from the (cached) properties of the parts with their own mass or
+    density, so parts of different materials keep their weight. The unit density properties are those of the combined
+    body divided by its mean density, so that scaling them with the returned mass gives the aggregated inertia."""
+    missing = {i: (part.shape, part.loc) for i, part in enumerate(parts)
+               if usable_mass_properties(part.mass_properties, 'brep') is None}
+    for i, properties in compute_mass_properties(missing, workers).items():
+        parts[i].mass_properties = properties
+
+    bodies = []
+    volume = 0
+    for part in parts:
+        properties = part.mass_properties
+        mass, __, inertia = scale_mass_properties(properties, part.mass, part.density)
+        # From the local frame of the part to the combined local frame
+        center_of_mass, inertia = transform_inertia(properties.center_of_mass, inertia, relative_frame(part.loc, loc))
+        bodies.append((mass, center_of_mass, inertia))
+        volume += properties.volume
+    mass, center_of_mass, inertia = combine_mass_properties(bodies)
+    mean_density = mass / volume if volume else 1
+    unit_properties = UnitMassProperties(volume=volume, center_of_mass=center_of_mass.tolist(),
+                                         inertia=(np.asarray(inertia) / mean_density).tolist())
+
+    shapes = [part.shape for part in parts]
+    shape = fuse_shapes(shapes, fuzzy_value) if fuse else make_compound(shapes)
+    logger.info("Combined %i parts into a %s with mass %g", len(parts), "fused shape" if fuse else "compound", mass)
+    return shape, mass, unit_properties
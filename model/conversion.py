@@ -2,31 +2,103 @@ import graphviz
 import json
 import logging
 
-from PyQt5 import QtWidgets
-
+from . import meshcache
+from .collision import DEFAULT_CONCAVITY, DEFAULT_MAX_HULLS, collision_files
+from .fingerprint import compute_fingerprint, find_duplicates, part_geometry_hashes
+from .primitives import DEFAULT_MIN_FILL_RATIO, DEFAULT_PRIMITIVE_TOLERANCE, fit_primitive
+from .massprops import (combine_mass_properties, compute_unit_mass_properties, mass_properties_error,
+                        relative_frame, scale_mass_properties, transform_inertia, usable_mass_properties)
+from .tessellation import (DEFAULT_DEFLECTION, STL_PARAMETERS, TessellationPolicy, local_matrix, read_binary_stl,
+                           reuses_triangulation, stl_triangle_count, write_stl)
+from .workers import compute_mass_properties, write_collision_files, write_stl_files
 from .structures import JointProperty, PartProperty
 
 import os
 import xml.etree.ElementTree as ET
 from xml.dom import minidom
 import numpy as np
-from OCC.Core.BRepMesh import BRepMesh_IncrementalMesh
-from OCC.Core.StlAPI import StlAPI_Writer
-from OCC.Core.gp import gp_Trsf, gp_Pnt, gp_Dir
-from OCC.Core.BRepBuilderAPI import BRepBuilderAPI_Transform
-from OCC.Core.GProp import GProp_GProps
-from OCC.Core.BRepGProp import brepgprop_VolumeProperties
+from OCC.Core.gp import gp_Trsf
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)  # set to DEBUG | INFO | ERROR
 
 
+# Options of MJCFGenerator that the base class and the linear graph converter don't take
+MJCF_OPTIONS = ('mesh_workers', 'mesh_cache', 'stl_deflection', 'stl_angular_deflection', 'stl_min_deflection',
+                'max_body_triangles', 'max_model_triangles', 'collision', 'max_hulls', 'concavity', 'primitives',
+                'primitive_tolerance', 'min_fill_ratio', 'contact_exclusion_hops')
+
+
+def common_options(options):
+    """The options of an export that all converters take, without MJCF_OPTIONS"""
+    return {key: value for key, value in options.items() if key not in MJCF_OPTIONS}
+
+
+def fixed_joint_clusters(uids, joints):
+    """Groups of parts connected by Fixed joints (union-find). Returns a dict {representative uid: member uids} of
+    the groups with more than one part, the representative being the first member in the order of uids."""
+    order = {uid: i for i, uid in enumerate(uids)}
+    root_of = {uid: uid for uid in uids}
+
+    def find(uid):
+        while root_of[uid] != uid:
+            root_of[uid] = root_of[root_of[uid]]  # Path halving
+            uid = root_of[uid]
+        return uid
+
+    for joint in joints:
+        if joint.joint_type != 'Fixed' or joint.parent_uid not in root_of or joint.child_uid not in root_of:
+            continue
+        first, second = sorted((find(joint.parent_uid), find(joint.child_uid)), key=order.get)
+        root_of[second] = first
+
+    clusters = {}
+    for uid in uids:
+        clusters.setdefault(find(uid), []).append(uid)
+    return {representative: members for representative, members in clusters.items() if len(members) > 1}
+
+
+def joint_neighbor_pairs(uids, joints, hops=1):
+    """Pairs of parts at most hops joints apart, found by a breadth-first search from every part. Each pair is
+    listed once, ordered as in uids, and the pairs are sorted in the order of uids as well."""
+    order = {uid: i for i, uid in enumerate(uids)}
+    neighbors = {uid: set() for uid in uids}
+    for joint in joints:
+        if joint.parent_uid in neighbors and joint.child_uid in neighbors and joint.parent_uid != joint.child_uid:
+            neighbors[joint.parent_uid].add(joint.child_uid)
+            neighbors[joint.child_uid].add(joint.parent_uid)
+
+    pairs = []
+    for uid in uids:
+        reached = {uid}
+        frontier = [uid]
+        for __ in range(hops):
+            frontier = [neighbor for current in frontier for neighbor in neighbors[current] if neighbor not in reached]
+            reached.update(frontier)
+        pairs.extend((uid, other) for other in sorted(reached, key=order.get) if order[other] > order[uid])
+    return pairs
+
+
 class ConversionClass:
-    def __init__(self, part_dict, joint_dict):
+    def __init__(self, part_dict, joint_dict, deduplicate=False, dedup_tolerance=1e-4, mass_workers=None,
+                 mass_engine='brep', mesh_deflection=DEFAULT_DEFLECTION, mass_cross_check=False, merge_fixed=False):
+        self.part_dict = part_dict
+        self.merge_fixed = merge_fixed          # Merge parts connected by Fixed joints into one body
+        self.mass_workers = mass_workers        # Processes computing mass properties, see workers.py
+        self.mass_engine = mass_engine          # 'brep' (exact) or 'mesh' (faster approximation), see massprops.py
+        self.mesh_deflection = mesh_deflection  # Relative deflection of the triangulation used by the mesh engine
+        self.mass_cross_check = mass_cross_check  # Compare the mesh engine results with the exact ones
+        self.mass_cross_check_report = None
+        self.deduplicate = deduplicate          # Also share results between geometrically identical shapes
+        self.dedup_tolerance = dedup_tolerance
+        self.deduplication_report = None
         self.part_properties = {}      # Keyed by uid
         self.joint_properties = {}     # Keyed by uid
         self.uid_to_body_name = {}     # Mapping from uid to body_name
         self.uid_to_joint_name = {}    # Mapping from uid to joint_name
+        self.prototype_uids = {}       # Mapping from uid to the uid of the first instance of the same shape
+        self.member_properties = {}    # Properties of every part, also those merged into another body
+        self.body_members = {}         # uids of the parts making up each body in part_properties, keyed by uid
         self.get_properties(part_dict, joint_dict)
 
     def get_properties(self, part_dict, joint_dict):
@@ -38,7 +110,9 @@ class ConversionClass:
                 shape=part.shape,
                 loc=part.loc,
                 mass=part.mass,
-                density=part.density
+                density=part.density,
+                mass_properties=usable_mass_properties(part.mass_properties, self.mass_engine),
+                ref_entry=part.ref_entry
             )
             self.uid_to_body_name[uid] = body_name  # Map uid to body_name
 
@@ -62,36 +136,152 @@ class ConversionClass:
             )
             self.uid_to_joint_name[uid] = joint_name  # Map uid to joint_name
 
+        self.group_prototypes()
         self.get_inertial_properties()
+        self.member_properties = dict(self.part_properties)
+        self.body_members = {uid: [uid] for uid in self.part_properties}
+        if self.merge_fixed:
+            self.merge_fixed_joints()
         self.print_inertias()
 
-    def get_inertial_properties(self):
+    def group_prototypes(self):
+        """Map each part to the first part referring to the same shape (same ref_entry). All instances of a shape have
+        the same geometry in their local frame, so mass properties and meshes only have to be computed for the
+        first one."""
+        first_instance = {}
         for uid, part in self.part_properties.items():
-            shape = part.shape
-
-            # Apply the inverse of part.loc to compute inertial properties in the body's local frame
-            if part.loc and not part.loc.IsIdentity():
-                trsf_inv = part.loc.Inverted().Transformation()
-                shape = BRepBuilderAPI_Transform(shape, trsf_inv).Shape()
-
-            properties = GProp_GProps()
-            brepgprop_VolumeProperties(shape, properties)
-            inertia_tensor = properties.MatrixOfInertia()
-            com = properties.CentreOfMass()
-
-            if part.mass is None:
-                if part.density is not None:
-                    mass = properties.Mass() * part.density
-                else:
-                    mass = properties.Mass()
-                    part.density = 1
-            else:
-                mass = part.mass
-                part.density = mass / properties.Mass()
+            key = part.ref_entry if part.ref_entry is not None else uid
+            self.prototype_uids[uid] = first_instance.setdefault(key, uid)
+        logger.info("%i parts are instances of %i unique shapes", len(self.prototype_uids), len(first_instance))
+        # Before deduplicating, the fingerprints need the mass properties of every prototype
+        self.compute_prototype_mass_properties()
+        if self.mass_cross_check and self.mass_engine != 'brep':
+            self.cross_check_mass_properties()
+        if self.deduplicate:
+            self.deduplicate_prototypes()
+
+    def deduplicate_prototypes(self):
+        """Many STEP exporters write each copy of a part as a separate product, so the copies don't share a ref_entry.
+        Compare the geometric fingerprints of the remaining unique shapes and let identical shapes share one
+        prototype."""
+        fingerprints = {}
+        for prototype_uid in dict.fromkeys(self.prototype_uids.values()):
+            prototype = self.part_properties[prototype_uid]
+            fingerprint = compute_fingerprint(prototype.shape, prototype.loc, prototype.mass_properties)
+            # The fingerprint includes the mass properties, keep them so they aren't computed again
+            prototype.mass_properties = fingerprint.mass_properties
+            self.part_dict[prototype_uid].mass_properties = fingerprint.mass_properties
+            fingerprints[prototype_uid] = fingerprint
+
+        canonical = find_duplicates(fingerprints, self.dedup_tolerance)
+        for uid, prototype_uid in self.prototype_uids.items():
+            self.prototype_uids[uid] = canonical[prototype_uid]
+
+        unique_shapes = len(set(canonical.values()))
+        self.deduplication_report = {
+            'parts': len(self.prototype_uids),
+            'shapes_before': len(fingerprints),
+            'shapes_after': unique_shapes,
+            'duplicates_collapsed': len(fingerprints) - unique_shapes,
+        }
+        logger.info("Deduplication collapsed %i of %i unique shapes, %i shapes remain",
+                    len(fingerprints) - unique_shapes, len(fingerprints), unique_shapes)
+
+    def compute_prototype_mass_properties(self):
+        """Compute the missing unit density mass properties of all prototypes at once, in mass_workers processes"""
+        missing = {}
+        for prototype_uid in dict.fromkeys(self.prototype_uids.values()):
+            prototype = self.part_properties[prototype_uid]
+            if prototype.mass_properties is None:
+                missing[prototype_uid] = (prototype.shape, prototype.loc)
+        if not missing:
+            return
+        for prototype_uid, properties in compute_mass_properties(missing, self.mass_workers, self.mass_engine,
+                                                                 self.mesh_deflection).items():
+            self.part_properties[prototype_uid].mass_properties = properties
+            self.part_dict[prototype_uid].mass_properties = properties
+
+    def cross_check_mass_properties(self):
+        """Compute the exact mass properties of the prototypes and report the relative errors of the approximate ones
+        used for the export"""
+        prototype_uids = list(dict.fromkeys(self.prototype_uids.values()))
+        exact = compute_mass_properties({uid: (self.part_properties[uid].shape, self.part_properties[uid].loc)
+                                         for uid in prototype_uids}, self.mass_workers, 'brep')
+        self.mass_cross_check_report = {}
+        for uid in prototype_uids:
+            part = self.part_properties[uid]
+            errors = mass_properties_error(part.mass_properties, exact[uid])
+            self.mass_cross_check_report[part.name] = errors
+            logger.info("%s: relative error of volume %.2e, center of mass %.2e, inertia %.2e", part.name,
+                        errors['volume'], errors['center_of_mass'], errors['inertia'])
 
-            part.center_of_mass = [com.X(), com.Y(), com.Z()]
-            part.mass = mass
-            part.inertia = [[part.density * inertia_tensor.Value(i, j) for j in range(1, 4)] for i in range(1, 4)]
+    def get_inertial_properties(self):
+        for uid, part in self.part_properties.items():
+            # Unit density properties are cached on the Part, so they are only computed once per shape
+            if part.mass_properties is None:
+                prototype = self.part_properties[self.prototype_uids[uid]]
+                if prototype.mass_properties is None:
+                    prototype.mass_properties = compute_unit_mass_properties(prototype.shape, prototype.loc,
+                                                                             self.mass_engine, self.mesh_deflection)
+                part.mass_properties = prototype.mass_properties
+                self.part_dict[uid].mass_properties = part.mass_properties
+            properties = part.mass_properties
+
+            # A material change is only a rescale of the unit density properties
+            part.mass, part.density, part.inertia = scale_mass_properties(properties, part.mass, part.density)
+            part.center_of_mass = list(properties.center_of_mass)
+
+    def merge_fixed_joints(self):
+        """Replace every group of parts connected by Fixed joints with one body in the local frame of its first part.
+        Its mass, center of mass and inertia are combined from those of the parts, the Fixed joints inside the group
+        are dropped and the other joints are moved to the bodies that now contain their parts."""
+        clusters = fixed_joint_clusters(list(self.part_properties), self.joint_properties.values())
+        body_of = {}
+        for representative_uid, members in clusters.items():
+            representative = self.part_properties[representative_uid]
+            bodies = []
+            volume = 0
+            for uid in members:
+                part = self.part_properties[uid]
+                center_of_mass, inertia = transform_inertia(part.center_of_mass, part.inertia,
+                                                            relative_frame(part.loc, representative.loc))
+                bodies.append((part.mass, center_of_mass, inertia))
+                volume += part.mass_properties.volume
+            mass, center_of_mass, inertia = combine_mass_properties(bodies)
+
+            self.part_properties[representative_uid] = PartProperty(
+                name=representative.name,
+                shape=representative.shape,
+                loc=representative.loc,
+                center_of_mass=center_of_mass.tolist(),
+                inertia=inertia.tolist(),
+                mass=mass,
+                density=mass / volume if volume else None,
+                ref_entry=representative.ref_entry
+            )
+            self.body_members[representative_uid] = members
+            for uid in members:
+                body_of[uid] = representative_uid
+                self.uid_to_body_name[uid] = representative.name
+                if uid != representative_uid:
+                    del self.part_properties[uid]
+                    del self.body_members[uid]
+
+        for uid, joint in list(self.joint_properties.items()):
+            parent_uid = body_of.get(joint.parent_uid, joint.parent_uid)
+            child_uid = body_of.get(joint.child_uid, joint.child_uid)
+            if parent_uid == child_uid:
+                if joint.joint_type != 'Fixed':
+                    logger.warning("Dropped joint %s, its parts are also connected by Fixed joints", joint.name)
+                del self.joint_properties[uid]
+                continue
+            joint.parent_uid = parent_uid
+            joint.child_uid = child_uid
+            joint.parent = self.uid_to_body_name.get(parent_uid, joint.parent)
+            joint.child = self.uid_to_body_name.get(child_uid, joint.child)
+
+        logger.info("Merged %i parts connected by Fixed joints into %i bodies, %i bodies remain",
+                    sum(len(members) for members in clusters.values()), len(clusters), len(self.part_properties))
 
     def print_inertias(self):
         for uid, part in self.part_properties.items():
@@ -108,14 +298,43 @@ class ConversionClass:
 
 
 class MJCFGenerator(ConversionClass):
-    def __init__(self, part_dict, joint_dict, output_dir='mjcf_output'):
-        super().__init__(part_dict, joint_dict)
+    def __init__(self, part_dict, joint_dict, output_dir='mjcf_output', mesh_workers=None, mesh_cache=True,
+                 stl_deflection=0.001, stl_angular_deflection=0.5, stl_min_deflection=0.5, max_body_triangles=None,
+                 max_model_triangles=None, collision='hull', max_hulls=DEFAULT_MAX_HULLS, concavity=DEFAULT_CONCAVITY,
+                 primitives=False, primitive_tolerance=DEFAULT_PRIMITIVE_TOLERANCE,
+                 min_fill_ratio=DEFAULT_MIN_FILL_RATIO, contact_exclusion_hops=1, **kwargs):
+        self.mesh_workers = mesh_workers        # Processes meshing and writing the STL files
+        self.mesh_cache = mesh_cache            # Reuse STL files from the mesh cache, see meshcache.py
+        self.mesh_cache_report = None
+        # Tessellation of the STL files, the deflection is relative to the size of each body
+        self.tessellation_policy = TessellationPolicy(relative_deflection=stl_deflection,
+                                                      angular_deflection=stl_angular_deflection,
+                                                      min_deflection=stl_min_deflection,
+                                                      max_body_triangles=max_body_triangles,
+                                                      max_model_triangles=max_model_triangles)
+        self.triangle_counts = {}      # Triangles of each written mesh, keyed by the uid of its part
+        # Collision geometry: 'mesh' (the visual mesh), 'hull' or 'decomposition' (at most max_hulls convex hulls,
+        # until they exceed the volume of the part by at most concavity), see collision.py
+        self.collision = collision
+        self.max_hulls = max_hulls
+        self.concavity = concavity
+        # Collide with a box, cylinder, capsule or sphere instead where one fits the part, see primitives.py
+        self.primitives = primitives
+        self.primitive_tolerance = primitive_tolerance
+        self.min_fill_ratio = min_fill_ratio
+        # Exclude contacts between bodies at most this many joints apart, 0 keeps all contacts
+        self.contact_exclusion_hops = contact_exclusion_hops
+        super().__init__(part_dict, joint_dict, **kwargs)
         self.output_dir = output_dir
         self.model = ET.Element('mujoco', attrib={'model': 'ImportedModel'})
         self.asset = ET.SubElement(self.model, 'asset')
         self.part_id_map = {}  # Keyed by uid
         self.processed_parts = set()
         self.mesh_paths = {}   # Keyed by uid
+        self.mesh_names = {}   # Keyed by uid, instances of the same shape share one mesh asset
+        self.collision_mesh_names = {}  # Collision hull assets, keyed by the name of the visual mesh asset
+        self.collision_primitives = {}  # Primitive collision geoms (see fit_primitive), keyed likewise
+        self.mesh_keys = {}    # Mesh cache keys of the STL files that are in the mesh cache, keyed by uid
         self.create_worldbody()
 
         os.makedirs(self.output_dir, exist_ok=True)
@@ -176,18 +395,28 @@ class MJCFGenerator(ConversionClass):
             self.build_body(root_uid, parent_uid=None)
 
         self.add_joints()
+        self.add_contact_exclusions()
 
         output_path = os.path.join(self.output_dir, output_file)
         self.write_xml(output_path)
         print(f'MJCF model written to {output_path}')
 
     def process_assets(self):
-        for uid, part in self.part_properties.items():
+        stl_jobs = {}  # (shape, loc, stl_file) of the meshes to write, keyed by uid
+        for uid, part in self.member_properties.items():
+            prototype_uid = self.prototype_uids[uid]
+            if prototype_uid != uid:
+                # The mesh of the first instance has already been written
+                self.mesh_names[uid] = self.mesh_names[prototype_uid]
+                self.mesh_paths[uid] = self.mesh_paths[prototype_uid]
+                continue
+
             part_name = part.name
             stl_file = os.path.join(self.output_dir, f'{part_name}.stl')
 
-            self.export_shape_to_stl(part.shape, stl_file, part.loc)
+            stl_jobs[uid] = (part.shape, part.loc, stl_file)
 
+            self.mesh_names[uid] = part_name
             self.mesh_paths[uid] = stl_file
 
             mesh_attrib = {
@@ -196,28 +425,135 @@ class MJCFGenerator(ConversionClass):
             }
             ET.SubElement(self.asset, 'mesh', attrib=mesh_attrib)
 
-    def export_shape_to_stl(self, shape, stl_file, part_loc):
-        if shape.IsNull():
-            raise ValueError('Invalid shape provided for STL export.')
-
-        # Apply the inverse of part_loc to transform the shape into the body's local frame
-        if part_loc and not part_loc.IsIdentity():
-            trsf_inv = part_loc.Inverted().Transformation()
-            shape = BRepBuilderAPI_Transform(shape, trsf_inv).Shape()
-
-        scale_trsf = gp_Trsf()
-        scale_trsf.SetScale(gp_Pnt(0, 0, 0), 0.001)  # Scale from mm to meters
-
-        # Apply scaling
-        transformed_shape = BRepBuilderAPI_Transform(shape, scale_trsf).Shape()
-
-        # Mesh and export the transformed shape
-        mesh = BRepMesh_IncrementalMesh(transformed_shape, 0.0005)
-        mesh.Perform()
+        # The asset entries are added above in part order, only the files are written in parallel
+        policy = self.tessellation_policy
+        budgets = {uid: policy.max_body_triangles for uid in stl_jobs}
+        self.mesh_cache_report = {'hits': 0, 'misses': 0} if self.mesh_cache and meshcache.is_enabled() else None
+        triangle_counts = self.write_meshes(stl_jobs, budgets)
+
+        # If the model is over budget, mesh the bodies again within their share of it
+        model_budgets = policy.body_budgets(triangle_counts)
+        if model_budgets is not None:
+            budgets = {uid: min(budget, budgets[uid] or budget) for uid, budget in model_budgets.items()}
+            over_budget = {uid: job for uid, job in stl_jobs.items() if triangle_counts[uid] > budgets[uid]}
+            triangle_counts.update(self.write_meshes(over_budget, budgets))
+
+        self.triangle_counts = {uid: triangle_counts[uid] for uid in stl_jobs}
+        if self.mesh_cache_report is not None:
+            print(f"Mesh cache: {self.mesh_cache_report['hits']} hits, {self.mesh_cache_report['misses']} misses")
+        total = sum(self.triangle_counts.values())
+        print(f"Wrote {len(self.triangle_counts)} meshes with {total} triangles")
+        if self.triangle_counts:
+            largest_uid = max(self.triangle_counts, key=self.triangle_counts.get)
+            logger.info("Largest mesh: %s with %i triangles", self.mesh_names[largest_uid],
+                        self.triangle_counts[largest_uid])
+        logger.info("Wrote %i meshes for %i parts", len(set(self.mesh_names.values())), len(self.mesh_names))
+
+        if self.primitives:
+            self.fit_collision_primitives(stl_jobs)
+        if self.collision != 'mesh':
+            self.process_collision_assets({uid: job for uid, job in stl_jobs.items()
+                                           if self.mesh_names[uid] not in self.collision_primitives})
+        if self.mesh_cache_report is not None:
+            meshcache.prune_cache()
+
+    def fit_collision_primitives(self, stl_jobs):
+        """Fit primitive collision geoms to the parts whose faces allow it, from their B-rep faces and written STL
+        meshes"""
+        for uid, (shape, loc, stl_file) in stl_jobs.items():
+            primitive = fit_primitive(shape, loc, *read_binary_stl(stl_file), self.primitive_tolerance,
+                                      self.min_fill_ratio)
+            if primitive is not None:
+                self.collision_primitives[self.mesh_names[uid]] = primitive
+        counts = {}
+        for primitive in self.collision_primitives.values():
+            counts[primitive['type']] = counts.get(primitive['type'], 0) + 1
+        summary = ', '.join(f'{count} {geom_type}' for geom_type, count in sorted(counts.items()))
+        print(f"Primitive collision geoms for {len(self.collision_primitives)} of {len(stl_jobs)} meshes"
+              + (f": {summary}" if summary else ''))
+
+    def process_collision_assets(self, stl_jobs):
+        """Write the collision hulls of the visual meshes and add them as mesh assets. Hulls are computed from the
+        written STL files, so they are in the same frame and units and also work for meshes from the mesh cache."""
+        parameters = {'collision': self.collision, 'max_hulls': self.max_hulls, 'concavity': self.concavity}
+        hull_files = {}
+        set_keys = {}
+        for uid, (__, __, stl_file) in stl_jobs.items():
+            if self.mesh_cache_report is None or uid not in self.mesh_keys:
+                continue
+            set_keys[uid] = meshcache.mesh_set_key(self.mesh_keys[uid], parameters)
+            cached = meshcache.fetch_mesh_set(set_keys[uid], lambda count: collision_files(stl_file, count))
+            if cached is not None:
+                hull_files[uid] = cached
+        missing = [uid for uid in stl_jobs if uid not in hull_files]
+        jobs = [(stl_jobs[uid][2], self.collision, self.max_hulls, self.concavity) for uid in missing]
+        for uid, files in zip(missing, write_collision_files(jobs, self.mesh_workers)):
+            hull_files[uid] = files
+            if uid in set_keys:
+                meshcache.store_mesh_set(set_keys[uid], files)
+        if missing != list(stl_jobs):
+            logger.info("Collision hulls of %i meshes taken from the mesh cache", len(stl_jobs) - len(missing))
+
+        for uid in stl_jobs:
+            names = []
+            for hull_file in hull_files[uid]:
+                name = os.path.splitext(os.path.basename(hull_file))[0]
+                ET.SubElement(self.asset, 'mesh', attrib={'name': name, 'file': os.path.basename(hull_file)})
+                names.append(name)
+            if names:
+                self.collision_mesh_names[self.mesh_names[uid]] = names
+            else:
+                logger.warning("%s is flat, its visual mesh is used for collisions", self.mesh_names[uid])
+        hull_count = sum(len(names) for names in self.collision_mesh_names.values())
+        logger.info("Wrote %i collision hulls for %i meshes", hull_count, len(self.collision_mesh_names))
+
+    def write_meshes(self, stl_jobs, budgets):
+        """Write the STL files of stl_jobs {uid: (shape, loc, stl_file)} within the triangle budgets {uid: maximum},
+        taking them from the mesh cache where possible. Returns the number of triangles of each file."""
+        triangle_counts = {}
+        cache_keys = {}
+        if self.mesh_cache_report is not None:
+            stl_jobs, cache_keys, triangle_counts = self.fetch_cached_meshes(stl_jobs, budgets)
+            # Meshes made from a finer triangulation that was already on the shape may not match their key, see
+            # policy_mesh
+            policy = self.tessellation_policy
+            cache_keys = {uid: key for uid, key in cache_keys.items()
+                          if not reuses_triangulation(stl_jobs[uid][0], policy.deflection(stl_jobs[uid][0]))}
+        written = write_stl_files([job + (budgets[uid],) for uid, job in stl_jobs.items()], self.mesh_workers,
+                                  self.tessellation_policy)
+        triangle_counts.update(zip(stl_jobs, written))
+        for uid in stl_jobs:
+            self.mesh_keys.pop(uid, None)
+        for uid, key in cache_keys.items():
+            meshcache.store_mesh(key, stl_jobs[uid][2])
+            self.mesh_keys[uid] = key
+        return triangle_counts
+
+    def fetch_cached_meshes(self, stl_jobs, budgets):
+        """Link the meshes that are in the mesh cache to their STL files. Returns the jobs of the meshes that still
+        have to be written, their cache keys and the triangle counts of the linked meshes, and adds the numbers of
+        hits and misses to mesh_cache_report."""
+        geometry_hashes = part_geometry_hashes({uid: self.part_dict[uid] for uid in stl_jobs})
+        missing = {}
+        keys = {}
+        triangle_counts = {}
+        for uid, (shape, loc, stl_file) in stl_jobs.items():
+            parameters = dict(STL_PARAMETERS, **self.tessellation_policy.parameters(), max_triangles=budgets[uid])
+            key = meshcache.mesh_key(geometry_hashes[uid], shape, loc, parameters)
+            if meshcache.fetch_mesh(key, stl_file):
+                triangle_counts[uid] = stl_triangle_count(stl_file)
+                self.mesh_keys[uid] = key
+            else:
+                missing[uid] = stl_jobs[uid]
+                keys[uid] = key
+        self.mesh_cache_report['hits'] += len(stl_jobs) - len(missing)
+        self.mesh_cache_report['misses'] += len(missing)
+        return missing, keys, triangle_counts
 
-        stl_writer = StlAPI_Writer()
-        stl_writer.SetASCIIMode(False)
-        stl_writer.Write(transformed_shape, stl_file)
+    def export_shape_to_stl(self, shape, stl_file, part_loc):
+        # Written in the body's local frame
+        return write_stl(shape, stl_file, local_matrix(part_loc), self.tessellation_policy,
+                         self.tessellation_policy.max_body_triangles)
 
     def find_root_uids(self):
         child_uids = set(joint.child_uid for joint in self.joint_properties.values())
@@ -270,7 +606,17 @@ class MJCFGenerator(ConversionClass):
 
         self.add_inertial(body, part)
 
-        self.add_geom(body, part)
+        for member_uid in self.body_members[part_uid]:
+            if member_uid == part_uid:
+                self.add_geom(body, part, self.mesh_names[part_uid])
+                continue
+            # Part merged into this body (merge_fixed), its mesh is placed relative to the body frame
+            member = self.member_properties[member_uid]
+            member_trsf = member.loc.Transformation() if member.loc else gp_Trsf()
+            member_pos, member_quat = self.trsf_to_pos_quat(member_trsf)
+            geom_pos, geom_quat = self.compute_relative_transform(part_pos, part_quat,
+                                                                  np.array(member_pos) * 0.001, member_quat)
+            self.add_geom(body, member, self.mesh_names[member_uid], geom_pos, geom_quat)
 
         self.processed_parts.add(part_uid)
 
@@ -310,23 +656,78 @@ class MJCFGenerator(ConversionClass):
         }
         ET.SubElement(body, 'inertial', attrib=inertial_attrib)
 
-    def add_geom(self, body, part):
-        part_name = part.name
-
+    def add_geom(self, body, part, mesh_name=None, pos=None, quat=None):
+        mesh_name = mesh_name or part.name
+        collision_mesh_names = self.collision_mesh_names.get(mesh_name, [])
+        primitive = self.collision_primitives.get(mesh_name)
         geom_attrib = {
             'type': 'mesh',
-            'mesh': part_name,
+            'mesh': mesh_name,
             'rgba': '0.8 0.6 0.4 1',  # Placeholder color
             'contype': '1',
             'conaffinity': '1'
         }
+        if collision_mesh_names or primitive is not None:
+            # Only shown, the collision hulls or primitive below take part in contacts
+            geom_attrib.update({'contype': '0', 'conaffinity': '0', 'group': '2'})
+        if pos is not None:
+            geom_attrib['pos'] = ' '.join(map(str, pos))
+            geom_attrib['quat'] = ' '.join(map(str, quat))
         ET.SubElement(body, 'geom', attrib=geom_attrib)
 
+        for collision_mesh_name in collision_mesh_names:
+            collision_attrib = dict(geom_attrib, mesh=collision_mesh_name, contype='1', conaffinity='1', group='3')
+            ET.SubElement(body, 'geom', attrib=collision_attrib)
+        if primitive is not None:
+            ET.SubElement(body, 'geom', attrib=self.primitive_geom_attrib(primitive, pos, quat))
+
+    def primitive_geom_attrib(self, primitive, pos=None, quat=None):
+        """Geom attributes of a fitted primitive, placed like a mesh geom with the given pos and quat"""
+        def place(point):
+            if pos is None:
+                return point
+            return np.array(pos) + self.rotate_vector_by_quaternion(point, quat)
+
+        def rotate(direction):
+            return direction if quat is None else self.rotate_vector_by_quaternion(direction, quat)
+
+        geom_attrib = {
+            'type': primitive['type'],
+            'size': ' '.join(map(str, primitive['size'])),
+            'rgba': '0.8 0.6 0.4 1',
+            'contype': '1',
+            'conaffinity': '1',
+            'group': '3'
+        }
+        if 'fromto' in primitive:
+            geom_attrib['fromto'] = ' '.join(map(str, np.concatenate([place(point) for point in primitive['fromto']])))
+        else:
+            geom_attrib['pos'] = ' '.join(map(str, place(primitive['pos'])))
+        if 'axes' in primitive:
+            geom_attrib['xyaxes'] = ' '.join(map(str, np.concatenate([rotate(axis) for axis in primitive['axes'][:2]])))
+        return geom_attrib
+
     def add_joints(self):
         for joint in self.joint_properties.values():
             if joint.joint_type != 'Fixed':
                 self.add_joint(joint)
 
+    def add_contact_exclusions(self):
+        """Exclude contacts between jointed bodies, which usually overlap at the joint, and between bodies up to
+        contact_exclusion_hops joints apart. MuJoCo already filters parent and child bodies of the tree, but not the
+        bodies of closed loops or those further apart."""
+        if not self.contact_exclusion_hops:
+            return
+        uids = [uid for uid in self.part_properties if uid in self.part_id_map]
+        pairs = joint_neighbor_pairs(uids, self.joint_properties.values(), self.contact_exclusion_hops)
+        if not pairs:
+            return
+        contact = ET.SubElement(self.model, 'contact')
+        for first_uid, second_uid in pairs:
+            ET.SubElement(contact, 'exclude', attrib={'body1': self.part_properties[first_uid].name,
+                                                      'body2': self.part_properties[second_uid].name})
+        logger.info("Excluded contacts between %i pairs of bodies", len(pairs))
+
     def trsf_to_pos_quat(self, trsf):
         # Extract translation
         translation = trsf.TranslationPart()
@@ -444,6 +845,8 @@ class MJCFGenerator(ConversionClass):
             f.write(pretty_xml)
 
     def get_mjcf_folder(self):
+        from PyQt5 import QtWidgets
+
         options = QtWidgets.QFileDialog.Options()
         options |= QtWidgets.QFileDialog.DontUseNativeDialog
         directory = QtWidgets.QFileDialog.getExistingDirectory(None, "Select Directory")
@@ -453,16 +856,16 @@ class MJCFGenerator(ConversionClass):
         return directory
 
 
-link_endpoint_count = {}
-
-
 class LinearGraphConverter(ConversionClass):
-    def __init__(self, part_dict, joint_dict):
-        super().__init__(part_dict, joint_dict)
+    def __init__(self, part_dict, joint_dict, **kwargs):
+        super().__init__(part_dict, joint_dict, **kwargs)
         self.translation_index = 0
         self.rotation_index = 0
+        self.link_endpoint_count = {}  # Number of joint end points per link, keyed by link name
 
     def get_graph_folder(self):
+        from PyQt5 import QtWidgets
+
         options = QtWidgets.QFileDialog.Options()
         options |= QtWidgets.QFileDialog.DontUseNativeDialog
         directory = QtWidgets.QFileDialog.getExistingDirectory(None, "Select Directory")
@@ -565,6 +968,7 @@ class LinearGraphConverter(ConversionClass):
                 'friction': joint_property.joint_friction
             }
 
+        link_endpoint_count = self.link_endpoint_count
         if joint_parent not in link_endpoint_count:
             link_endpoint_count[joint_parent] = 0  # Initialize the count for this parent if it doesn't exist
         if joint_child not in link_endpoint_count:
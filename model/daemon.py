@@ -0,0 +1,216 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)  # set to DEBUG | INFO | ERROR
+
+DEFAULT_HOST = '127.0.0.1'
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    """Reads one json request per line and answers each with one json line"""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.conversion_daemon.handle_message(line)
+            self.wfile.write((json.dumps(response) + '\n').encode())
+            self.wfile.flush()
+            if not self.server.conversion_daemon.running:
+                return
+
+
+class ConversionDaemon:
+    """Long-lived conversion server listening on a UNIX socket or a localhost port.
+
+    OCC is imported and an XCAF application is set up once at start. Parsed models are kept in an LRU cache keyed by
+    file path, size and modification time, and the mass properties computed for a model are cached on its parts, so
+    repeated jobs for the same file skip STEP translation and inertia computation."""
+
+    def __init__(self, socket_path=None, host=DEFAULT_HOST, port=None, max_models=8):
+        # Warm up OCC: import the conversion modules and set up the XCAF application with the BinXCAF drivers
+        from . import pipeline
+        from .docmodel import close_doc, create_doc
+        close_doc(*create_doc())
+
+        self.pipeline = pipeline
+        self.max_models = max_models
+        self.models = OrderedDict()  # {(path, size, mtime) : (DocModel, joint_dict)}, least recently used first
+        self.stats = {'requests': 0, 'model_hits': 0, 'model_misses': 0, 'errors': 0}
+        self.running = False
+        self.commands = {
+            'ping': self.ping,
+            'load': self.load,
+            'mass_properties': self.mass_properties,
+            'export_mjcf': self.export_mjcf,
+            'export_linear_graph': self.export_linear_graph,
+            'stats': self.get_stats,
+            'memory': self.memory,
+            'shutdown': self.shutdown,
+        }
+
+        self.socket_path = socket_path
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)  # Stale socket left by a daemon that was killed
+            self.server = socketserver.UnixStreamServer(socket_path, DaemonRequestHandler)
+        else:
+            self.server = socketserver.TCPServer((host, port or 0), DaemonRequestHandler)
+        self.server.conversion_daemon = self
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def serve(self):
+        """Handle requests until a shutdown request is received. Jobs are handled one at a time, since OCC is not
+        thread safe."""
+        self.running = True
+        logger.info("Conversion daemon listening on %s", self.address)
+        try:
+            while self.running:
+                self.server.handle_request()
+        finally:
+            self.server.server_close()
+            if self.socket_path is not None and os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            logger.info("Conversion daemon stopped")
+
+    def handle_message(self, line):
+        start = time.perf_counter()
+        self.stats['requests'] += 1
+        try:
+            request = json.loads(line)
+            command = request.pop("command")
+            if command not in self.commands:
+                raise ValueError(f"Unknown command: {command}")
+            result = self.commands[command](**request)
+            response = {'ok': True, 'result': result}
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.exception("Request failed")
+            response = {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+        response['seconds'] = time.perf_counter() - start
+        return response
+
+    def get_model(self, path):
+        """Return (DocModel, joint_dict, cached) for the STEP or project file at path"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if key in self.models:
+            self.stats['model_hits'] += 1
+            self.models.move_to_end(key)
+            dm, joint_dict = self.models[key]
+            return dm, joint_dict, True
+
+        self.stats['model_misses'] += 1
+        # Drop older revisions of the same file, they can't be requested anymore
+        for old_key in [old_key for old_key in self.models if old_key[0] == path]:
+            self.models.pop(old_key)[0].close()
+        dm, joint_dict = self.pipeline.load_model(path)
+        self.models[key] = (dm, joint_dict)
+        while len(self.models) > self.max_models:
+            __, (evicted_dm, __) = self.models.popitem(last=False)
+            evicted_dm.close()
+        return dm, joint_dict, False
+
+    def ping(self):
+        return {'pid': os.getpid()}
+
+    def load(self, path):
+        dm, joint_dict, cached = self.get_model(path)
+        return {'parts': len(dm.part_dict), 'joints': len(joint_dict), 'cached': cached}
+
+    def mass_properties(self, path, options=None):
+        from .conversion import ConversionClass
+
+        dm, joint_dict, cached = self.get_model(path)
+        converter = ConversionClass(dm.part_dict, joint_dict, **(options or {}))
+        parts = {uid: {'name': part.name, 'mass': part.mass, 'density': part.density,
+                       'center_of_mass': part.center_of_mass, 'inertia': part.inertia}
+                 for uid, part in converter.part_properties.items()}
+        return {'parts': parts, 'cached': cached}
+
+    def export_mjcf(self, path, output_dir, output_file='model.xml', options=None):
+        dm, joint_dict, cached = self.get_model(path)
+        mjcf_path = self.pipeline.export_mjcf(dm.part_dict, joint_dict, output_dir, output_file, **(options or {}))
+        return {'mjcf': mjcf_path, 'cached': cached}
+
+    def export_linear_graph(self, path, output_dir, render_graphs=False, options=None):
+        dm, joint_dict, cached = self.get_model(path)
+        json_path = self.pipeline.export_linear_graph(dm.part_dict, joint_dict, output_dir, render_graphs,
+                                                      **(options or {}))
+        return {'linear_graph': json_path, 'cached': cached}
+
+    def get_stats(self):
+        return dict(self.stats, models=[key[0] for key in self.models])
+
+    def memory(self, path=None):
+        """Memory report (see model.memory) of the cached model of path, or of all cached models"""
+        from .memory import memory_report
+
+        return {key[0]: memory_report(dm) for key, (dm, __) in self.models.items()
+                if path is None or key[0] == os.path.abspath(path)}
+
+    def shutdown(self):
+        self.running = False
+        return {}
+
+
+class DaemonClient:
+    """Client for the conversion daemon, connects either to a UNIX socket or to a localhost port"""
+
+    def __init__(self, socket_path=None, host=DEFAULT_HOST, port=None, timeout=None):
+        if socket_path is None and port is None:
+            raise ValueError("Either socket_path or port has to be given")
+        self.socket_path = socket_path
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def connect(self):
+        if self.socket_path is not None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+        else:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        return sock
+
+    def request(self, command, **params):
+        """Send one request and return its result. Raises RuntimeError if the daemon reports an error."""
+        message = dict(params, command=command)
+        with self.connect() as sock, sock.makefile('rwb') as stream:
+            stream.write((json.dumps(message) + '\n').encode())
+            stream.flush()
+            line = stream.readline()
+        if not line:
+            raise RuntimeError("Conversion daemon closed the connection without answering")
+        response = json.loads(line)
+        if not response['ok']:
+            raise RuntimeError(response['error'])
+        return response['result']
+
+    def ping(self):
+        return self.request('ping')
+
+    def export_mjcf(self, path, output_dir, output_file='model.xml', **options):
+        return self.request('export_mjcf', path=os.path.abspath(path), output_dir=os.path.abspath(output_dir),
+                            output_file=output_file, options=options)
+
+    def export_linear_graph(self, path, output_dir, render_graphs=False, **options):
+        return self.request('export_linear_graph', path=os.path.abspath(path),
+                            output_dir=os.path.abspath(output_dir), render_graphs=render_graphs, options=options)
+
+    def mass_properties(self, path, **options):
+        return self.request('mass_properties', path=os.path.abspath(path), options=options)
+
+    def shutdown(self):
+        return self.request('shutdown')
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from OCC import VERSION
+from OCC.Core.BinXCAFDrivers import binxcafdrivers_DefineFormat
+from OCC.Core.PCDM import PCDM_RS_AlreadyRetrieved, PCDM_RS_OK, PCDM_SS_OK
+from OCC.Core.TCollection import TCollection_ExtendedString
+from OCC.Core.TDocStd import TDocStd_Document
+from OCC.Core.XCAFApp import XCAFApp_Application_GetApplication
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)  # set to DEBUG | INFO | ERROR
+
+# Set CADCONVERSION_CACHE_DIR to move the cache, or to an empty string to disable it
+CACHE_DIR = os.environ.get('CADCONVERSION_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'cadconversion', 'xcaf'))
+CACHE_EXTENSION = '.xbf'
+# Largest total size of the cached documents in MB, the least recently used ones are removed beyond it
+MAX_CACHE_MB = float(os.environ.get('CADCONVERSION_CACHE_MB', 10000))
+
+_hash_memo = {}  # {(path, size, mtime) : sha256 hex digest}
+
+
+def file_content_hash(f_path):
+    """sha256 of the file content. The result is remembered for as long as the size and modification time of the
+    file don't change, so the file is only read again when it has been written to."""
+    stat = os.stat(f_path)
+    memo_key = (os.path.abspath(f_path), stat.st_size, stat.st_mtime_ns)
+    if memo_key in _hash_memo:
+        return _hash_memo[memo_key]
+
+    sha = hashlib.sha256()
+    with open(f_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    _hash_memo[memo_key] = digest
+    return digest
+
+
+def cache_key(f_path, reader_settings):
+    """Key of the cached document: the STEP file content, the reader settings and the OCC version"""
+    sha = hashlib.sha256()
+    sha.update(file_content_hash(f_path).encode())
+    sha.update(json.dumps(reader_settings, sort_keys=True).encode())
+    sha.update(VERSION.encode())
+    return sha.hexdigest()
+
+
+def cache_path(key):
+    return os.path.join(CACHE_DIR, key + CACHE_EXTENSION)
+
+
+def is_enabled():
+    return bool(CACHE_DIR)
+
+
+def read_doc_file(path):
+    """Open a BinXCAF document file. Returns (doc, app), or None if it could not be opened."""
+    app = XCAFApp_Application_GetApplication()
+    binxcafdrivers_DefineFormat(app)
+    doc = TDocStd_Document(TCollection_ExtendedString("BinXCAF"))
+    status = app.Open(TCollection_ExtendedString(path), doc)
+    if status == PCDM_RS_AlreadyRetrieved:
+        # The application only hands out the document that is already open for this file, e.g. by the model that is
+        # being reloaded. Every model closes its own document, so open a private copy instead.
+        fd, copy_path = tempfile.mkstemp(suffix=CACHE_EXTENSION)
+        os.close(fd)
+        try:
+            shutil.copyfile(path, copy_path)
+            doc = TDocStd_Document(TCollection_ExtendedString("BinXCAF"))
+            status = app.Open(TCollection_ExtendedString(copy_path), doc)
+        finally:
+            os.remove(copy_path)
+    if status != PCDM_RS_OK:
+        logger.warning("Could not open document %s (status %s)", path, status)
+        return None
+    return doc, app
+
+
+def write_doc_file(doc, app, path):
+    """Save doc as a BinXCAF document file. Returns True on success."""
+    status = app.SaveAs(doc, TCollection_ExtendedString(path))
+    if status != PCDM_SS_OK:
+        logger.warning("Could not write document to %s (status %s)", path, status)
+        return False
+    return True
+
+
+def load_doc(key):
+    """Open the cached document for key. Returns (doc, app), or None if there is no valid cached document."""
+    path = cache_path(key)
+    if not os.path.exists(path):
+        return None
+    cached = read_doc_file(path)
+    if cached is None:
+        logger.warning("Cached document %s will be recreated", path)
+    else:
+        try:
+            os.utime(path)  # Used, see prune_cache
+        except OSError:
+            pass
+    return cached
+
+
+def save_doc(doc, app, key):
+    """Store doc in the cache. The file is written to a temporary name first, so that an interrupted write never
+    leaves a truncated cache entry behind."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(suffix=CACHE_EXTENSION, dir=CACHE_DIR)
+    os.close(fd)
+    if not write_doc_file(doc, app, temp_path):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+    os.replace(temp_path, cache_path(key))
+    prune_cache(keep=key)
+    return True
+
+
+def prune_cache(max_mb=None, keep=None):
+    """Remove the least recently used (saved or loaded) documents until the cache is at most max_mb (default
+    MAX_CACHE_MB) large. The document for the key keep is never removed, even if it is larger on its own. Returns
+    the number of removed documents."""
+    max_bytes = (MAX_CACHE_MB if max_mb is None else max_mb) * 1e6
+    if not os.path.isdir(CACHE_DIR):
+        return 0
+    documents = []
+    for entry in os.scandir(CACHE_DIR):
+        # Temporary files are still being written by save_doc, possibly in another process
+        if entry.name.endswith(CACHE_EXTENSION) and not entry.name.startswith('tmp'):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            documents.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for __, size, __ in documents)
+    removed = 0
+    for __, size, path in sorted(documents):
+        if total <= max_bytes:
+            break
+        if keep is not None and path == cache_path(keep):
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    if removed:
+        logger.info("Removed %i least recently used documents from the cache", removed)
+    return removed
+
+
+def clear_cache():
+    """Remove all cached documents"""
+    if not os.path.isdir(CACHE_DIR):
+        return
+    for f_name in os.listdir(CACHE_DIR):
+        if f_name.endswith(CACHE_EXTENSION):
+            os.remove(os.path.join(CACHE_DIR, f_name))
@@ -16,13 +16,22 @@ from OCC.Core.XCAFDoc import (
     XCAFDoc_DocumentTool_ColorTool,
     XCAFDoc_ColorSurf,
 )
-from PyQt5 import QtWidgets
 
+from . import doccache
+from .fingerprint import part_geometry_hashes
 from .structures import Part
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)  # set to DEBUG | INFO | ERROR
 
+# Settings of the STEPCAFControl_Reader, part of the key of cached documents
+STEP_READER_SETTINGS = {
+    'color_mode': True,
+    'layer_mode': True,
+    'name_mode': True,
+    'mat_mode': True,
+}
+
 
 def create_doc():
     doc_format = "BinXCAF"
@@ -33,13 +42,36 @@ def create_doc():
     return doc, app
 
 
+def close_doc(doc, app):
+    """Close doc, so that the application releases it together with the shapes and attributes it holds. Every
+    document that is created or opened stays in the session of the (global) XCAF application until it is closed."""
+    if doc is not None and app is not None and doc.IsOpened():
+        app.Close(doc)
+
+
+class LazyPart:
+    """Placeholder for a part whose shape has not been loaded yet, see DocModel.parse_structure"""
+    def __init__(self, c_label, ref_label, res_loc):
+        self.c_label = c_label
+        self.ref_label = ref_label
+        self.res_loc = res_loc
+
+
 class DocModel:
-    def __init__(self):
-        self.doc, self.app = create_doc()
+    """A model parsed from an XCAF document. The DocModel owns its document: close() closes it once the model is not
+    needed anymore. When another DocModel takes over the document with copy_model_from, release() this one instead."""
+
+    def __init__(self, instancing=True, doc=None, app=None):
+        self.doc, self.app = doc, app
         self.previous_label_dict = None
+        # If True, each part shares the geometry of its referred shape and only carries its own location. If False,
+        # each part gets its own transformed copy of the shape (BRepBuilderAPI_Transform).
+        self.instancing = instancing
+        self.structure_only = False  # If True, parts are not loaded while parsing, see parse_structure
 
         # Used by redraw()
         self.part_dict = {}  # {uid : Part}
+        self.lazy_parts = {}  # {uid : LazyPart} of the parts that are not loaded (not in part_dict) yet
         # Used to construct tree_view and access labels
         # {uid : {keys : .'entry', 'name', 'parent_uid', 'ref_entry', 'is_assembly'}}
         self.label_dict = {}
@@ -48,9 +80,41 @@ class DocModel:
         self.parent_uid_stack = []  # uid of parent lineage, topmost first
         self.assembly_entry_stack = []  # entries of containing assemblies, immediate last
         self.assembly_loc_stack = []  # applicable <TopLoc_Location> locations
+        self.cumulative_loc_stack = []  # product of assembly_loc_stack up to each level, root first
+        self.root_uid = None
+        self.root_shape = None
+
+    def set_doc(self, doc, app):
+        """Replace the document of this model, closing the previous one"""
+        if self.doc is not doc:
+            close_doc(self.doc, self.app)
+        self.doc, self.app = doc, app
+
+    def release(self):
+        """Drop the references to the document and the parts without closing the document"""
+        self.doc = self.app = None
+        self.part_dict = {}
+        self.lazy_parts = {}
+        self.label_dict = {}
+        self.parent_dict = {}
         self.root_uid = None
         self.root_shape = None
 
+    def close(self):
+        """Close the document and release the parts derived from it"""
+        close_doc(self.doc, self.app)
+        self.release()
+
+    def copy_model_from(self, other):
+        """Make this DocModel hold the same model as other. The dicts are shared, not copied."""
+        self.doc, self.app = other.doc, other.app
+        self.part_dict = other.part_dict
+        self.lazy_parts = other.lazy_parts
+        self.label_dict = other.label_dict
+        self.parent_dict = other.parent_dict
+        self.root_uid = other.root_uid
+        self.root_shape = other.root_shape
+
     def get_uid_from_entry(self, entry):
         if entry in self._share_dict:
             value = self._share_dict[entry]
@@ -61,7 +125,55 @@ class DocModel:
         return entry + '.' + str(value)
 
     def parse_doc(self):
-        """Generate new part_dict & label_dict from self.doc
+        """Generate new part_dict & label_dict from self.doc, see iter_parse_doc"""
+        for __ in self.iter_parse_doc():
+            pass
+
+    def parse_structure(self):
+        """First phase of a partial load: generate label_dict & parent_dict from self.doc, but don't load any parts.
+        Parts are only kept as placeholders in lazy_parts, until they are loaded with load_subtree or load_part."""
+        for __ in self.iter_parse_doc(structure_only=True):
+            pass
+
+    def load_part(self, uid):
+        """Load the part with uid if it is still a placeholder, and return it"""
+        if uid not in self.part_dict:
+            lazy_part = self.lazy_parts.pop(uid)
+            shape_tool = XCAFDoc_DocumentTool_ShapeTool(self.doc.Main())
+            color_tool = XCAFDoc_DocumentTool_ColorTool(self.doc.Main())
+            self.part_dict[uid] = self.create_part(lazy_part.c_label, lazy_part.ref_label, self.label_dict[uid]['name'],
+                                                   lazy_part.res_loc, shape_tool, color_tool)
+        return self.part_dict[uid]
+
+    def load_subtree(self, uid):
+        """Load all parts in the subtree of the component with uid (which may be a part itself). Returns the uids of
+        the parts that were loaded."""
+        loaded = []
+        stack = [uid]
+        while stack:
+            uid = stack.pop()
+            if uid in self.lazy_parts:
+                self.load_part(uid)
+                loaded.append(uid)
+            stack.extend(reversed(self.parent_dict.get(uid, [])))
+        return loaded
+
+    def load_all_parts(self):
+        """Load all parts that are still placeholders. Returns the uids of the parts that were loaded."""
+        loaded = list(self.lazy_parts)
+        for uid in loaded:
+            self.load_part(uid)
+        return loaded
+
+    def find_uids(self, name):
+        """uids of the components called name"""
+        return [uid for uid, label in self.label_dict.items() if label['name'] == name]
+
+    def iter_parse_doc(self, structure_only=False):
+        """Generate new part_dict & label_dict from self.doc, yielding the uid of every item as soon as it has been
+        added to label_dict (and part_dict, for parts). Parents are always yielded before their children, so the
+        model can be displayed while it is being parsed. With structure_only, parts are added to lazy_parts instead of
+        part_dict (see parse_structure).
 
         part_dict (dict of dicts) is used primarily for 3D display
         There is a one-to-one correspondence between each 'display-able'
@@ -83,13 +195,16 @@ class DocModel:
                             'is_assembly': }}
         """
         self._share_dict = {'0:1:1': 0}  # {entry : serial_number}
+        self.structure_only = structure_only
         self.part_dict = {}
+        self.lazy_parts = {}
         self.label_dict = {}
         self.parent_dict = {}
         # Temporary use during unpacking
         self.parent_uid_stack = []  # uid of parent (topmost first)
         self.assembly_entry_stack = ['0:1:1']  # [entries of containing assemblies]
         self.assembly_loc_stack = []  # applicable <TopLoc_Location> locations
+        self.cumulative_loc_stack = []  # product of assembly_loc_stack up to each level
 
         shape_tool = XCAFDoc_DocumentTool_ShapeTool(self.doc.Main())
         color_tool = XCAFDoc_DocumentTool_ColorTool(self.doc.Main())
@@ -119,22 +234,52 @@ class DocModel:
             root_name = root_label.GetLabelName()
 
         self.assembly_loc_stack.append(loc)
+        self.cumulative_loc_stack.append(loc)
         self.assembly_entry_stack.append(root_entry)
         self.label_dict = {root_uid: {'entry': root_entry, 'name': root_name,
                                       'parent_uid': None, 'ref_entry': None,
                                       'is_assembly': True}}
         self.parent_uid_stack.append(root_uid)
         self.root_uid = root_uid
+        yield root_uid
         top_comps = TDF_LabelSequence()  # Components of Top Assembly
         sub_children = False
         __ = shape_tool.GetComponents(root_label, top_comps, sub_children)
         if top_comps.Length():  # if root_label is_assembly:
             logger.debug("")
             logger.debug("Parsing components of label entry %s)", root_entry)
-            self.parse_components(top_comps, shape_tool, color_tool)
+            yield from self.parse_components(top_comps, shape_tool, color_tool)
         else:
             print("Something went wrong while parsing document.")
 
+    def create_part(self, c_label, ref_label, name, res_loc, shape_tool, color_tool):
+        """Create the Part of a component referring to a simple shape, res_loc is the location of the containing
+        assembly relative to the root"""
+        c_shape = shape_tool.GetShape(c_label)
+        if self.instancing:
+            # Share the geometry of the referred shape, only the location differs between instances
+            display_shape = c_shape.Moved(res_loc)
+        else:
+            display_shape = BRepBuilderAPI_Transform(
+                c_shape, res_loc.Transformation()).Shape()
+        # It is possible for this component to both specify a
+        # location 'c_loc' and refer directly to a top level shape.
+        # If this component *does* specify a location 'c_loc',
+        # it will be applied to the referred shape without being
+        # included in temp_assembly_loc_stack. But in order to keep
+        # track of the total location from the root shape to the
+        # instance, it needs to be accounted for (by mutiplying
+        # res_loc by it) before saving it to part_dict.
+        c_loc = shape_tool.GetLocation(c_label)
+        loc = res_loc.Multiplied(c_loc)
+        color = Quantity_Color()
+        color_tool.GetColor(shape_tool.GetShape(ref_label), XCAFDoc_ColorSurf, color)
+        return Part(shape=display_shape,
+                    color=color,
+                    name=name,
+                    loc=loc,
+                    ref_entry=ref_label.EntryDumpToString())
+
     def parse_components(self, comps, shape_tool, color_tool):
         """Parse components from comps (LabelSequence).
 
@@ -145,6 +290,7 @@ class DocModel:
         the referred shape or assembly.
         The root label and all referred labels have Depth = 3
         All component labels (references) have Depth = 4
+        Yields the uid of each parsed component.
         """
 
         for j in range(comps.Length()):
@@ -153,7 +299,6 @@ class DocModel:
             c_label = comps.Value(j + 1)  # component label <class 'TDF_Label'>
             c_entry = c_label.EntryDumpToString()
             c_uid = self.get_uid_from_entry(c_entry)
-            c_shape = shape_tool.GetShape(c_label)
             if self.previous_label_dict is not None and c_uid in self.previous_label_dict:
                 c_name = self.previous_label_dict[c_uid]["name"]
             else:
@@ -165,7 +310,6 @@ class DocModel:
             is_ref = shape_tool.GetReferredShape(c_label, ref_label)
             if is_ref:  # I think all components are references
                 ref_name = ref_label.GetLabelName()
-                ref_shape = shape_tool.GetShape(ref_label)
                 ref_entry = ref_label.EntryDumpToString()
                 self.label_dict[c_uid] = {'entry': c_entry,
                                           'name': c_name,
@@ -176,37 +320,14 @@ class DocModel:
                 self.parent_dict[self.parent_uid_stack[-1]].append(c_uid)
                 if shape_tool.IsSimpleShape(ref_label):
                     self.label_dict[c_uid].update({'is_assembly': False})
-                    temp_assembly_loc_stack = list(self.assembly_loc_stack)
-                    # Multiply locations in stack sequentially to a result
-                    if len(temp_assembly_loc_stack) > 1:
-                        res_loc = temp_assembly_loc_stack.pop(0)
-                        for loc in temp_assembly_loc_stack:
-                            res_loc = res_loc.Multiplied(loc)
-                        display_shape = BRepBuilderAPI_Transform(
-                            c_shape, res_loc.Transformation()).Shape()
-                    elif len(temp_assembly_loc_stack) == 1:
-                        res_loc = temp_assembly_loc_stack.pop()
-                        display_shape = BRepBuilderAPI_Transform(
-                            c_shape, res_loc.Transformation()).Shape()
+                    # The locations of all containing assemblies, multiplied once per assembly level
+                    res_loc = self.cumulative_loc_stack[-1]
+                    if self.structure_only:
+                        self.lazy_parts[c_uid] = LazyPart(c_label, ref_label, res_loc)
                     else:
-                        res_loc = None
-                    # It is possible for this component to both specify a
-                    # location 'c_loc' and refer directly to a top level shape.
-                    # If this component *does* specify a location 'c_loc',
-                    # it will be applied to the referred shape without being
-                    # included in temp_assembly_loc_stack. But in order to keep
-                    # track of the total location from the root shape to the
-                    # instance, it needs to be accounted for (by mutiplying
-                    # res_loc by it) before saving it to part_dict.
-                    c_loc = shape_tool.GetLocation(c_label)
-                    if c_loc:
-                        loc = res_loc.Multiplied(c_loc)
-                    color = Quantity_Color()
-                    color_tool.GetColor(ref_shape, XCAFDoc_ColorSurf, color)
-                    self.part_dict[c_uid] = Part(shape=display_shape,
-                                                 color=color,
-                                                 name=c_name,
-                                                 loc=loc)
+                        self.part_dict[c_uid] = self.create_part(c_label, ref_label, c_name, res_loc,
+                                                                 shape_tool, color_tool)
+                    yield c_uid
                 elif shape_tool.IsAssembly(ref_label):
                     self.label_dict[c_uid].update({'is_assembly': True})
                     logger.debug("Referred item is an Assembly")
@@ -214,8 +335,10 @@ class DocModel:
                     a_loc = shape_tool.GetLocation(c_label)
                     # store inverted location transform in label_dict for this assembly
                     self.assembly_loc_stack.append(a_loc)
+                    self.cumulative_loc_stack.append(self.cumulative_loc_stack[-1].Multiplied(a_loc))
                     self.assembly_entry_stack.append(ref_entry)
                     self.parent_uid_stack.append(c_uid)
+                    yield c_uid
                     r_comps = TDF_LabelSequence()  # Components of Assy
                     sub_children = False
                     is_assembly = shape_tool.GetComponents(
@@ -227,27 +350,35 @@ class DocModel:
                         logger.debug("")
                         logger.debug(
                             "Parsing components of label entry %s)", ref_entry)
-                        self.parse_components(r_comps, shape_tool, color_tool)
+                        yield from self.parse_components(r_comps, shape_tool, color_tool)
             else:
                 print(f"Oops! All components are *not* references {c_uid}")
         self.assembly_entry_stack.pop()
         self.assembly_loc_stack.pop()
+        self.cumulative_loc_stack.pop()
         self.parent_uid_stack.pop()
 
 
-def _load_step():
-    """Allow user to select step file to load, create doc and app,
-
-    transfer step data to doc, return step_file_name, doc, app"""
+def select_step_file():
+    """Allow user to select step file to load, returns the file path or None if cancelled"""
+    from PyQt5 import QtWidgets
 
     prompt = 'Select STEP file to import'
     f_path, __ = QtWidgets.QFileDialog.getOpenFileName(
         None, prompt, './', "STEP files (*.stp *.STP *.step)")
-    base = os.path.basename(f_path)  # f_name.ext
-    step_file_name, ext = os.path.splitext(base)
     logger.debug("Load file name: %s", f_path)
     if not f_path:
         print("Load step cancelled")
+        return None
+    return f_path
+
+
+def _load_step():
+    """Allow user to select step file to load, create doc and app,
+
+    transfer step data to doc, return step_file_name, doc, app"""
+    f_path = select_step_file()
+    if not f_path:
         return
 
     doc, app = load_step_fpath(f_path)
@@ -255,21 +386,49 @@ def _load_step():
     return f_path, doc, app
 
 
-def load_step_fpath(f_path):
+def load_step_fpath(f_path, use_cache=True, progress=None):
+    """Read the STEP file into a new XCAF document, returns doc, app.
+
+    The transferred document is cached in binary form (see model.doccache), keyed by the file content and the reader
+    settings, so opening the same file again skips the STEP translation.
+    progress is called as progress(stage, count) with the stages 'cache_hit', 'read' (count is the number of STEP
+    entities) and 'transferred'. Raises ValueError if the file can't be read or its shapes can't be transferred."""
+    if progress is None:
+        def progress(stage, count=None):
+            pass
+
+    key = None
+    if use_cache and doccache.is_enabled():
+        key = doccache.cache_key(f_path, STEP_READER_SETTINGS)
+        cached = doccache.load_doc(key)
+        if cached is not None:
+            logger.info("XCAF cache hit for %s", f_path)
+            progress('cache_hit')
+            return cached
+        logger.info("XCAF cache miss for %s", f_path)
+
     # Create a new instance of DocModel for the step file
     doc, app = create_doc()
 
     # Create and prepare step reader
     step_reader = STEPCAFControl_Reader()
-    step_reader.SetColorMode(True)
-    step_reader.SetLayerMode(True)
-    step_reader.SetNameMode(True)
-    step_reader.SetMatMode(True)
+    step_reader.SetColorMode(STEP_READER_SETTINGS['color_mode'])
+    step_reader.SetLayerMode(STEP_READER_SETTINGS['layer_mode'])
+    step_reader.SetNameMode(STEP_READER_SETTINGS['name_mode'])
+    step_reader.SetMatMode(STEP_READER_SETTINGS['mat_mode'])
 
     status = step_reader.ReadFile(f_path)
-    if status == IFSelect_RetDone:
-        logger.info("Transfer doc to STEPCAFControl_Reader")
-        step_reader.Transfer(doc)
+    if status != IFSelect_RetDone:
+        close_doc(doc, app)
+        raise ValueError(f"Could not read STEP file {f_path} (status {status})")
+    progress('read', step_reader.Reader().WS().Model().NbEntities())
+    logger.info("Transfer doc to STEPCAFControl_Reader")
+    if not step_reader.Transfer(doc):
+        close_doc(doc, app)
+        raise ValueError(f"Could not transfer the shapes of STEP file {f_path}")
+    progress('transferred')
+    if key is not None:
+        doccache.save_doc(doc, app, key)
     return doc, app
 
 
@@ -285,8 +444,7 @@ def load_step_at_top(dm):
         print("Load step cancelled")
         return
     logger.info("Transfer temp_doc to STEPCAFControl_Reader")
-    dm.doc = doc
-    dm.app = app
+    dm.set_doc(doc, app)
     dm.parse_doc()
     return f_path
 
@@ -295,11 +453,110 @@ def load_step_at_top_fpath(dm, f_path):
     logger.info("Transfer temp_doc to STEPCAFControl_Reader")
     doc, app = load_step_fpath(f_path)
     dm.previous_label_dict = dm.label_dict
-    dm.doc = doc
-    dm.app = app
+    dm.set_doc(doc, app)
     dm.parse_doc()
     dm.previous_label_dict = None
 
 
+def parse_revision(dm, doc, app):
+    """Parse a new revision of the document of dm into a new DocModel. Components keep the names given to them in
+    dm."""
+    new_dm = DocModel(instancing=dm.instancing, doc=doc, app=app)
+    new_dm.previous_label_dict = dm.label_dict
+    new_dm.parse_doc()
+    new_dm.previous_label_dict = None
+    return new_dm
+
+
+def load_step_revision(dm, f_path):
+    """Read a new revision of the STEP file of dm into a new DocModel, see parse_revision"""
+    doc, app = load_step_fpath(f_path)
+    return parse_revision(dm, doc, app)
+
+
+class ModelDiff:
+    """Difference between two revisions of a model, as lists of part uids. Parts are modified if their geometry or
+    location changed. labels_changed is True if the product tree (label_dict) is different."""
+    def __init__(self, added, removed, modified, unchanged, labels_changed):
+        self.added = added
+        self.removed = removed
+        self.modified = modified
+        self.unchanged = unchanged
+        self.labels_changed = labels_changed
+
+    def is_empty(self):
+        return not (self.added or self.removed or self.modified or self.labels_changed)
+
+    def __str__(self):
+        return f"{len(self.added)} added, {len(self.removed)} removed, {len(self.modified)} modified, " \
+               f"{len(self.unchanged)} unchanged parts"
+
+
+def location_matrix(loc):
+    """The 3x4 matrix of a TopLoc_Location as a flat list, row by row"""
+    trsf = loc.Transformation()
+    return [trsf.Value(row + 1, col + 1) for row in range(3) for col in range(4)]
+
+
+def same_location(loc_one, loc_two, tolerance=1e-9):
+    return all(abs(a - b) <= tolerance * max(1.0, abs(a), abs(b))
+               for a, b in zip(location_matrix(loc_one), location_matrix(loc_two)))
+
+
+def diff_doc_models(old_dm, new_dm):
+    """Compare two revisions of a model part by part, using geometry hashes and locations"""
+    old_hashes = part_geometry_hashes(old_dm.part_dict)
+    new_hashes = part_geometry_hashes(new_dm.part_dict)
+
+    added, modified, unchanged = [], [], []
+    for uid, new_part in new_dm.part_dict.items():
+        if uid not in old_dm.part_dict:
+            added.append(uid)
+        elif old_hashes[uid] != new_hashes[uid] or not same_location(old_dm.part_dict[uid].loc, new_part.loc):
+            modified.append(uid)
+        else:
+            unchanged.append(uid)
+    removed = [uid for uid in old_dm.part_dict if uid not in new_dm.part_dict]
+
+    structure_keys = ('entry', 'ref_entry', 'parent_uid', 'is_assembly')
+    labels_changed = old_dm.label_dict.keys() != new_dm.label_dict.keys() or any(
+        old_dm.label_dict[uid].get(key) != label.get(key)
+        for uid, label in new_dm.label_dict.items() for key in structure_keys)
+
+    return ModelDiff(added, removed, modified, unchanged, labels_changed)
+
+
+def apply_model_diff(dm, new_dm, diff):
+    """Update dm in place to the revision in new_dm. Unchanged parts are kept as they are, together with their
+    materials and cached mass properties. Modified parts get the new shape and location but keep their name, material
+    and color. Call diff_doc_models first, it sets the geometry hashes used here.
+    dm takes over the document of new_dm, and its previous document is closed."""
+    unchanged = set(diff.unchanged)
+    modified = set(diff.modified)
+    part_dict = {}
+    for uid, new_part in new_dm.part_dict.items():
+        if uid in unchanged:
+            part_dict[uid] = dm.part_dict[uid]
+        elif uid in modified:
+            old_part = dm.part_dict[uid]
+            new_part.name = old_part.name
+            new_part.color = old_part.color
+            new_part.mass = old_part.mass
+            new_part.density = old_part.density
+            if new_part.geometry_hash == old_part.geometry_hash:
+                # Only moved, the mass properties in the local frame of the part are still valid
+                new_part.mass_properties = old_part.mass_properties
+            part_dict[uid] = new_part
+        else:
+            part_dict[uid] = new_part
+
+    previous_doc, previous_app = dm.doc, dm.app
+    dm.copy_model_from(new_dm)
+    dm.part_dict = part_dict
+    new_dm.release()
+    if previous_doc is not dm.doc:
+        close_doc(previous_doc, previous_app)
+
+
 def same_doc_model(dm_one, dm_two):
-    return dm_one.label_dict == dm_two.label_dict and dm_one.part_dict == dm_two.part_dict
+    return diff_doc_models(dm_one, dm_two).is_empty()
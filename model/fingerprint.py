@@ -0,0 +1,206 @@
+import hashlib
+import logging
+
+import numpy as np
+from OCC.Core.BRep import BRep_Tool
+from OCC.Core.BRepAdaptor import BRepAdaptor_Curve, BRepAdaptor_Surface
+from OCC.Core.BRepBndLib import brepbndlib_AddOptimal
+from OCC.Core.Bnd import Bnd_Box
+from OCC.Core.TopAbs import TopAbs_EDGE, TopAbs_FACE, TopAbs_VERTEX
+from OCC.Core.TopExp import topexp_MapShapes
+from OCC.Core.TopLoc import TopLoc_Location
+from OCC.Core.TopTools import TopTools_IndexedMapOfShape
+from OCC.Core.TopoDS import topods_Edge, topods_Face, topods_Vertex
+from OCC.Core.gp import gp_Trsf
+
+from .brepio import shape_to_brep_bytes
+from .massprops import compute_unit_mass_properties
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)  # set to DEBUG | INFO | ERROR
+
+
+class ShapeFingerprint:
+    """Location invariant signature of a shape: volume, principal moments of inertia, bounding box extents in the
+    principal frame and the number of faces and edges of each geometric type. The center of mass and inertia tensor
+    in the local frame of the part are kept as well, since two parts can only share a mesh and inertia if their
+    geometry is also placed the same way in their local frames. None of these tell a part from its mirror image, or
+    from a rotated copy with isotropic inertia, so the B-rep vertices in the local frame are compared too."""
+
+    def __init__(self, mass_properties, principal_moments, extents, face_types, edge_types, vertices):
+        self.mass_properties = mass_properties
+        self.principal_moments = principal_moments
+        self.extents = extents
+        self.face_types = face_types
+        self.edge_types = edge_types
+        self.vertices = vertices  # (n, 3) positions of the B-rep vertices in the local frame
+
+    @property
+    def topology_key(self):
+        return self.face_types, self.edge_types
+
+    def matches(self, other, tolerance):
+        """True if the shapes are identical within tolerance, relative to the size of the shape"""
+        if self.topology_key != other.topology_key:
+            return False
+        volume = max(abs(self.mass_properties.volume), abs(other.mass_properties.volume))
+        if abs(self.mass_properties.volume - other.mass_properties.volume) > tolerance * volume:
+            return False
+        moment_scale = max(np.max(self.principal_moments), np.max(other.principal_moments), 1e-300)
+        if np.max(np.abs(self.principal_moments - other.principal_moments)) > tolerance * moment_scale:
+            return False
+        length_scale = max(np.max(self.extents), np.max(other.extents))
+        if np.max(np.abs(self.extents - other.extents)) > tolerance * length_scale:
+            return False
+
+        # Same placement in the local frame
+        com_distance = np.linalg.norm(np.array(self.mass_properties.center_of_mass) -
+                                      np.array(other.mass_properties.center_of_mass))
+        if com_distance > tolerance * length_scale:
+            return False
+        inertia_difference = np.array(self.mass_properties.inertia) - np.array(other.mass_properties.inertia)
+        if np.max(np.abs(inertia_difference)) > tolerance * moment_scale:
+            return False
+        return vertices_match(self.vertices, other.vertices, tolerance * length_scale)
+
+
+def vertices_match(vertices, other_vertices, distance):
+    """True if every vertex has one of the other vertices within distance and vice versa"""
+    if len(vertices) != len(other_vertices):
+        return False
+    return all_within(vertices, other_vertices, distance) and all_within(other_vertices, vertices, distance)
+
+
+# Offsets of a grid cell and its 26 neighbors, the cell itself first since the matching vertex is usually in it
+NEIGHBOR_CELLS = np.array(sorted(((i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)),
+                                 key=lambda offset: sum(map(abs, offset))), dtype=np.int64)
+
+
+def cell_keys(cells):
+    """Hash of integer grid cells (n, 3). Different cells may get the same key, the extra candidates that brings up
+    are ruled out by their distance."""
+    return (cells[:, 0] * 73856093) ^ (cells[:, 1] * 19349663) ^ (cells[:, 2] * 83492791)
+
+
+def all_within(points, others, distance):
+    """True if every point (n, 3) has one of others (m, 3) within distance. others are hashed into a grid of cells at
+    least distance wide, so each point is only compared with the others in its own and the neighboring cells, in
+    O((n + m) log m) instead of comparing all pairs."""
+    if not len(points):
+        return True
+    if not len(others):
+        return False
+    scale = max(np.max(np.abs(points)), np.max(np.abs(others)), 1.0)
+    cell_size = max(distance, 1e-9 * scale)  # Keeps the cell indices in range for a (nearly) zero distance
+    keys = cell_keys(np.floor(others / cell_size).astype(np.int64))
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    point_cells = np.floor(points / cell_size).astype(np.int64)
+    found = np.zeros(len(points), dtype=bool)
+    for offset in NEIGHBOR_CELLS:
+        pending = np.flatnonzero(~found)
+        if not len(pending):
+            break
+        query = cell_keys(point_cells[pending] + offset)
+        first = np.searchsorted(sorted_keys, query, side='left')
+        counts = np.searchsorted(sorted_keys, query, side='right') - first
+        for rank in range(int(counts.max())):
+            candidates = counts > rank
+            indices = pending[candidates]
+            nearby = others[order[first[candidates] + rank]]
+            close = ((points[indices] - nearby) ** 2).sum(axis=1) <= distance ** 2
+            found[indices[close]] = True
+    return bool(found.all())
+
+
+def shape_geometry_hash(shape):
+    """sha256 of the exact geometry of shape, independent of where the shape is placed and of its triangulation"""
+    return hashlib.sha256(shape_to_brep_bytes(shape.Located(TopLoc_Location()), with_triangles=False)).hexdigest()
+
+
+def part_geometry_hashes(part_dict):
+    """Geometry hash of every part, cached on the parts. Instances of the same referred shape share their geometry,
+    so it's only serialized once per ref_entry."""
+    prototype_hashes = {}
+    for part in part_dict.values():
+        if part.geometry_hash is None:
+            if part.ref_entry is not None and part.ref_entry in prototype_hashes:
+                part.geometry_hash = prototype_hashes[part.ref_entry]
+            else:
+                part.geometry_hash = shape_geometry_hash(part.shape)
+        if part.ref_entry is not None:
+            prototype_hashes.setdefault(part.ref_entry, part.geometry_hash)
+    return {uid: part.geometry_hash for uid, part in part_dict.items()}
+
+
+def count_types(shape, shape_type):
+    """Number of unique faces (or edges) of shape per surface (or curve) type, as a sorted tuple of (type, count)"""
+    shape_map = TopTools_IndexedMapOfShape()
+    topexp_MapShapes(shape, shape_type, shape_map)
+    counts = {}
+    for i in range(1, shape_map.Size() + 1):
+        if shape_type == TopAbs_FACE:
+            geom_type = BRepAdaptor_Surface(topods_Face(shape_map.FindKey(i))).GetType()
+        else:
+            geom_type = BRepAdaptor_Curve(topods_Edge(shape_map.FindKey(i))).GetType()
+        counts[int(geom_type)] = counts.get(int(geom_type), 0) + 1
+    return tuple(sorted(counts.items()))
+
+
+def vertex_positions(shape):
+    """Positions (n, 3) of the unique vertices of shape"""
+    shape_map = TopTools_IndexedMapOfShape()
+    topexp_MapShapes(shape, TopAbs_VERTEX, shape_map)
+    points = [BRep_Tool.Pnt(topods_Vertex(shape_map.FindKey(i))).Coord() for i in range(1, shape_map.Size() + 1)]
+    return np.array(points, dtype=float).reshape(-1, 3)
+
+
+def compute_fingerprint(shape, loc=None, mass_properties=None):
+    """Fingerprint of shape in the local frame given by loc. Pass mass_properties if they are already known."""
+    if mass_properties is None:
+        mass_properties = compute_unit_mass_properties(shape, loc)
+
+    # Principal axes, ordered by increasing moment and forming a right-handed frame
+    principal_moments, axes = np.linalg.eigh(np.array(mass_properties.inertia))
+    if np.linalg.det(axes) < 0:
+        axes[:, 2] = -axes[:, 2]
+
+    # Bounding box in the principal frame: p' = axes^T (p_local - com)
+    com = np.array(mass_properties.center_of_mass)
+    rotation = axes.T
+    translation = -rotation @ com
+    principal_trsf = gp_Trsf()
+    principal_trsf.SetValues(*rotation[0], translation[0],
+                             *rotation[1], translation[1],
+                             *rotation[2], translation[2])
+    local_loc = loc.Inverted() if loc else TopLoc_Location()
+    principal_shape = shape.Moved(TopLoc_Location(principal_trsf).Multiplied(local_loc))
+    box = Bnd_Box()
+    brepbndlib_AddOptimal(principal_shape, box, False, False)
+    x_min, y_min, z_min, x_max, y_max, z_max = box.Get()
+    extents = np.array([x_max - x_min, y_max - y_min, z_max - z_min])
+
+    return ShapeFingerprint(mass_properties=mass_properties,
+                            principal_moments=principal_moments,
+                            extents=extents,
+                            face_types=count_types(shape, TopAbs_FACE),
+                            edge_types=count_types(shape, TopAbs_EDGE),
+                            vertices=vertex_positions(shape.Moved(local_loc)))
+
+
+def find_duplicates(fingerprints, tolerance=1e-4):
+    """Group identical shapes. fingerprints is a dict {key: ShapeFingerprint}, returns a dict mapping every key to the
+    key of the first matching shape (in dict order)."""
+    canonical = {}
+    candidates = {}  # Canonical keys by topology, only shapes with the same face and edge types can match
+    for key, fingerprint in fingerprints.items():
+        bucket = candidates.setdefault(fingerprint.topology_key, [])
+        for candidate_key in bucket:
+            if fingerprint.matches(fingerprints[candidate_key], tolerance):
+                canonical[key] = candidate_key
+                break
+        else:
+            bucket.append(key)
+            canonical[key] = key
+    return canonical
@@ -0,0 +1,204 @@
+import numpy as np
+from OCC.Core.BRepBuilderAPI import BRepBuilderAPI_Copy
+from OCC.Core.BRepGProp import brepgprop_VolumeProperties
+from OCC.Core.GProp import GProp_GProps
+from OCC.Core.TopLoc import TopLoc_Location
+
+from .structures import UnitMassProperties
+from .tessellation import DEFAULT_DEFLECTION, mesh_shape, shape_triangles, trsf_matrix
+
+# Mass property engines: exact integration over the B-rep, or the faster approximation from a triangulation
+ENGINES = ('brep', 'mesh')
+
+
+def frame_change(loc):
+    """Rotation matrix (3, 3) and translation (3,) taking points from the coordinates of a shape to the local frame
+    given by loc, or None if loc is the identity"""
+    if not loc or loc.IsIdentity():
+        return None
+    matrix = trsf_matrix(loc.Inverted().Transformation())
+    return matrix[:, :3], matrix[:, 3]
+
+
+def relative_frame(loc, target_loc):
+    """frame_change from the local frame given by loc to the local frame given by target_loc"""
+    loc = loc or TopLoc_Location()
+    return frame_change(loc.Inverted().Multiplied(target_loc or TopLoc_Location()))
+
+
+def transform_inertia(center_of_mass, inertia, frame):
+    """Center of mass and inertia tensor (about the center of mass) expressed in the frame given by frame_change, as
+    numpy arrays. The center of mass is transformed as a point and the inertia tensor is rotated."""
+    center_of_mass = np.asarray(center_of_mass, dtype=float)
+    inertia = np.asarray(inertia, dtype=float)
+    if frame is None:
+        return center_of_mass, inertia
+    rotation, translation = frame
+    return rotation @ center_of_mass + translation, rotation @ inertia @ rotation.T
+
+
+def to_local_frame(properties, frame):
+    """properties expressed in the frame given by frame_change, the shape itself doesn't have to be transformed"""
+    if frame is None:
+        return properties
+    center_of_mass, inertia = transform_inertia(properties.center_of_mass, properties.inertia, frame)
+    return UnitMassProperties(volume=properties.volume, center_of_mass=center_of_mass.tolist(),
+                              inertia=inertia.tolist(), engine=properties.engine)
+
+
+def brep_mass_properties(shape):
+    """Exact unit density mass properties of shape in its own coordinates, integrated over the B-rep"""
+    properties = GProp_GProps()
+    brepgprop_VolumeProperties(shape, properties)
+    inertia_tensor = properties.MatrixOfInertia()
+    com = properties.CentreOfMass()
+
+    return UnitMassProperties(volume=properties.Mass(),
+                              center_of_mass=[com.X(), com.Y(), com.Z()],
+                              inertia=[[inertia_tensor.Value(i, j) for j in range(1, 4)] for i in range(1, 4)])
+
+
+def triangle_mass_properties(vertices, triangles):
+    """Unit density mass properties of the solid bounded by a closed, outward oriented triangle mesh. Every triangle
+    forms a tetrahedron with a reference point, and the volume integrals of the tetrahedra (divergence theorem) are
+    summed over all triangles at once."""
+    # Integrate relative to a point inside the mesh, far away coordinates would lose precision
+    reference = vertices.mean(axis=0) if len(vertices) else np.zeros(3)
+    a, b, c = (vertices[triangles[:, k]] - reference for k in range(3))
+    determinants = np.einsum('ij,ij->i', a, np.cross(b, c))  # Six times the signed tetrahedron volumes
+    volume = determinants.sum() / 6
+    if volume == 0:
+        return UnitMassProperties(volume=0.0, center_of_mass=reference.tolist(), inertia=np.zeros((3, 3)).tolist(),
+                                  engine='mesh')
+
+    sums = a + b + c
+    center = (determinants[:, None] * sums).sum(axis=0) / (24 * volume)
+    # Second moments: integral of x x^T over a tetrahedron (0, a, b, c) is det / 120 * (s s^T + a a^T + b b^T + c c^T)
+    outer = (sums[:, :, None] * sums[:, None, :] + a[:, :, None] * a[:, None, :] + b[:, :, None] * b[:, None, :] +
+             c[:, :, None] * c[:, None, :])
+    second_moments = np.einsum('i,ijk->jk', determinants, outer) / 120
+    second_moments -= volume * np.outer(center, center)  # About the center of mass
+    inertia = np.trace(second_moments) * np.eye(3) - second_moments
+
+    return UnitMassProperties(volume=volume, center_of_mass=(center + reference).tolist(), inertia=inertia.tolist(),
+                              engine='mesh')
+
+
+def mesh_mass_properties(shape, deflection=DEFAULT_DEFLECTION):
+    """Approximate unit density mass properties of shape in its own coordinates, from a triangulation with the given
+    relative deflection. The error decreases with the deflection. A copy of shape without triangulation is meshed, so
+    the result doesn't depend on what the viewer or an export meshed before, and the shared faces keep their
+    triangulations."""
+    mesh_copy = BRepBuilderAPI_Copy(shape, True, False).Shape()
+    mesh_shape(mesh_copy, deflection)
+    return triangle_mass_properties(*shape_triangles(mesh_copy))
+
+
+def compute_mass_properties_in_frame(shape, frame, engine='brep', deflection=DEFAULT_DEFLECTION):
+    """Unit density mass properties of shape in the frame given by frame_change"""
+    if engine == 'mesh':
+        properties = mesh_mass_properties(shape, deflection)
+    elif engine == 'brep':
+        properties = brep_mass_properties(shape)
+    else:
+        raise ValueError(f"Unknown mass property engine {engine}, expected one of {', '.join(ENGINES)}")
+    return to_local_frame(properties, frame)
+
+
+def compute_unit_mass_properties(shape, loc=None, engine='brep', deflection=DEFAULT_DEFLECTION):
+    """Compute volume, center of mass and inertia tensor of shape with density 1, in the local frame given by loc.
+    engine is 'brep' (exact) or 'mesh' (approximate, see mesh_mass_properties)."""
+    return compute_mass_properties_in_frame(shape, frame_change(loc), engine, deflection)
+
+
+def usable_mass_properties(properties, engine):
+    """properties if they can be used where the given engine was asked for, else None. Exact properties can always be
+    used, approximate ones only if an approximation was asked for."""
+    if properties is None or properties.engine not in ('brep', engine):
+        return None
+    return properties
+
+
+def mass_properties_error(approximate, exact):
+    """Relative errors of approximate mass properties: of the volume, of the center of mass (relative to the size of
+    the shape, the cube root of its volume) and the largest error of an inertia tensor element (relative to the
+    largest element)"""
+    volume = abs(exact.volume)
+    size = volume ** (1 / 3)
+    inertia_scale = np.max(np.abs(exact.inertia))
+    com_distance = np.linalg.norm(np.array(approximate.center_of_mass) - np.array(exact.center_of_mass))
+    inertia_difference = np.max(np.abs(np.array(approximate.inertia) - np.array(exact.inertia)))
+    return {'volume': abs(approximate.volume - exact.volume) / volume if volume else 0.0,
+            'center_of_mass': com_distance / size if size else 0.0,
+            'inertia': inertia_difference / inertia_scale if inertia_scale else 0.0}
+
+
+def unit_mass_properties_to_dict(properties):
+    return {'volume': properties.volume,
+            'center_of_mass': list(properties.center_of_mass),
+            'inertia': [list(row) for row in properties.inertia],
+            'engine': properties.engine}
+
+
+def unit_mass_properties_from_dict(data):
+    return UnitMassProperties(volume=data['volume'], center_of_mass=data['center_of_mass'], inertia=data['inertia'],
+                              engine=data.get('engine', 'brep'))
+
+
+def scale_mass_properties(properties, mass=None, density=None):
+    """Mass, density and inertia tensor (about the center of mass) of a part with the unit density properties
+    properties. A given mass takes precedence over density, without either the density is 1."""
+    if mass is not None:
+        density = mass / properties.volume
+    elif density is None:
+        density = 1
+    inertia = [[density * properties.inertia[i][j] for j in range(3)] for i in range(3)]
+    return properties.volume * density, density, inertia
+
+
+def combine_mass_properties(bodies):
+    """Mass, center of mass and inertia tensor (about the combined center of mass) of rigidly connected bodies.
+    bodies is a list of (mass, center_of_mass, inertia) in a common frame, the inertia tensors about the centers of
+    mass of the bodies. Each inertia tensor is moved to the combined center of mass with the parallel axis theorem."""
+    masses = np.array([body[0] for body in bodies], dtype=float)
+    centers = np.array([body[1] for body in bodies], dtype=float).reshape(-1, 3)
+    inertias = np.array([body[2] for body in bodies], dtype=float).reshape(-1, 3, 3)
+    mass = masses.sum()
+    center = masses @ centers / mass if mass else centers.mean(axis=0)
+    offsets = centers - center
+    # m (|d|^2 E - d d^T) for every body
+    shifts = masses[:, None, None] * (np.einsum('ij,ij->i', offsets, offsets)[:, None, None] * np.eye(3) -
+                                      offsets[:, :, None] * offsets[:, None, :])
+    return mass, center, (inertias + shifts).sum(axis=0)
+
+
+def stack_mass_properties(properties_list):
+    """Arrays of the volumes (n,), centers of mass (n, 3) and inertia tensors (n, 3, 3) of a list of
+    UnitMassProperties, as used by sweep_densities"""
+    volumes = np.array([properties.volume for properties in properties_list], dtype=float)
+    centers = np.array([properties.center_of_mass for properties in properties_list], dtype=float).reshape(-1, 3)
+    inertias = np.array([properties.inertia for properties in properties_list], dtype=float).reshape(-1, 3, 3)
+    return volumes, centers, inertias
+
+
+def sweep_densities(properties_list, densities, world_centers=None):
+    """Evaluate the mass properties of n parts for many density assignments at once.
+
+    densities has shape (k, n), one row per assignment (a shape (n,) array is a single assignment). Returns a dict
+    with the masses (k, n) and inertia tensors (k, n, 3, 3) of the parts, and the total mass (k,) of each assignment.
+    The centers of mass of the parts don't depend on the density. If world_centers (n, 3), the part centers of mass in
+    a common frame, is given, the center of mass (k, 3) of each assignment is returned as well."""
+    volumes, __, inertias = stack_mass_properties(properties_list)
+    densities = np.atleast_2d(np.asarray(densities, dtype=float))
+    if densities.shape[1] != len(volumes):
+        raise ValueError(f"Expected densities for {len(volumes)} parts, got {densities.shape[1]}")
+
+    masses = densities * volumes
+    result = {
+        'masses': masses,
+        'inertias': densities[:, :, None, None] * inertias,
+        'total_mass': masses.sum(axis=1),
+    }
+    if world_centers is not None:
+        result['center_of_mass'] = masses @ np.asarray(world_centers, dtype=float) / result['total_mass'][:, None]
+    return result
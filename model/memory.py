@@ -0,0 +1,101 @@
+import os
+
+from OCC.Core.BRep import BRep_Tool
+from OCC.Core.TDF import TDF_LabelSequence
+from OCC.Core.TopAbs import TopAbs_EDGE, TopAbs_FACE, TopAbs_VERTEX
+from OCC.Core.TopExp import topexp_MapShapes
+from OCC.Core.TopLoc import TopLoc_Location
+from OCC.Core.TopTools import TopTools_IndexedMapOfShape
+from OCC.Core.TopoDS import topods_Face
+from OCC.Core.XCAFDoc import XCAFDoc_DocumentTool_ShapeTool
+
+# Approximate bytes per stored item, for the estimates in memory_report
+NODE_BYTES = 3 * 8  # gp_Pnt
+NORMAL_BYTES = 3 * 4  # Float normals
+UV_BYTES = 2 * 8
+TRIANGLE_BYTES = 3 * 4
+
+
+def process_memory():
+    """Resident set size of this process in bytes, or None if it can't be determined (non-Linux systems)"""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def triangulation_bytes(triangulation):
+    size = triangulation.NbNodes() * NODE_BYTES + triangulation.NbTriangles() * TRIANGLE_BYTES
+    if triangulation.HasNormals():
+        size += triangulation.NbNodes() * NORMAL_BYTES
+    if triangulation.HasUVNodes():
+        size += triangulation.NbNodes() * UV_BYTES
+    return size
+
+
+def memory_report(dm, ais_shape_dict=None):
+    """Memory held by the model in dm: its XCAF document, the distinct shapes (shared geometry is counted once), their
+    triangulations and, if ais_shape_dict is given, the AIS presentations displaying them. Returns a dict."""
+    # Sub-shapes of instances of the same part share their TShapes, strip the part location so they map to one key
+    faces = TopTools_IndexedMapOfShape()
+    edges = TopTools_IndexedMapOfShape()
+    vertices = TopTools_IndexedMapOfShape()
+    for part in dm.part_dict.values():
+        shape = part.shape.Located(TopLoc_Location())
+        topexp_MapShapes(shape, TopAbs_FACE, faces)
+        topexp_MapShapes(shape, TopAbs_EDGE, edges)
+        topexp_MapShapes(shape, TopAbs_VERTEX, vertices)
+
+    triangulated_faces = nodes = triangles = mesh_bytes = 0
+    for i in range(1, faces.Size() + 1):
+        triangulation = BRep_Tool.Triangulation(topods_Face(faces.FindKey(i)), TopLoc_Location())
+        if triangulation is None:
+            continue
+        triangulated_faces += 1
+        nodes += triangulation.NbNodes()
+        triangles += triangulation.NbTriangles()
+        mesh_bytes += triangulation_bytes(triangulation)
+
+    doc_shapes = 0
+    if dm.doc is not None and dm.doc.IsOpened():
+        labels = TDF_LabelSequence()
+        XCAFDoc_DocumentTool_ShapeTool(dm.doc.Main()).GetShapes(labels)
+        doc_shapes = labels.Length()
+
+    report = {
+        'document_open': dm.doc is not None and dm.doc.IsOpened(),
+        'document_shapes': doc_shapes,
+        'parts': len(dm.part_dict),
+        'lazy_parts': len(dm.lazy_parts),
+        'distinct_geometries': len({part.ref_entry or uid for uid, part in dm.part_dict.items()}),
+        'faces': faces.Size(),
+        'edges': edges.Size(),
+        'vertices': vertices.Size(),
+        'triangulated_faces': triangulated_faces,
+        'triangulation_nodes': nodes,
+        'triangulation_triangles': triangles,
+        'triangulation_bytes': mesh_bytes,
+        'process_bytes': process_memory(),
+    }
+    if ais_shape_dict is not None:
+        report['ais_presentations'] = len(ais_shape_dict)
+        report['ais_stale'] = len([uid for uid in ais_shape_dict if uid not in dm.part_dict])
+    return report
+
+
+def format_memory_report(report):
+    lines = [
+        f"Document: {'open' if report['document_open'] else 'closed'}, {report['document_shapes']} shapes",
+        f"Parts: {report['parts']} loaded ({report['distinct_geometries']} distinct), "
+        f"{report['lazy_parts']} not loaded",
+        f"Topology: {report['faces']} faces, {report['edges']} edges, {report['vertices']} vertices",
+        f"Triangulations: {report['triangulated_faces']} faces, {report['triangulation_nodes']} nodes, "
+        f"{report['triangulation_triangles']} triangles, about {report['triangulation_bytes'] / 1e6:.1f} MB",
+    ]
+    if 'ais_presentations' in report:
+        lines.append(f"AIS presentations: {report['ais_presentations']} "
+                     f"({report['ais_stale']} of parts no longer in the model)")
+    if report['process_bytes'] is not None:
+        lines.append(f"Process resident memory: {report['process_bytes'] / 1e6:.1f} MB")
+    return "\n".join(lines)
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from OCC import VERSION
+
+from .tessellation import trsf_matrix
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)  # set to DEBUG | INFO | ERROR
+
+# Set CADCONVERSION_MESH_CACHE_DIR to move the cache, or to an empty string to disable it
+CACHE_DIR = os.environ.get('CADCONVERSION_MESH_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'cadconversion', 'meshes'))
+CACHE_EXTENSION = '.stl'
+# Number of meshes of a mesh set (e.g. the collision hulls of a part), stored after the meshes themselves
+COUNT_EXTENSION = '.json'
+# Largest total size of the cache in MB, the least recently used files are removed beyond it, see prune_cache
+MAX_CACHE_MB = float(os.environ.get('CADCONVERSION_MESH_CACHE_MB', 2000))
+
+
+def is_enabled():
+    return bool(CACHE_DIR)
+
+
+def mesh_key(geometry_hash, shape, loc, parameters):
+    """Key of the mesh of a shape written in the local frame given by loc: the exact geometry (see
+    fingerprint.shape_geometry_hash), its placement in the local frame, the tessellation parameters and the OCC
+    version. Only meshes that depend on nothing else may be stored, see tessellation.policy_mesh."""
+    placement = loc.Inverted().Multiplied(shape.Location()) if loc else shape.Location()
+    sha = hashlib.sha256()
+    sha.update(geometry_hash.encode())
+    sha.update(repr(trsf_matrix(placement.Transformation()).tolist()).encode())
+    sha.update(json.dumps(parameters, sort_keys=True).encode())
+    sha.update(VERSION.encode())
+    return sha.hexdigest()
+
+
+def mesh_set_key(key, parameters):
+    """Key of a set of meshes derived from the mesh cached under key, e.g. its collision hulls made with the given
+    parameters"""
+    sha = hashlib.sha256()
+    sha.update(key.encode())
+    sha.update(json.dumps(parameters, sort_keys=True).encode())
+    return sha.hexdigest()
+
+
+def cache_path(key):
+    return os.path.join(CACHE_DIR, key + CACHE_EXTENSION)
+
+
+def fetch_mesh(key, stl_file):
+    """Hard link (or copy, across filesystems) the cached mesh for key to stl_file. Returns False if there is no cached
+    mesh."""
+    path = cache_path(key)
+    if not os.path.exists(path):
+        return False
+    if os.path.lexists(stl_file):
+        os.remove(stl_file)
+    try:
+        os.link(path, stl_file)
+    except OSError:
+        shutil.copyfile(path, stl_file)
+    touch(path)
+    return True
+
+
+def touch(path):
+    """Mark a cache file as used, prune_cache removes the files that were used least recently first"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass  # Removed by another process in the meantime
+
+
+def store_mesh(key, stl_file):
+    """Copy a written mesh into the cache. The copy is made under a temporary name first, so that an interrupted copy
+    never leaves a truncated cache entry behind."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(suffix=CACHE_EXTENSION, dir=CACHE_DIR)
+    os.close(fd)
+    try:
+        shutil.copyfile(stl_file, temp_path)
+        os.replace(temp_path, cache_path(key))
+    except OSError:
+        logger.warning("Could not store %s in the mesh cache", stl_file)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def fetch_mesh_set(key, stl_files):
+    """Link the meshes of the set cached under key to the files given by stl_files(count), see fetch_mesh. Returns
+    the linked files, or None if the set is not in the cache."""
+    count_path = os.path.join(CACHE_DIR, key + COUNT_EXTENSION)
+    try:
+        with open(count_path, 'r') as file:
+            count = json.load(file)['count']
+    except (OSError, ValueError, KeyError):
+        return None
+    touch(count_path)
+    files = stl_files(count)
+    if not all(fetch_mesh(f'{key}_{index}', stl_file) for index, stl_file in enumerate(files)):
+        return None
+    return files
+
+
+def store_mesh_set(key, files):
+    """Copy a set of written meshes into the cache. The count is written last, so a set is only found once all of
+    its meshes are stored."""
+    for index, stl_file in enumerate(files):
+        store_mesh(f'{key}_{index}', stl_file)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(suffix=COUNT_EXTENSION, dir=CACHE_DIR)
+    with os.fdopen(fd, 'w') as file:
+        json.dump({'count': len(files)}, file)
+    os.replace(temp_path, os.path.join(CACHE_DIR, key + COUNT_EXTENSION))
+
+
+def clear_cache():
+    """Remove all cached meshes"""
+    if not os.path.isdir(CACHE_DIR):
+        return
+    for f_name in os.listdir(CACHE_DIR):
+        if f_name.endswith((CACHE_EXTENSION, COUNT_EXTENSION)):
+            os.remove(os.path.join(CACHE_DIR, f_name))
+
+
+def prune_cache(max_mb=None):
+    """Remove the least recently used (stored or fetched) files until the cache is at most max_mb (default
+    MAX_CACHE_MB) large. Returns the number of removed files. A mesh set that lost one of its meshes is simply made
+    and stored again."""
+    max_bytes = (MAX_CACHE_MB if max_mb is None else max_mb) * 1e6
+    if not os.path.isdir(CACHE_DIR):
+        return 0
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        # Temporary files are still being written by store_mesh, possibly in another process
+        if entry.name.endswith((CACHE_EXTENSION, COUNT_EXTENSION)) and not entry.name.startswith('tmp'):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for __, size, __ in entries)
+    removed = 0
+    for __, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    if removed:
+        logger.info("Removed %i least recently used files from the mesh cache", removed)
+    return removed
@@ -1,58 +1,182 @@
 from PyQt5.QtCore import Qt
 from PyQt5.QtCore import QMetaObject
 from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
 from watchdog.events import FileSystemEventHandler
-import time
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import multiprocessing
+import tempfile
 import threading
 import os
 
+from . import doccache
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)  # set to DEBUG | INFO | ERROR
+
+# Events for the watched file are coalesced until none has arrived for this many seconds. A single save from a CAD
+# program usually produces several events (truncate, write, rename, ...).
+DEBOUNCE_SECONDS = float(os.environ.get('CADCONVERSION_WATCH_DEBOUNCE', 1.0))
+# Set CADCONVERSION_WATCH_POLLING to 1 to poll the file instead of relying on inotify (e.g. network filesystems)
+USE_POLLING = os.environ.get('CADCONVERSION_WATCH_POLLING', '') not in ('', '0')
+POLL_INTERVAL = 1.0
+
+
+def translate_step(f_path, doc_path=None):
+    """Translate the STEP file into the XCAF document cache, or into the BinXCAF file doc_path if the cache is
+    disabled. Runs in a worker process, so that the translation neither blocks the GUI nor uses the XCAF application
+    of the GUI from another thread."""
+    from .docmodel import close_doc, load_step_fpath
+    doc, app = load_step_fpath(f_path)
+    try:
+        if doc_path is not None and not doccache.write_doc_file(doc, app, doc_path):
+            raise RuntimeError("Could not write the translated document")
+    finally:
+        close_doc(doc, app)
+
+
+def remove_doc_file(doc_path):
+    """Remove a document file written by translate_step, if any"""
+    if doc_path is not None and os.path.exists(doc_path):
+        os.remove(doc_path)
+
 
 class Watcher:
-    def __init__(self, filename, window):
+    """Watches one STEP file. When its content has changed, the new revision is translated in a worker process and
+    window.model_file_changed is invoked in the main thread once it is ready. window.pending_revision is then set to
+    (path, doc_path), see preparse."""
+
+    def __init__(self, filename, window, debounce=DEBOUNCE_SECONDS, polling=USE_POLLING):
         self.window = window
+        self.debounce = debounce
+        self.polling = polling
         self.DIRECTORY_TO_WATCH = None
         self.FILE_TO_WATCH = None
         self.observer = None
-        self.thread = None
+        self.known_hash = None  # Content hash of the revision that is loaded (or being prepared)
+        self.generation = 0  # Incremented for every detected revision, older pre-parses are discarded
+        self.lock = threading.Lock()
+        self.timer = None
+        self.executor = None
         self.watch_new_file(filename)
 
+    @property
+    def path(self):
+        return os.path.join(self.DIRECTORY_TO_WATCH, self.FILE_TO_WATCH)
+
+    def create_observer(self):
+        if self.polling:
+            return PollingObserver(timeout=POLL_INTERVAL)
+        return Observer()
 
     def run(self):
-        event_handler = Handler(self.window)
+        event_handler = Handler(self)
         self.observer.schedule(event_handler, self.DIRECTORY_TO_WATCH, recursive=False)
-        self.thread = threading.Thread(target=self._run)
-        self.thread.daemon = True  # Daemon threads will be killed once the main program exits
-        self.thread.start()
+        try:
+            self.observer.start()
+        except OSError as e:
+            # E.g. the inotify watch limit is reached, or the filesystem doesn't support it
+            logger.warning("Could not start file system observer (%s), polling %s instead", e, self.path)
+            self.polling = True
+            self.observer = self.create_observer()
+            self.observer.schedule(event_handler, self.DIRECTORY_TO_WATCH, recursive=False)
+            self.observer.start()
 
     def watch_new_file(self, filename):
+        filename = os.path.abspath(filename)
         self.DIRECTORY_TO_WATCH = os.path.dirname(filename)
         self.FILE_TO_WATCH = os.path.basename(filename)
-        self.observer = Observer()
-        self.thread = None
+        self.observer = self.create_observer()
+        with self.lock:
+            self.generation += 1
+            self.known_hash = doccache.file_content_hash(filename) if os.path.exists(filename) else None
 
-    def _run(self):
-        self.observer.start()
-        self.observer.join()
+    def file_event(self):
+        """Called for every event on the watched file, (re)starts the debounce timer"""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.debounce, self.file_settled)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def file_settled(self):
+        """No events for the debounce window, check whether the content actually changed"""
+        path = self.path
+        try:
+            digest = doccache.file_content_hash(path)
+        except OSError:
+            return  # Removed, or replaced and not yet there again. The next event will trigger a new check.
+        with self.lock:
+            self.timer = None
+            if digest == self.known_hash:
+                logger.debug("%s touched but its content is unchanged", path)
+                return
+            self.known_hash = digest
+            self.generation += 1
+            generation = self.generation
+        logger.info("%s changed, preparing the new revision", path)
+        threading.Thread(target=self.preparse, args=(path, generation), daemon=True).start()
+
+    def get_executor(self):
+        """The worker process translating the new revisions, started for the first one"""
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+            return self.executor
+
+    def preparse(self, path, generation):
+        """Translate a new revision in the worker process. The main thread then only has to open the binary document:
+        from the XCAF cache, or from the temporary file doc_path if the cache is disabled."""
+        doc_path = None
+        if not doccache.is_enabled():
+            fd, doc_path = tempfile.mkstemp(suffix=doccache.CACHE_EXTENSION)
+            os.close(fd)
+        try:
+            self.get_executor().submit(translate_step, path, doc_path).result()
+        except Exception:
+            logger.exception("Could not read the new revision of %s", path)
+            remove_doc_file(doc_path)
+            return
+
+        with self.lock:
+            if generation != self.generation:
+                # A newer revision has been detected in the meantime
+                remove_doc_file(doc_path)
+                return
+        self.window.pending_revision = (path, doc_path)
+        # Use QMetaObject to invoke a method in the main thread safely
+        QMetaObject.invokeMethod(self.window, 'model_file_changed', Qt.QueuedConnection)
 
     def stop(self):
+        with self.lock:
+            self.generation += 1
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            executor, self.executor = self.executor, None
         self.observer.stop()
         self.observer.join()
-        if self.thread.is_alive():
-            self.thread.join()
+        if executor is not None:
+            executor.shutdown(wait=False)
 
 
 class Handler(FileSystemEventHandler):
-    def __init__(self, window):
-        self.window = window
+    def __init__(self, watcher):
+        self.watcher = watcher
 
     def process(self, event):
-        filename = event.src_path
-        if filename == self.window.file_to_watch and event.event_type == 'modified':
-            # Use QMetaObject to invoke a method in the main thread safely
-            QMetaObject.invokeMethod(self.window, 'show_update_model_popup', Qt.QueuedConnection)
+        # CAD programs often save to a temporary file and rename it, so the destination of moves is checked as well
+        paths = [event.src_path, getattr(event, 'dest_path', '')]
+        if self.watcher.path in (os.path.abspath(path) for path in paths if path):
+            self.watcher.file_event()
 
     def on_modified(self, event):
         self.process(event)
 
     def on_created(self, event):
         self.process(event)
+
+    def on_moved(self, event):
+        self.process(event)
@@ -0,0 +1,105 @@
+import logging
+import os
+
+from .conversion import LinearGraphConverter, MJCFGenerator, common_options, create_graph
+from .docmodel import DocModel, load_step_at_top_fpath, load_step_fpath
+from .serializer import Serializer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)  # set to DEBUG | INFO | ERROR
+
+STEP_EXTENSIONS = ('.stp', '.step')
+
+
+def load_step_model(f_path, instancing=True, subtrees=None):
+    """Load a STEP file into a new DocModel without any display or dialogs. With instancing, repeated parts share
+    their geometry instead of being copied for each instance.
+    subtrees is a list of component names or uids. If given, only the parts in these subtrees are loaded, the others
+    stay placeholders in dm.lazy_parts."""
+    if not os.path.exists(f_path):
+        raise FileNotFoundError(f"STEP file not found: {f_path}")
+    dm = DocModel(instancing=instancing)
+    if subtrees:
+        dm.set_doc(*load_step_fpath(f_path))
+        dm.parse_structure()
+        for subtree in subtrees:
+            uids = [subtree] if subtree in dm.label_dict else dm.find_uids(subtree)
+            if not uids:
+                raise ValueError(f"No component called {subtree} in {f_path}")
+            for uid in uids:
+                dm.load_subtree(uid)
+        logger.info("Loaded %i of %i parts", len(dm.part_dict), len(dm.part_dict) + len(dm.lazy_parts))
+    else:
+        load_step_at_top_fpath(dm, f_path)
+    if not dm.part_dict:
+        dm.close()
+        raise ValueError(f"No parts could be read from STEP file {f_path}")
+    return dm
+
+
+def load_project_model(f_path):
+    """Load a project saved from the GUI (json). Returns the DocModel, the joint dict and the path of the STEP file
+    the project was created from"""
+    joint_dict, part_dict, label_dict, parent_dict, step_path = Serializer().load_model_fpath(f_path)
+    dm = DocModel()
+    dm.part_dict = part_dict
+    dm.label_dict = label_dict
+    dm.parent_dict = parent_dict
+    for uid, label in label_dict.items():
+        if label["parent_uid"] is None:
+            dm.root_uid = uid
+            break
+    return dm, joint_dict, step_path
+
+
+def load_model(f_path, subtrees=None):
+    """Load either a STEP file or a saved project file, depending on the file extension.
+    Returns the DocModel and the joint dict (empty for STEP files). subtrees can only be given for STEP files, see
+    load_step_model, a project file always has all its parts loaded."""
+    if f_path.lower().endswith(STEP_EXTENSIONS):
+        return load_step_model(f_path, subtrees=subtrees), {}
+    if subtrees:
+        raise ValueError(f"Subtrees can only be selected in STEP files, not in the project file {f_path}")
+    dm, joint_dict, _ = load_project_model(f_path)
+    return dm, joint_dict
+
+
+def export_mjcf(part_dict, joint_dict, output_dir, output_file='model.xml', **options):
+    """Write an MJCF model together with its STL meshes to output_dir. Returns the path of the written xml file.
+    options are passed on to MJCFGenerator (e.g. deduplicate=True)"""
+    mjcf_gen = MJCFGenerator(part_dict, joint_dict, output_dir=output_dir, **options)
+    mjcf_gen.generate(output_file)
+    return os.path.join(output_dir, output_file)
+
+
+def export_linear_graph(part_dict, joint_dict, output_dir, render_graphs=True, **options):
+    """Write data.json for the linear graph to output_dir, and optionally render the rotation and translation graphs
+    with graphviz. Returns the path of the written json file"""
+    os.makedirs(output_dir, exist_ok=True)
+    lgc = LinearGraphConverter(part_dict, joint_dict, **options)
+    lgc.convert_to_json(output_dir)
+    json_path = os.path.join(output_dir, 'data.json')
+    if render_graphs:
+        create_graph(json_path, 'translation_graph')
+        create_graph(json_path, 'rotation_graph')
+    return json_path
+
+
+def convert(f_path, mjcf_dir=None, graph_dir=None, render_graphs=True, subtrees=None, **options):
+    """Run the full conversion for a STEP or project file: load, parse and run the requested exporters.
+    Only the parts in subtrees are converted if given, see load_step_model. options are passed on to the exporters,
+    the linear graph export only gets those that aren't MJCF specific (see conversion.common_options).
+    Returns a dict with the paths of the written files"""
+    dm, joint_dict = load_model(f_path, subtrees=subtrees)
+    logger.info("Loaded %s with %i parts and %i joints", f_path, len(dm.part_dict), len(joint_dict))
+
+    try:
+        result = {'input': f_path, 'parts': len(dm.part_dict), 'joints': len(joint_dict)}
+        if mjcf_dir:
+            result['mjcf'] = export_mjcf(dm.part_dict, joint_dict, mjcf_dir, **options)
+        if graph_dir:
+            result['linear_graph'] = export_linear_graph(dm.part_dict, joint_dict, graph_dir, render_graphs,
+                                                         **common_options(options))
+        return result
+    finally:
+        dm.close()
@@ -0,0 +1,146 @@
+import numpy as np
+from OCC.Core.BRepAdaptor import BRepAdaptor_Surface
+from OCC.Core.GeomAbs import GeomAbs_Cylinder, GeomAbs_Plane, GeomAbs_Sphere
+from OCC.Core.TopAbs import TopAbs_FACE
+from OCC.Core.TopExp import TopExp_Explorer
+from OCC.Core.TopoDS import topods_Face
+
+from .collision import mesh_volume
+from .massprops import frame_change
+from .tessellation import STL_SCALE
+
+# Relative tolerance when comparing radii, axes and directions of the faces
+DEFAULT_PRIMITIVE_TOLERANCE = 1e-3
+# A primitive is only used if the part fills at least this fraction of its volume
+DEFAULT_MIN_FILL_RATIO = 0.95
+
+
+def coordinates(point):
+    return np.array([point.X(), point.Y(), point.Z()])
+
+
+def analyze_faces(shape, frame=None):
+    """Normals of the planar faces, (point, direction, radius) of the cylindrical faces and (center, radius) of the
+    spherical faces of shape, in the frame given by massprops.frame_change and in meters. Faces of other types are
+    skipped, the primitive must then still contain the part and pass the fill check of fit_primitive."""
+    rotation, translation = frame if frame is not None else (np.eye(3), np.zeros(3))
+    planes, cylinders, spheres = [], [], []
+    explorer = TopExp_Explorer(shape, TopAbs_FACE)
+    while explorer.More():
+        surface = BRepAdaptor_Surface(topods_Face(explorer.Current()), True)
+        explorer.Next()
+        surface_type = surface.GetType()
+        if surface_type == GeomAbs_Plane:
+            planes.append(rotation @ coordinates(surface.Plane().Axis().Direction()))
+        elif surface_type == GeomAbs_Cylinder:
+            cylinder = surface.Cylinder()
+            point = (rotation @ coordinates(cylinder.Location()) + translation) * STL_SCALE
+            direction = rotation @ coordinates(cylinder.Axis().Direction())
+            cylinders.append((point, direction, cylinder.Radius() * STL_SCALE))
+        elif surface_type == GeomAbs_Sphere:
+            sphere = surface.Sphere()
+            center = (rotation @ coordinates(sphere.Location()) + translation) * STL_SCALE
+            spheres.append((center, sphere.Radius() * STL_SCALE))
+    return planes, cylinders, spheres
+
+
+def parallel(first, second, tolerance):
+    return np.linalg.norm(np.cross(first, second)) <= tolerance
+
+
+def fit_axis(cylinders, tolerance, size):
+    """Common (point, unit direction, radius) of cylindrical faces, None if they don't share one axis and radius"""
+    point, direction, radius = cylinders[0]
+    for other_point, other_direction, other_radius in cylinders[1:]:
+        offset = other_point - point
+        if (not parallel(direction, other_direction, tolerance) or abs(other_radius - radius) > tolerance * radius or
+                np.linalg.norm(np.cross(offset, direction)) > tolerance * size):
+            return None
+    return point, direction, radius
+
+
+def fit_box_axes(planes, tolerance):
+    """Three orthogonal unit directions the normals of the planar faces are parallel to, None if there aren't
+    exactly three"""
+    axes = []
+    for normal in planes:
+        if not any(parallel(normal, axis, tolerance) for axis in axes):
+            axes.append(normal)
+    if len(axes) != 3 or any(abs(axes[i] @ axes[j]) > tolerance for i, j in ((0, 1), (0, 2), (1, 2))):
+        return None
+    x_axis, y_axis = axes[0], axes[1]
+    return np.array([x_axis, y_axis, np.cross(x_axis, y_axis)])
+
+
+def segment_distances(vertices, start, end):
+    """Distances of vertices (n, 3) to the line segment from start to end"""
+    segment = end - start
+    length = segment @ segment
+    t = np.clip((vertices - start) @ segment / length, 0, 1) if length > 0 else np.zeros(len(vertices))
+    return np.linalg.norm(vertices - (start + t[:, None] * segment), axis=1)
+
+
+def fit_primitive(shape, loc, vertices, triangles, tolerance=DEFAULT_PRIMITIVE_TOLERANCE,
+                  min_fill_ratio=DEFAULT_MIN_FILL_RATIO):
+    """MuJoCo primitive approximating shape, fitted from the types of its faces: a cylinder or capsule if its
+    cylindrical faces share one axis and radius (a capsule if it also has spherical ends), else a sphere if its
+    spherical faces are one sphere, else a box if its planar faces have three orthogonal normals. vertices and
+    triangles are the STL mesh of shape (see tessellation.read_binary_stl), in the local frame given by loc and in
+    meters. The primitive has to contain the mesh, and the mesh has to fill at least min_fill_ratio of it, so holes,
+    steps and other features are caught.
+
+    Returns a dict with the geom 'type' and 'size' (radius, or half sizes of a box), and 'fromto' (cylinder and
+    capsule), 'pos' (sphere and box) or 'axes' (box, rows are the directions of its x, y and z axis), or None if
+    no primitive fits."""
+    if not len(triangles):
+        return None
+    planes, cylinders, spheres = analyze_faces(shape, frame_change(loc))
+    size = np.linalg.norm(vertices.max(axis=0) - vertices.min(axis=0))
+    slack = tolerance * size
+
+    if cylinders:
+        axis = fit_axis(cylinders, tolerance, size)
+        if axis is None:
+            return None
+        point, direction, radius = axis
+        direction = direction / np.linalg.norm(direction)
+        heights = (vertices - point) @ direction
+        start, end = point + heights.min() * direction, point + heights.max() * direction
+        if spheres and all(abs(sphere_radius - radius) <= tolerance * radius and
+                           np.linalg.norm(np.cross(center - point, direction)) <= slack
+                           for center, sphere_radius in spheres):
+            start, end = start + radius * direction, end - radius * direction
+            primitive = {'type': 'capsule', 'size': [radius], 'fromto': (start, end)}
+            primitive_volume = np.pi * radius ** 2 * (np.linalg.norm(end - start) + 4 / 3 * radius)
+        elif not spheres:
+            primitive = {'type': 'cylinder', 'size': [radius], 'fromto': (start, end)}
+            primitive_volume = np.pi * radius ** 2 * np.linalg.norm(end - start)
+        else:
+            return None
+        inside = segment_distances(vertices, start, end) <= radius + slack
+    elif spheres:
+        center, radius = spheres[0]
+        if any(np.linalg.norm(other_center - center) > slack or abs(other_radius - radius) > tolerance * radius
+               for other_center, other_radius in spheres[1:]):
+            return None
+        primitive = {'type': 'sphere', 'size': [radius], 'pos': center}
+        primitive_volume = 4 / 3 * np.pi * radius ** 3
+        inside = np.linalg.norm(vertices - center, axis=1) <= radius + slack
+    elif planes:
+        axes = fit_box_axes(planes, tolerance)
+        if axes is None:
+            return None
+        projections = vertices @ axes.T
+        low, high = projections.min(axis=0), projections.max(axis=0)
+        half_sizes = (high - low) / 2
+        primitive = {'type': 'box', 'size': list(half_sizes), 'pos': axes.T @ ((low + high) / 2), 'axes': axes}
+        primitive_volume = np.prod(2 * half_sizes)
+        inside = np.ones(len(vertices), dtype=bool)  # The box is fitted around the vertices
+    else:
+        return None
+
+    if not inside.all() or primitive_volume <= 0:
+        return None
+    if abs(mesh_volume(vertices, triangles)) / primitive_volume < min_fill_ratio:
+        return None
+    return primitive
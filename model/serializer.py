@@ -1,12 +1,7 @@
-import os
-
-from OCC.Core import BRepTools
 from OCC.Core.AIS import AIS_Trihedron, AIS_Line
-from OCC.Core.BRep import BRep_Builder
 from OCC.Core.Geom import Geom_Axis2Placement, Geom_Line
 from OCC.Core.Quantity import Quantity_Color
 from OCC.Core.TopLoc import TopLoc_Location
-from OCC.Core.TopoDS import TopoDS_Shape
 from OCC.Core.Quantity import Quantity_TOC_RGB, Quantity_NOC_RED, Quantity_NOC_GREEN, Quantity_NOC_BLUE
 from OCC.Core.Prs3d import Prs3d_DatumParts_XAxis, Prs3d_DatumParts_YAxis, Prs3d_DatumParts_ZAxis
 
@@ -14,8 +9,10 @@ import json
 import base64
 
 from OCC.Core.gp import gp_Trsf, gp_Pnt, gp_Dir, gp_Ax1
-from PyQt5 import QtWidgets
 
+from .brepio import brep_bytes_to_shape, shape_to_brep_bytes
+from .fingerprint import part_geometry_hashes
+from .massprops import unit_mass_properties_from_dict, unit_mass_properties_to_dict
 from .structures import Joint, Part
 
 
@@ -44,16 +41,8 @@ class Serializer:
         }
 
     def serialize_part(self, part_info):
-        # Write shape to a temporary file
-        temp_shape_file = "temp_shape.brep"
-        BRepTools.breptools_Write(part_info.shape, temp_shape_file)
-
-        # Read the temporary file and encode it as Base64
-        with open(temp_shape_file, "rb") as file:
-            shape_data_base64 = base64.b64encode(file.read()).decode()
-
-        # Delete the temporary file
-        os.remove(temp_shape_file)
+        # Write shape in the BREP format and encode it as Base64
+        shape_data_base64 = base64.b64encode(shape_to_brep_bytes(part_info.shape)).decode()
 
         # Get the location transformation
         loc_trsf = part_info.loc.Transformation()
@@ -68,8 +57,17 @@ class Serializer:
             "loc": loc_matrix,
             "mass": part_info.mass,
             "density": part_info.density,
+            "ref_entry": part_info.ref_entry,
+            "geometry_hash": part_info.geometry_hash,
         }
 
+    def serialize_mass_properties(self, part_dict):
+        """Unit density mass properties of the parts that have them, keyed by geometry hash, so that identical shapes
+        are stored once and a part whose geometry changed can't pick up stale properties"""
+        parts = {uid: part for uid, part in part_dict.items() if part.mass_properties is not None}
+        part_geometry_hashes(parts)
+        return {part.geometry_hash: unit_mass_properties_to_dict(part.mass_properties) for part in parts.values()}
+
     def deserialize_joint(self, joint_data):
         x_dir = joint_data["joint_xdir"]
         x_dir = gp_Dir(x_dir[0], x_dir[1], x_dir[2])
@@ -111,18 +109,8 @@ class Serializer:
         )
 
     def deserialize_part(self, part_data):
-        # Decode the Base64 string and write it to a temporary file
-        shape_data_base64 = part_data['shape_data_base64']
-        temp_shape_file = "temp_shape.brep"
-        with open(temp_shape_file, "wb") as file:
-            file.write(base64.b64decode(shape_data_base64))
-
-        # Read the shape from the temporary file
-        shape = TopoDS_Shape()
-        BRepTools.breptools_Read(shape, temp_shape_file, BRep_Builder())
-
-        # Delete the temporary file
-        os.remove(temp_shape_file)
+        # Decode the Base64 string and read the shape from the BREP data
+        shape = brep_bytes_to_shape(base64.b64decode(part_data['shape_data_base64']))
 
         # Extract the RGB values
         red, green, blue = part_data["color"]
@@ -150,19 +138,28 @@ class Serializer:
             color=color,
             loc=loc,
             mass=part_data["mass"],
-            density=part_data["density"]
+            density=part_data["density"],
+            ref_entry=part_data.get("ref_entry"),
+            geometry_hash=part_data.get("geometry_hash")
         )
 
     def load_model(self):
         f_name = self.prompt_open_file()
         if not f_name:
             return
+        return self.load_model_fpath(f_name)
 
+    def load_model_fpath(self, f_name):
+        """Load a saved project file without prompting, returns the same tuple as load_model"""
         with open(f_name, "r") as file:
             loaded_data = json.load(file)
 
         joint_dict = {uid: self.deserialize_joint(joint_data) for uid, joint_data in loaded_data["joints"].items()}
         part_dict = {uid: self.deserialize_part(part_data) for uid, part_data in loaded_data["parts"].items()}
+        mass_properties = loaded_data.get("mass_properties", {})
+        for part in part_dict.values():
+            if part.geometry_hash in mass_properties:
+                part.mass_properties = unit_mass_properties_from_dict(mass_properties[part.geometry_hash])
         label_dict = loaded_data["labels"]
         parent_dict = loaded_data["parents"]
         f_path = loaded_data.get("file_path", "")
@@ -170,12 +167,20 @@ class Serializer:
         return joint_dict, part_dict, label_dict, parent_dict, f_path
 
     def save_model(self, joint_dict, part_dict, label_dict, parent_dict, f_path):
+        """Save the model as a json project. Raises ValueError if parts of a partially loaded model
+        (DocModel.lazy_parts) aren't loaded yet, they would be lost and their labels kept without a part."""
+        missing = [uid for uid, label in label_dict.items()
+                   if label.get('is_assembly') is False and uid not in part_dict]
+        if missing:
+            raise ValueError(f"{len(missing)} parts are not loaded yet, load them first (DocModel.load_all_parts)")
+
         if self.f_name is None:
             self.f_name = self.prompt_save_file()
             if self.f_name is None:                 # Select folder cancelled
                 return
 
         serialized_joints = {uid: self.serialize_joint(joint) for uid, joint in joint_dict.items()}
+        mass_properties = self.serialize_mass_properties(part_dict)  # Also fills in the geometry hashes
         serialized_parts = {uid: self.serialize_part(part_info) for uid, part_info in part_dict.items()}
 
         saved_data = {
@@ -183,6 +188,7 @@ class Serializer:
             "parts": serialized_parts,
             "labels": label_dict,
             "parents": parent_dict,
+            "mass_properties": mass_properties,
             "file_path": f_path
         }
 
@@ -190,6 +196,8 @@ class Serializer:
             json.dump(saved_data, file)
 
     def prompt_save_file(self):
+        from PyQt5 import QtWidgets
+
         prompt = 'Specify name for saved file.'
         fname, selected_filter = QtWidgets.QFileDialog.getSaveFileName(None, prompt, './', "JSON files;;")
 
@@ -202,6 +210,8 @@ class Serializer:
         return fname
 
     def prompt_open_file(self):
+        from PyQt5 import QtWidgets
+
         prompt = 'Select file to load'
         f_path, __ = QtWidgets.QFileDialog.getOpenFileName(
             None, prompt, './', "JSON files (*.json)")
@@ -0,0 +1,181 @@
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+
+from . import doccache
+from .docmodel import STEP_READER_SETTINGS, DocModel, close_doc, load_step_fpath
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)  # set to DEBUG | INFO | ERROR
+
+POLL_INTERVAL_MS = 50
+PARSE_TIME_SLICE = 0.05  # Seconds of parsing per event loop iteration, the GUI stays responsive in between
+
+
+def translate_step_worker(f_path, doc_path, connection):
+    """Runs in the loader process. Translates the STEP file, or takes it from the XCAF cache, and reports progress
+    through connection. The document is stored in the XCAF cache, or in doc_path if the cache is disabled. The cache
+    key is sent with 'done', so the GUI doesn't have to read the whole STEP file to compute it."""
+    try:
+        key = None
+        if doc_path is None:
+            connection.send(('hashing', None))
+            key = doccache.cache_key(f_path, STEP_READER_SETTINGS)  # Remembered for load_step_fpath
+        doc, app = load_step_fpath(f_path, progress=lambda stage, count=None: connection.send((stage, count)))
+        if doc_path is not None and not doccache.write_doc_file(doc, app, doc_path):
+            raise RuntimeError("Could not write the translated document")
+        close_doc(doc, app)
+        connection.send(('done', key))
+    except Exception as e:
+        connection.send(('error', f"{type(e).__name__}: {e}"))
+    finally:
+        connection.close()
+
+
+class StepLoader(QObject):
+    """Loads a STEP file into dm without blocking the GUI.
+
+    The STEP translation runs in a separate process (OCC holds the GIL while translating, so a thread would still
+    freeze the GUI), which can be terminated to cancel the load. The XCAF cache lookup, which reads the whole STEP
+    file to hash it, runs in that process too. The main thread only opens the binary document, and then parses it in
+    short time slices, and the uids of the parsed components are emitted as they come, so they can be shown
+    before the whole model has been parsed."""
+
+    progress = pyqtSignal(str, int, int)  # message, done, total (0 if unknown)
+    parsing_started = pyqtSignal()  # dm now holds the new document, and is still empty
+    items_loaded = pyqtSignal(list)  # uids added to dm.label_dict (and dm.part_dict for parts), parents first
+    finished = pyqtSignal()
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+    def __init__(self, f_path, dm, previous_label_dict=None, structure_only=False, parent=None):
+        super().__init__(parent)
+        self.f_path = f_path
+        self.dm = dm
+        self.structure_only = structure_only  # Only load the product tree, see DocModel.parse_structure
+        self.previous_label_dict = previous_label_dict  # Component names to keep, see DocModel.parse_doc
+        self.process = None
+        self.connection = None
+        self.doc_path = None
+        self.parse_iter = None
+        self.items_parsed = 0
+        self.timer = QTimer(self)
+        self.timer.setInterval(POLL_INTERVAL_MS)
+        self.timer.timeout.connect(self.poll)
+
+    def start(self):
+        if not doccache.is_enabled():
+            fd, self.doc_path = tempfile.mkstemp(suffix=doccache.CACHE_EXTENSION)
+            os.close(fd)
+
+        context = multiprocessing.get_context('spawn')
+        self.connection, child_connection = context.Pipe(duplex=False)
+        self.process = context.Process(target=translate_step_worker,
+                                       args=(self.f_path, self.doc_path, child_connection), daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.progress.emit("Translating STEP file", 0, 0)
+        self.timer.start()
+
+    def cancel(self):
+        if not self.timer.isActive():
+            return
+        self.stop()
+        logger.info("Loading %s cancelled", self.f_path)
+        self.cancelled.emit()
+
+    def stop(self):
+        self.timer.stop()
+        if self.process is not None:
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process.join()
+            self.process = None
+            self.connection.close()
+        if self.doc_path is not None and os.path.exists(self.doc_path):
+            os.remove(self.doc_path)
+        self.parse_iter = None
+
+    def poll(self):
+        if self.process is not None:
+            self.poll_translation()
+        elif self.parse_iter is not None:
+            self.parse_slice()
+
+    def poll_translation(self):
+        try:
+            while self.connection.poll():
+                stage, value = self.connection.recv()
+                if stage == 'hashing':
+                    self.progress.emit("Looking up the STEP file in the cache", 0, 0)
+                elif stage == 'cache_hit':
+                    self.progress.emit("Found the translated document in the cache", 0, 0)
+                elif stage == 'read':
+                    self.progress.emit(f"Read {value} STEP entities, transferring shapes", 0, 0)
+                elif stage == 'transferred':
+                    self.progress.emit("Transferred shapes, storing document", 0, 0)
+                elif stage == 'error':
+                    self.fail(value)
+                    return
+                elif stage == 'done':
+                    self.translation_done(value)
+                    return
+        except EOFError:
+            self.fail("The loader process exited unexpectedly")
+
+    def fail(self, message):
+        self.stop()
+        logger.error("Loading %s failed: %s", self.f_path, message)
+        self.failed.emit(message)
+
+    def translation_done(self, key):
+        """The loader process has stored the document in the XCAF cache under key, or in doc_path"""
+        self.process.join()
+        self.process = None
+        self.connection.close()
+        if self.doc_path is not None:
+            opened = doccache.read_doc_file(self.doc_path)
+            os.remove(self.doc_path)
+            self.doc_path = None
+        else:
+            # Never translate or hash the STEP file here, that would block the GUI
+            opened = doccache.load_doc(key)
+        if opened is None:
+            self.fail("Could not open the translated document")
+            return
+        self.start_parsing(*opened)
+
+    def start_parsing(self, doc, app):
+        self.dm.copy_model_from(DocModel(instancing=self.dm.instancing, doc=doc, app=app))
+        self.parsing_started.emit()
+        self.dm.previous_label_dict = self.previous_label_dict
+        self.parse_iter = self.dm.iter_parse_doc(structure_only=self.structure_only)
+        self.items_parsed = 0
+
+    def parse_slice(self):
+        uids = []
+        deadline = time.perf_counter() + PARSE_TIME_SLICE
+        done = False
+        try:
+            while time.perf_counter() < deadline:
+                uids.append(next(self.parse_iter))
+        except StopIteration:
+            done = True
+        except Exception as e:
+            logger.exception("Parsing %s failed", self.f_path)
+            self.fail(f"{type(e).__name__}: {e}")
+            return
+        self.items_parsed += len(uids)
+        if uids:
+            self.progress.emit(f"Parsed {self.items_parsed} components", self.items_parsed, 0)
+            self.items_loaded.emit(uids)
+        if done:
+            self.timer.stop()
+            self.parse_iter = None
+            self.dm.previous_label_dict = None
+            logger.info("Loaded %s with %i parts", self.f_path, len(self.dm.part_dict))
+            self.finished.emit()
@@ -0,0 +1,393 @@
+import os
+import re
+import time
+from collections import Counter
+
+# Rough costs on a desktop machine, only meant for previews and for ordering jobs by size. The translation cost
+# grows with the number of entities, meshing with the number of faces of each distinct part and the export with the
+# number of part instances (one body each).
+COST_MODEL = {
+    'load_seconds_per_entity': 2e-5,
+    'mesh_seconds_per_face': 2e-3,
+    'export_seconds_per_instance': 5e-3,
+    'export_seconds_per_face': 5e-4,
+}
+
+# Entity types whose parameters are needed for the product tree and the face counts, all others are only counted
+PRODUCT_TYPES = {'PRODUCT'}
+FORMATION_TYPES = {'PRODUCT_DEFINITION_FORMATION', 'PRODUCT_DEFINITION_FORMATION_WITH_SPECIFIED_SOURCE'}
+DEFINITION_TYPES = {'PRODUCT_DEFINITION', 'PRODUCT_DEFINITION_WITH_ASSOCIATED_DOCUMENTS'}
+USAGE_TYPES = {'NEXT_ASSEMBLY_USAGE_OCCURRENCE'}
+SHAPE_DEFINITION_TYPES = {'PRODUCT_DEFINITION_SHAPE'}
+SHAPE_DEFINITION_REPRESENTATION_TYPES = {'SHAPE_DEFINITION_REPRESENTATION'}
+REPRESENTATION_TYPES = {'SHAPE_REPRESENTATION', 'ADVANCED_BREP_SHAPE_REPRESENTATION',
+                        'MANIFOLD_SURFACE_SHAPE_REPRESENTATION', 'FACETED_BREP_SHAPE_REPRESENTATION'}
+SOLID_TYPES = {'MANIFOLD_SOLID_BREP', 'BREP_WITH_VOIDS', 'FACETED_BREP'}
+SHELL_TYPES = {'CLOSED_SHELL', 'OPEN_SHELL'}
+SURFACE_MODEL_TYPES = {'SHELL_BASED_SURFACE_MODEL'}
+FACE_TYPES = {'ADVANCED_FACE', 'FACE_SURFACE'}
+PARSED_TYPES = (PRODUCT_TYPES | FORMATION_TYPES | DEFINITION_TYPES | USAGE_TYPES | SHAPE_DEFINITION_TYPES |
+                SHAPE_DEFINITION_REPRESENTATION_TYPES | REPRESENTATION_TYPES | SOLID_TYPES | SHELL_TYPES |
+                SURFACE_MODEL_TYPES | {'SHAPE_REPRESENTATION_RELATIONSHIP'})
+HEADER_TYPES = {'FILE_DESCRIPTION', 'FILE_NAME', 'FILE_SCHEMA'}
+
+_entity_re = re.compile(r'#(\d+)\s*=\s*([A-Z][A-Z0-9_]*)?\s*\(')  # No type for complex entities
+_type_re = re.compile(r'([A-Z][A-Z0-9_]*)\s*\(')
+_separator_re = re.compile(r"'|/\*|\*/|;")  # Characters delimiting strings, comments and records
+_token_re = re.compile(r"""\s*(?:
+    (?P<string>'(?:[^']|'')*')|
+    (?P<ref>\#\d+)|
+    (?P<enum>\.[A-Z0-9_]+\.)|
+    (?P<number>[+-]?\d+\.?\d*(?:[eE][+-]?\d+)?)|
+    (?P<keyword>[A-Z][A-Z0-9_]*)|
+    (?P<open>\()|
+    (?P<close>\))|
+    (?P<comma>,)|
+    (?P<unset>[$*])
+)""", re.VERBOSE)
+
+
+class Ref(int):
+    """Reference to another entity instance (#id) in a parameter list"""
+    def __repr__(self):
+        return f"#{int(self)}"
+
+
+def parse_parameters(text):
+    """Parse a STEP parameter list like "('name',#12,(1.,2.),.T.,$)" into Python values. References become Ref,
+    strings str, numbers float, enumerations and $ / * are kept as text, and typed parameters like
+    LENGTH_MEASURE(1.) or the parts of complex entities become (type, parameters) tuples."""
+    tokens = [(m.lastgroup, m.group(m.lastgroup)) for m in _token_re.finditer(text)]
+    position = 0
+
+    def parse_list():
+        nonlocal position
+        values = []
+        while position < len(tokens):
+            kind, value = tokens[position]
+            position += 1
+            if kind == 'close':
+                return values
+            elif kind == 'open':
+                values.append(parse_list())
+            elif kind == 'keyword':
+                if position < len(tokens) and tokens[position][0] == 'open':
+                    position += 1
+                    values.append((value, parse_list()))
+                else:
+                    values.append(value)
+            elif kind == 'string':
+                values.append(value[1:-1].replace("''", "'"))
+            elif kind == 'ref':
+                values.append(Ref(value[1:]))
+            elif kind == 'number':
+                values.append(float(value))
+            elif kind in ('enum', 'unset'):
+                values.append(value)
+        return values
+
+    values = parse_list()
+    return values[0] if len(values) == 1 and isinstance(values[0], list) else values
+
+
+def iter_records(file):
+    """Yield the records (text between ';' outside of strings and comments) of a STEP file, read line by line.
+    Comments are removed in the same pass, so '/*' and ';' inside strings are kept as text:
+
+    >>> import io
+    >>> list(iter_records(io.StringIO("#1=PRODUCT('a/*b;c','',$);/* note; */\\n#2=ADVANCED_FACE('',(#3),#4,.T.);\\n")))
+    ["#1=PRODUCT('a/*b;c','',$)", "#2=ADVANCED_FACE('',(#3),#4,.T.)"]
+    """
+    pieces = []  # Text of the current record
+    in_string = in_comment = False
+    for line in file:
+        start = 0
+        for match in _separator_re.finditer(line):
+            token = match.group()
+            if in_comment:
+                if token == '*/':
+                    in_comment = False
+                    start = match.end()
+            elif token == "'":
+                in_string = not in_string  # Quotes inside strings are doubled and toggle twice
+            elif in_string or token == '*/':
+                continue
+            elif token == '/*':
+                pieces.append(line[start:match.start()])
+                in_comment = True
+            else:
+                pieces.append(line[start:match.start()])
+                yield ''.join(pieces).strip()
+                pieces = []
+                start = match.end()
+        if not in_comment:
+            pieces.append(line[start:])
+    record = ''.join(pieces).strip()
+    if record:
+        yield record
+
+
+class StepProduct:
+    """A product definition (part or assembly) of the STEP file"""
+    def __init__(self, definition_id, name):
+        self.definition_id = definition_id
+        self.name = name
+        self.children = []  # [(occurrence name, definition id)] from NEXT_ASSEMBLY_USAGE_OCCURRENCE
+        self.faces = 0  # B-rep faces of the shape of the product itself, not of its children
+        self.parent_count = 0
+
+    @property
+    def is_assembly(self):
+        return bool(self.children)
+
+
+class StepScan:
+    """Result of scan_step: header, entity counts, product tree and cost estimates of a STEP file, obtained from the
+    text alone without translating the file with OCC"""
+
+    def __init__(self, f_path):
+        self.f_path = f_path
+        self.file_size = os.path.getsize(f_path)
+        self.header = {}
+        self.entity_counts = Counter()
+        self.products = {}  # {definition id : StepProduct}
+        self.roots = []  # Definition ids of the products that are not used in any assembly
+        self.scan_seconds = 0.0
+
+    @property
+    def entity_count(self):
+        return sum(self.entity_counts.values())
+
+    @property
+    def face_count(self):
+        return sum(self.entity_counts[face_type] for face_type in FACE_TYPES)
+
+    def instance_counts(self):
+        """Number of times each product occurs in the expanded assembly tree"""
+        counts = Counter({root_id: 1 for root_id in self.roots})
+        # Visit products in topological order, so that each one is expanded once with its final count
+        remaining_parents = {definition_id: product.parent_count for definition_id, product in self.products.items()}
+        ready = list(self.roots)
+        while ready:
+            definition_id = ready.pop()
+            for __, child_id in self.products[definition_id].children:
+                counts[child_id] += counts[definition_id]
+                remaining_parents[child_id] -= 1
+                if remaining_parents[child_id] == 0:
+                    ready.append(child_id)
+        return counts
+
+    def part_statistics(self):
+        """Number of distinct parts, part instances, faces of the distinct parts and faces of all instances"""
+        counts = self.instance_counts()
+        parts = [definition_id for definition_id, product in self.products.items()
+                 if not product.is_assembly and counts[definition_id]]
+        return {
+            'distinct_parts': len(parts),
+            'part_instances': sum(counts[definition_id] for definition_id in parts),
+            'distinct_faces': sum(self.products[definition_id].faces for definition_id in parts),
+            'instance_faces': sum(self.products[definition_id].faces * counts[definition_id]
+                                  for definition_id in parts),
+        }
+
+    def estimate_costs(self, cost_model=None):
+        """Estimated seconds for loading (STEP translation), meshing and exporting the model. Meshes are computed
+        once per distinct part."""
+        cost_model = cost_model or COST_MODEL
+        statistics = self.part_statistics()
+        # Fall back on the total face count if faces could not be assigned to products
+        distinct_faces = statistics['distinct_faces'] or self.face_count
+        costs = {
+            'load': self.entity_count * cost_model['load_seconds_per_entity'],
+            'mesh': distinct_faces * cost_model['mesh_seconds_per_face'],
+            'export': (statistics['part_instances'] * cost_model['export_seconds_per_instance'] +
+                       distinct_faces * cost_model['export_seconds_per_face']),
+        }
+        costs['total'] = sum(costs.values())
+        return costs
+
+    def tree_lines(self, max_depth=None):
+        """The product tree as indented text lines, with the number of faces of each part"""
+        lines = []
+
+        def add(definition_id, label, depth):
+            product = self.products[definition_id]
+            if product.is_assembly:
+                lines.append(f"{'  ' * depth}{label} [{len(product.children)} components]")
+                if max_depth is None or depth < max_depth:
+                    for occurrence_name, child_id in product.children:
+                        add(child_id, occurrence_name or self.products[child_id].name, depth + 1)
+            else:
+                lines.append(f"{'  ' * depth}{label} ({product.faces} faces)")
+
+        for root_id in self.roots:
+            add(root_id, self.products[root_id].name, 0)
+        return lines
+
+    def to_dict(self):
+        return {
+            'file': self.f_path,
+            'file_size': self.file_size,
+            'header': self.header,
+            'entities': self.entity_count,
+            'faces': self.face_count,
+            'products': len(self.products),
+            **self.part_statistics(),
+            'estimated_seconds': self.estimate_costs(),
+            'scan_seconds': self.scan_seconds,
+            'entity_counts': dict(self.entity_counts.most_common()),
+        }
+
+
+def scan_step(f_path):
+    """Scan the text of a STEP file. Only the entities needed for the product tree and the face counts are parsed,
+    all others are just counted by type."""
+    start = time.perf_counter()
+    scan = StepScan(f_path)
+    entities = {}  # {id : (type, parameters)} of the parsed entity types
+    usages = []
+    entity_counts = scan.entity_counts
+    in_data = False
+
+    with open(f_path, 'r', encoding='latin-1') as file:
+        for record in iter_records(file):
+            if not in_data:
+                if record == 'DATA':
+                    in_data = True
+                    continue
+                match = _type_re.match(record)
+                if match and match.group(1) in HEADER_TYPES:
+                    scan.header[match.group(1)] = parse_parameters(record[match.end() - 1:])
+                continue
+
+            match = _entity_re.match(record)
+            if match is None:
+                continue  # ENDSEC, END-ISO-10303-21
+            entity_id, entity_type = int(match.group(1)), match.group(2)
+            if entity_type is None:
+                # Complex entity, e.g. (REPRESENTATION_RELATIONSHIP(...) SHAPE_REPRESENTATION_RELATIONSHIP() ...)
+                parts = parse_parameters(record[match.end() - 1:])
+                types = [part[0] for part in parts if isinstance(part, tuple)]
+                entity_counts.update(types)
+                # Relationships with a transformation place assembly components, they don't link a product's shapes
+                if 'SHAPE_REPRESENTATION_RELATIONSHIP' in types and \
+                        'REPRESENTATION_RELATIONSHIP_WITH_TRANSFORMATION' not in types:
+                    for part in parts:
+                        if isinstance(part, tuple) and part[0] == 'REPRESENTATION_RELATIONSHIP':
+                            entities[entity_id] = ('SHAPE_REPRESENTATION_RELATIONSHIP', part[1])
+                continue
+
+            entity_counts[entity_type] += 1
+            if entity_type in PARSED_TYPES:
+                parameters = parse_parameters(record[match.end() - 1:])
+                entities[entity_id] = (entity_type, parameters)
+                if entity_type in USAGE_TYPES:
+                    usages.append(parameters)
+
+    build_product_tree(scan, entities, usages)
+    scan.scan_seconds = time.perf_counter() - start
+    return scan
+
+
+def build_product_tree(scan, entities, usages):
+    def parameters_of(ref, types):
+        entity = entities.get(ref)
+        if entity is None or entity[0] not in types:
+            return None
+        return entity[1]
+
+    for entity_id, (entity_type, parameters) in entities.items():
+        if entity_type in DEFINITION_TYPES:
+            name = ''
+            formation = parameters_of(parameters[2], FORMATION_TYPES)
+            product = parameters_of(formation[2], PRODUCT_TYPES) if formation else None
+            if product:
+                name = product[1] or product[0]
+            scan.products[entity_id] = StepProduct(entity_id, name)
+
+    for parameters in usages:
+        name, relating, related = parameters[1], parameters[3], parameters[4]
+        if relating in scan.products and related in scan.products:
+            scan.products[relating].children.append((name, related))
+            scan.products[related].parent_count += 1
+    scan.roots = [definition_id for definition_id, product in scan.products.items() if not product.parent_count]
+
+    # Shapes: PRODUCT_DEFINITION_SHAPE -> SHAPE_DEFINITION_REPRESENTATION -> representation, which either holds the
+    # solids itself or is linked to the representation holding them by a SHAPE_REPRESENTATION_RELATIONSHIP
+    linked = {}
+    for entity_type, parameters in entities.values():
+        if entity_type == 'SHAPE_REPRESENTATION_RELATIONSHIP':
+            linked.setdefault(parameters[2], []).append(parameters[3])
+            linked.setdefault(parameters[3], []).append(parameters[2])
+
+    def shell_faces(ref):
+        shell = parameters_of(ref, SHELL_TYPES)
+        return len(shell[1]) if shell else 0
+
+    def item_faces(ref):
+        entity = entities.get(ref)
+        if entity is None:
+            return 0
+        entity_type, parameters = entity
+        if entity_type in SOLID_TYPES:
+            faces = shell_faces(parameters[1])
+            if entity_type == 'BREP_WITH_VOIDS':
+                faces += sum(shell_faces(void) for void in parameters[2])
+            return faces
+        if entity_type in SURFACE_MODEL_TYPES:
+            return sum(shell_faces(shell) for shell in parameters[1])
+        return 0
+
+    def representation_faces(ref):
+        faces = 0
+        seen = set()
+        stack = [ref]
+        while stack:
+            ref = stack.pop()
+            if ref in seen:
+                continue
+            seen.add(ref)
+            representation = parameters_of(ref, REPRESENTATION_TYPES)
+            if representation:
+                faces += sum(item_faces(item) for item in representation[1])
+            stack.extend(linked.get(ref, []))
+        return faces
+
+    shape_definitions = {}  # {PRODUCT_DEFINITION_SHAPE id : product definition id}
+    for entity_id, (entity_type, parameters) in entities.items():
+        if entity_type in SHAPE_DEFINITION_TYPES and parameters[2] in scan.products:
+            shape_definitions[entity_id] = parameters[2]
+    for entity_type, parameters in entities.values():
+        if entity_type in SHAPE_DEFINITION_REPRESENTATION_TYPES and parameters[0] in shape_definitions:
+            product = scan.products[shape_definitions[parameters[0]]]
+            product.faces += representation_faces(parameters[1])
+
+
+def estimated_cost(f_path):
+    """Estimated total conversion seconds of a file, for ordering jobs. Files that can't be scanned (e.g. project
+    files) are ranked by their size."""
+    if f_path.lower().endswith(('.stp', '.step')):
+        try:
+            return scan_step(f_path).estimate_costs()['total']
+        except (OSError, ValueError, IndexError, TypeError):
+            pass
+    try:
+        return os.path.getsize(f_path) / 100 * COST_MODEL['load_seconds_per_entity']  # About 100 bytes per entity
+    except OSError:
+        return 0.0
+
+
+def file_size(f_path):
+    try:
+        return os.path.getsize(f_path)
+    except OSError:
+        return 0
+
+
+def largest_first(f_paths, scan=False):
+    """f_paths ordered by decreasing conversion cost. Starting the longest jobs first keeps a worker pool from ending
+    with one long job running on its own. The file size is used as cost, which is free to get; with scan, the
+    estimated cost of each file is computed from its text (see estimated_cost), which is more accurate but reads
+    every file completely."""
+    costs = {f_path: estimated_cost(f_path) if scan else file_size(f_path) for f_path in f_paths}
+    return sorted(f_paths, key=lambda f_path: -costs[f_path])
@@ -29,7 +29,8 @@ class JointProperty:
 
 
 class PartProperty:
-    def __init__(self, name, shape, loc=None, center_of_mass=None, inertia=None, mass=None, density=None):
+    def __init__(self, name, shape, loc=None, center_of_mass=None, inertia=None, mass=None, density=None,
+                 mass_properties=None, ref_entry=None):
         self.name = name
         self.shape = shape
         self.loc = loc
@@ -37,13 +38,29 @@ class PartProperty:
         self.inertia = inertia
         self.mass = mass
         self.density = density
+        self.mass_properties = mass_properties
+        self.ref_entry = ref_entry
+
+
+class UnitMassProperties:
+    """Volume, center of mass and inertia tensor (about the center of mass) of a shape with density 1, expressed in
+    the local frame of the part. Mass and inertia for another density are obtained by scaling."""
+    def __init__(self, volume, center_of_mass, inertia, engine='brep'):
+        self.volume = volume
+        self.center_of_mass = center_of_mass
+        self.inertia = inertia
+        self.engine = engine  # 'brep' if exact, 'mesh' if approximated from a triangulation
 
 
 class Part:
-    def __init__(self, shape, name, color, loc, mass=None, density=None):
+    def __init__(self, shape, name, color, loc, mass=None, density=None, mass_properties=None, ref_entry=None,
+                 geometry_hash=None):
         self.shape = shape
         self.name = name
         self.color = color
         self.loc = loc
         self.mass = mass
         self.density = density
+        self.mass_properties = mass_properties  # Cached UnitMassProperties, None until computed
+        self.ref_entry = ref_entry  # Entry of the referred (prototype) shape, shared by all instances of a part
+        self.geometry_hash = geometry_hash  # Cached shape_geometry_hash of shape, None until computed
@@ -0,0 +1,227 @@
+import os
+
+import numpy as np
+from OCC.Core.BRep import BRep_Tool
+from OCC.Core.BRepBndLib import brepbndlib_Add
+from OCC.Core.BRepBuilderAPI import BRepBuilderAPI_Copy
+from OCC.Core.BRepMesh import BRepMesh_IncrementalMesh
+from OCC.Core.Bnd import Bnd_Box
+from OCC.Core.TopAbs import TopAbs_FACE, TopAbs_REVERSED
+from OCC.Core.TopExp import TopExp_Explorer
+from OCC.Core.TopLoc import TopLoc_Location
+from OCC.Core.TopoDS import topods_Face
+
+# Deflection relative to the size of each edge, and angular deflection in radians
+DEFAULT_DEFLECTION = 0.01
+DEFAULT_ANGULAR_DEFLECTION = 0.5
+# Scale of the STL meshes written for MJCF, from mm to meters
+STL_SCALE = 0.001
+# Everything besides the shape and the TessellationPolicy that determines the content of an STL file written by
+# write_stl, see meshcache.py. Meshes made from a finer triangulation already stored on the shape (see policy_mesh)
+# aren't cached, they depend on what was meshed before.
+STL_PARAMETERS = {'scale': STL_SCALE, 'format': 'binary', 'writer': 'numpy'}
+# Existing triangulations are reused for STL files if their deflection is at most this fraction above the requested
+# one. The angular deflection isn't stored with a triangulation, so only the linear deflection is compared.
+REUSE_TOLERANCE = 1e-6
+# Meshes over their triangle budget are made again with a deflection this much larger than the estimate that would
+# just meet the budget, and an angular deflection of at most MAX_ANGULAR_DEFLECTION radians
+BUDGET_MARGIN = 1.1
+MAX_ANGULAR_DEFLECTION = 1.5
+# Binary STL record: normal, three vertices and an unused attribute, 50 bytes
+STL_TRIANGLE_DTYPE = np.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)), ('attribute', '<u2')])
+
+
+def mesh_shape(shape, deflection=DEFAULT_DEFLECTION, relative=True, angular_deflection=DEFAULT_ANGULAR_DEFLECTION):
+    """Triangulate the faces of shape. The triangulations are stored on the faces, which are shared by all instances
+    of the shape. Faces that are already meshed finely enough are kept."""
+    BRepMesh_IncrementalMesh(shape, deflection, relative, angular_deflection, True)
+
+
+class TessellationPolicy:
+    """How finely the STL meshes are tessellated. The linear deflection is relative to the bounding box diagonal of
+    each body in its own frame, so small and large parts get a similar number of triangles, and is limited to
+    [min_deflection, max_deflection] mm. The default minimum is the fixed deflection of earlier versions, so that
+    small parts don't get finer meshes than before. A body with more than max_body_triangles triangles is meshed
+    again with a larger deflection (see budget_mesh), and if all meshes of a model together have more than
+    max_model_triangles triangles, each body gets a share of that budget in proportion to its triangle count."""
+
+    def __init__(self, relative_deflection=0.001, angular_deflection=0.5, min_deflection=0.5, max_deflection=10.0,
+                 max_body_triangles=None, max_model_triangles=None):
+        self.relative_deflection = relative_deflection
+        self.angular_deflection = angular_deflection  # Radians
+        self.min_deflection = min_deflection
+        self.max_deflection = max_deflection
+        self.max_body_triangles = max_body_triangles
+        self.max_model_triangles = max_model_triangles
+
+    def parameters(self):
+        """Settings that determine the mesh of a body, besides its triangle budget"""
+        return {'relative_deflection': self.relative_deflection, 'angular_deflection': self.angular_deflection,
+                'min_deflection': self.min_deflection, 'max_deflection': self.max_deflection}
+
+    def deflection(self, shape):
+        """Linear deflection (mm) for shape, relative to the diagonal of its bounding box. The box is taken without
+        the location of shape, so the deflection doesn't depend on how the part is placed in the assembly."""
+        box = Bnd_Box()
+        brepbndlib_Add(shape.Located(TopLoc_Location()), box, False)
+        diagonal = 0.0 if box.IsVoid() else box.SquareExtent() ** 0.5
+        return min(max(self.relative_deflection * diagonal, self.min_deflection), self.max_deflection)
+
+    def body_budgets(self, triangle_counts):
+        """Triangle budget of every body such that the model fits in max_model_triangles, in proportion to the
+        triangle counts {key: count} of the bodies. Returns None if the model already fits."""
+        total = sum(triangle_counts.values())
+        if not self.max_model_triangles or total <= self.max_model_triangles:
+            return None
+        ratio = self.max_model_triangles / total
+        return {key: max(int(count * ratio), 1) for key, count in triangle_counts.items()}
+
+
+def trsf_matrix(trsf):
+    """3x4 matrix of a gp_Trsf as a numpy array"""
+    return np.array([[trsf.Value(row, col) for col in range(1, 5)] for row in range(1, 4)])
+
+
+def local_matrix(loc):
+    """3x4 matrix taking points from global coordinates to the local frame given by loc, None for the identity"""
+    if not loc or loc.IsIdentity():
+        return None
+    return trsf_matrix(loc.Inverted().Transformation())
+
+
+def write_binary_stl(stl_file, vertices, triangles):
+    """Write the triangles (m, 3, indices into vertices (n, 3)) as a binary STL file"""
+    corners = vertices[triangles]
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    lengths = np.linalg.norm(normals, axis=1)
+    normals = np.divide(normals, lengths[:, None], out=np.zeros_like(normals), where=lengths[:, None] > 0)
+
+    records = np.zeros(len(triangles), dtype=STL_TRIANGLE_DTYPE)
+    records['normal'] = normals
+    records['vertices'] = corners
+    with open(stl_file, 'wb') as file:
+        file.write(b'Binary STL'.ljust(80, b' '))
+        file.write(np.uint32(len(triangles)).tobytes())
+        file.write(records.tobytes())
+
+
+def stl_triangle_count(stl_file):
+    """Number of triangles in a binary STL file, from its header"""
+    with open(stl_file, 'rb') as file:
+        file.seek(80)
+        return int(np.frombuffer(file.read(4), dtype='<u4')[0])
+
+
+def read_binary_stl(stl_file):
+    """Vertices (3 m, 3) and triangles (m, 3, indices into the vertices) of a binary STL file, every triangle has its
+    own three vertices"""
+    with open(stl_file, 'rb') as file:
+        file.seek(84)
+        records = np.frombuffer(file.read(), dtype=STL_TRIANGLE_DTYPE)
+    vertices = records['vertices'].reshape(-1, 3).astype(float)
+    return vertices, np.arange(len(vertices), dtype=np.int64).reshape(-1, 3)
+
+
+def triangulation_deflections(shape):
+    """Deflections of the existing triangulations of the faces of shape, None for faces without one"""
+    deflections = []
+    explorer = TopExp_Explorer(shape, TopAbs_FACE)
+    while explorer.More():
+        triangulation = BRep_Tool.Triangulation(topods_Face(explorer.Current()), TopLoc_Location())
+        explorer.Next()
+        deflections.append(None if triangulation is None else triangulation.Deflection())
+    return deflections
+
+
+def reuses_triangulation(shape, deflection):
+    """True if policy_mesh would keep a triangulation already stored on the faces of shape that is finer than
+    deflection, e.g. one made by the viewer. The mesh then depends on what was meshed before."""
+    return any(existing is not None and existing < (1 - REUSE_TOLERANCE) * deflection
+               for existing in triangulation_deflections(shape))
+
+
+def policy_mesh(shape, deflection, angular_deflection):
+    """Vertices and triangles of shape meshed with at most the given absolute deflection. The triangulations stored
+    on the shared faces are reused if they are at least as fine, e.g. those of the viewer or of an earlier export,
+    only faces without one or with a coarser one are meshed."""
+    deflections = triangulation_deflections(shape)
+    if not all(existing is not None and existing <= (1 + REUSE_TOLERANCE) * deflection for existing in deflections):
+        mesh_shape(shape, deflection, relative=False, angular_deflection=angular_deflection)
+    return shape_triangles(shape)
+
+
+def budget_mesh(shape, policy, max_triangles=None):
+    """Vertices and triangles of shape meshed according to policy, with at most max_triangles triangles if possible
+    (see policy_mesh). Only meshes that are over budget are made again, on a copy of the shape without
+    triangulation, so that the shared faces keep theirs."""
+    deflection = policy.deflection(shape)
+    vertices, triangles = policy_mesh(shape, deflection, policy.angular_deflection)
+    if not max_triangles or len(triangles) <= max_triangles:
+        return vertices, triangles
+
+    # The number of triangles falls roughly with the square of the deflection, so the deflection that meets the
+    # budget is estimated from the first mesh, and corrected once if that mesh is still over budget. The first mesh
+    # may be a finer triangulation that was already on the shape, its deflection is the base of the estimate.
+    deflection = max((existing for existing in triangulation_deflections(shape) if existing is not None),
+                     default=deflection)
+    angular_deflection = policy.angular_deflection
+    for __ in range(2):
+        scale = BUDGET_MARGIN * (len(triangles) / max_triangles) ** 0.5
+        deflection *= scale
+        angular_deflection = min(angular_deflection * scale, MAX_ANGULAR_DEFLECTION)
+        coarse_shape = BRepBuilderAPI_Copy(shape, True, False).Shape()
+        mesh_shape(coarse_shape, deflection, relative=False, angular_deflection=angular_deflection)
+        vertices, triangles = shape_triangles(coarse_shape)
+        if len(triangles) <= max_triangles:
+            break
+    return vertices, triangles
+
+
+def write_stl(shape, stl_file, matrix=None, policy=None, max_triangles=None):
+    """Write shape as a binary STL file in meters, in the local frame given by matrix (see local_matrix), tessellated
+    according to policy (see budget_mesh). The frame change and scale are applied to the vertices, so the shape
+    doesn't have to be copied. Returns the number of triangles written."""
+    if shape.IsNull():
+        raise ValueError('Invalid shape provided for STL export.')
+    if os.path.lexists(stl_file):
+        os.remove(stl_file)  # May be a hard link into the mesh cache, which must not be overwritten
+
+    vertices, triangles = budget_mesh(shape, policy or TessellationPolicy(), max_triangles)
+    if matrix is not None:
+        vertices = vertices @ matrix[:, :3].T + matrix[:, 3]
+    write_binary_stl(stl_file, vertices * STL_SCALE, triangles)
+    return len(triangles)
+
+
+def shape_triangles(shape):
+    """Vertices (n, 3) and triangles (m, 3, indices into the vertices) of the triangulations of the faces of shape, in
+    the coordinates of shape. Triangles of reversed faces are flipped, so that they are ordered counterclockwise
+    seen from outside of a solid. Vertices on edges are repeated for every face they belong to."""
+    vertex_blocks = []
+    triangle_blocks = []
+    offset = 0
+    explorer = TopExp_Explorer(shape, TopAbs_FACE)
+    while explorer.More():
+        face = topods_Face(explorer.Current())
+        explorer.Next()
+        loc = TopLoc_Location()
+        triangulation = BRep_Tool.Triangulation(face, loc)
+        if triangulation is None:
+            continue
+
+        nodes = np.array([triangulation.Node(i).Coord() for i in range(1, triangulation.NbNodes() + 1)])
+        if not loc.IsIdentity():
+            matrix = trsf_matrix(loc.Transformation())
+            nodes = nodes @ matrix[:, :3].T + matrix[:, 3]
+        triangles = np.array([triangulation.Triangle(i).Get() for i in range(1, triangulation.NbTriangles() + 1)],
+                             dtype=np.int64) - 1 + offset
+        if face.Orientation() == TopAbs_REVERSED:
+            triangles = triangles[:, [0, 2, 1]]
+
+        vertex_blocks.append(nodes)
+        triangle_blocks.append(triangles)
+        offset += len(nodes)
+
+    if not vertex_blocks:
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+    return np.concatenate(vertex_blocks), np.concatenate(triangle_blocks)
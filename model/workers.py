@@ -0,0 +1,98 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from .brepio import binary_bytes_to_shape, shape_to_binary_bytes
+from .collision import write_collision_meshes
+from .massprops import (compute_mass_properties_in_frame, frame_change, unit_mass_properties_from_dict,
+                        unit_mass_properties_to_dict)
+from .tessellation import DEFAULT_DEFLECTION, local_matrix, write_stl
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)  # set to DEBUG | INFO | ERROR
+
+# Number of processes computing mass properties when no mass_workers option is given, 1 computes them serially
+DEFAULT_MASS_WORKERS = int(os.environ.get('CADCONVERSION_MASS_WORKERS', 1))
+# Number of processes meshing and writing STL files when no mesh_workers option is given
+DEFAULT_MESH_WORKERS = int(os.environ.get('CADCONVERSION_MESH_WORKERS', 1))
+# Below this many shapes the serialization and process start up cost more than they save
+MIN_PARALLEL_SHAPES = 8
+
+
+def mass_properties_worker(job):
+    """Runs in a worker process. Returns the unit density mass properties of a serialized shape in the given frame as
+    a dict of numbers."""
+    brep_data, frame, engine, deflection = job
+    properties = compute_mass_properties_in_frame(binary_bytes_to_shape(brep_data), frame, engine, deflection)
+    return unit_mass_properties_to_dict(properties)
+
+
+def compute_mass_properties(shapes, workers=None, engine='brep', deflection=DEFAULT_DEFLECTION):
+    """Unit density mass properties of many shapes. shapes is a dict {key: (shape, loc)}, returns a dict
+    {key: UnitMassProperties} with the properties in the local frame given by loc, as compute_unit_mass_properties.
+
+    With more than one worker, the shapes are serialized to binary BREP and computed in a process pool. Only numbers
+    are sent back. The binary format stores the geometry and locations exactly, so the results are the same as
+    computing them serially."""
+    workers = DEFAULT_MASS_WORKERS if workers is None else workers
+    workers = min(workers, os.cpu_count() or 1, len(shapes))
+    if workers <= 1 or len(shapes) < MIN_PARALLEL_SHAPES:
+        return {key: compute_mass_properties_in_frame(shape, frame_change(loc), engine, deflection)
+                for key, (shape, loc) in shapes.items()}
+
+    keys = list(shapes)
+    jobs = [(shape_to_binary_bytes(shape), frame_change(loc), engine, deflection)
+            for shape, loc in (shapes[key] for key in keys)]
+    # A few chunks per worker, so that a handful of large shapes at the end don't leave the other workers idle
+    chunksize = max(1, len(keys) // (workers * 4))
+    logger.info("Computing mass properties of %i shapes in %i processes", len(keys), workers)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        results = list(executor.map(mass_properties_worker, jobs, chunksize=chunksize))
+    return {key: unit_mass_properties_from_dict(result) for key, result in zip(keys, results)}
+
+
+def stl_worker(job):
+    """Runs in a worker process. Writes a serialized shape to an STL file and returns the number of triangles."""
+    brep_data, matrix, stl_file, policy, max_triangles = job
+    return write_stl(binary_bytes_to_shape(brep_data), stl_file, matrix, policy, max_triangles)
+
+
+def write_stl_files(shapes, workers=None, policy=None):
+    """Mesh shapes and write them as STL files. shapes is a list of (shape, loc, stl_file, max_triangles), each shape
+    is written in the local frame given by loc and tessellated according to policy (a TessellationPolicy) within its
+    triangle budget. With more than one worker the shapes are serialized to binary BREP, together with their
+    triangulations, and written in a process pool. The files are the same as when writing them serially. Returns the
+    number of triangles of each file."""
+    workers = DEFAULT_MESH_WORKERS if workers is None else workers
+    workers = min(workers, os.cpu_count() or 1, len(shapes))
+    if workers <= 1 or len(shapes) < MIN_PARALLEL_SHAPES:
+        return [write_stl(shape, stl_file, local_matrix(loc), policy, max_triangles)
+                for shape, loc, stl_file, max_triangles in shapes]
+
+    jobs = [(shape_to_binary_bytes(shape, with_triangles=True), local_matrix(loc), stl_file, policy, max_triangles)
+            for shape, loc, stl_file, max_triangles in shapes]
+    chunksize = max(1, len(jobs) // (workers * 4))
+    logger.info("Writing %i STL files in %i processes", len(jobs), workers)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return list(executor.map(stl_worker, jobs, chunksize=chunksize))
+
+
+def collision_worker(job):
+    """Runs in a worker process. Writes the collision hulls of an STL file and returns their file names."""
+    return write_collision_meshes(*job)
+
+
+def write_collision_files(jobs, workers=None):
+    """Write the collision hulls of STL files, see collision.write_collision_meshes. jobs is a list of (stl_file,
+    mode, max_hulls, concavity), returns the names of the hull files of each job. Only file names are sent to the
+    worker processes, the meshes are read from the STL files."""
+    workers = DEFAULT_MESH_WORKERS if workers is None else workers
+    workers = min(workers, os.cpu_count() or 1, len(jobs))
+    if workers <= 1 or len(jobs) < MIN_PARALLEL_SHAPES:
+        return [write_collision_meshes(*job) for job in jobs]
+
+    chunksize = max(1, len(jobs) // (workers * 4))
+    logger.info("Writing the collision hulls of %i meshes in %i processes", len(jobs), workers)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return list(executor.map(collision_worker, jobs, chunksize=chunksize))
@@ -1,17 +1,18 @@
+import os
+
 from PyQt5.QtCore import Qt, pyqtSlot
-from PyQt5 import QtWidgets
+from PyQt5 import QtGui, QtWidgets
 
 from OCC.Core.AIS import AIS_Shape, AIS_Trihedron
-from OCC.Core.BRepAlgoAPI import BRepAlgoAPI_Fuse
 from OCC.Core.BRepExtrema import BRepExtrema_DistShapeShape
 from OCC.Core.GeomLProp import GeomLProp_SLProps
 from OCC.Core.Prs3d import Prs3d_DatumParts_XAxis, Prs3d_DatumParts_YAxis, Prs3d_DatumParts_ZAxis
-from OCC.Core.BRep import BRep_Tool, BRep_Builder
+from OCC.Core.BRep import BRep_Tool
 from OCC.Core.BRepBuilderAPI import BRepBuilderAPI_MakeEdge
 from OCC.Core.Geom import Geom_Axis2Placement
 from OCC.Core.GeomAbs import GeomAbs_Circle
 from OCC.Core.TopLoc import TopLoc_Location
-from OCC.Core.TopoDS import topods_Edge, topods_Vertex, TopoDS_Compound, topods_Face
+from OCC.Core.TopoDS import topods_Edge, topods_Vertex, topods_Face
 from OCC.Core.TopAbs import TopAbs_VERTEX, TopAbs_EDGE, TopAbs_FACE
 from OCC.Core.IntCurvesFace import IntCurvesFace_ShapeIntersector
 from OCC.Core.Quantity import Quantity_Color, Quantity_NOC_RED, Quantity_NOC_GREEN, Quantity_NOC_BLUE, \
@@ -19,7 +20,12 @@ from OCC.Core.Quantity import Quantity_Color, Quantity_NOC_RED, Quantity_NOC_GRE
 from OCC.Core.BRepAdaptor import BRepAdaptor_Curve
 from OCC.Core.gp import gp_Pnt, gp_Dir, gp_Lin, gp_Trsf
 
-from model.docmodel import DocModel, load_step_at_top_fpath, load_step_fpath
+from model.docmodel import DocModel, apply_model_diff, close_doc, diff_doc_models, load_step_fpath, \
+    load_step_revision, parse_revision, same_doc_model
+from model import doccache
+from model.combine import collect_part_uids, combine_parts
+from model.memory import format_memory_report, memory_report
+from model.modelupdate import remove_doc_file
 
 import OCC.Display.backend
 import OCC.Display.OCCViewer
@@ -27,6 +33,7 @@ import OCC.Display.OCCViewer
 used_backend = OCC.Display.backend.load_backend()
 dm = DocModel()
 
+from model.steploader import StepLoader
 from model.structures import Part
 from .mainwindow_managers import MaterialManager, JointManager
 from .uiwidgets import TreeView, JointSelectionWidget, ModelUpdateWidget
@@ -214,6 +221,9 @@ class MainWindow(QtWidgets.QMainWindow):
         self.model_update_widget = ModelUpdateWidget(self)
         self.saved_doc = None
         self.saved_app = None
+        # (file path, translated document file or None if it is in the XCAF cache) of a changed STEP file, set by the
+        # Watcher
+        self.pending_revision = None
 
         # create_dock_widget initializes tree_view and tree_dock_widget that display the component tree view
         self.tree_view = None
@@ -230,6 +240,9 @@ class MainWindow(QtWidgets.QMainWindow):
         self.items_clicked_uid = set()  # The items in the tree view that have been clicked
 
         self.ais_shape_dict = {}
+        self.component_item_dict = {}  # {uid : QTreeWidgetItem} of the components in the tree view
+
+        self.step_loader = None  # StepLoader of the STEP file that is being loaded, if any
 
         self.registered_callback = None
 
@@ -479,6 +492,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def clear_tree(self):
         self.tree_view.clear()
+        self.component_item_dict = {}
         self.joint_view_root, self.component_view_root = self.create_root_items()
         self.origin_datum_item = self.create_origin_datum_item()
 
@@ -510,7 +524,6 @@ class MainWindow(QtWidgets.QMainWindow):
         joint root item"""
         self.clear_tree()
         self.assembly_list = []
-        parent_item_dict = {}
         if self.origin_checked:
             self.origin_datum_item.setCheckState(0, Qt.Checked)
         else:
@@ -528,27 +541,34 @@ class MainWindow(QtWidgets.QMainWindow):
             joint.item = item
             self.tree_view.expandItem(item)
 
-        for uid, dict_, in dm.label_dict.items():
-            # dict: {keys: 'entry', 'name', 'parent_uid', 'ref_entry'}
-            name = dict_["name"]
-            parent_uid = dict_["parent_uid"]
-            if parent_uid not in parent_item_dict:
-                parent_item = self.component_view_root
-            else:
-                parent_item = parent_item_dict[parent_uid]
-
-            # create node in tree view
-            item_name = [name, uid]
-            item = QtWidgets.QTreeWidgetItem(parent_item, item_name)
-            item.setFlags(item.flags() | Qt.ItemIsTristate | Qt.ItemIsUserCheckable | Qt.ItemIsEditable)
-            if uid in self.hide_list:
-                item.setCheckState(0, Qt.Unchecked)
-            else:
-                item.setCheckState(0, Qt.Checked)
-            self.tree_view.expandItem(item)
-            parent_item_dict[uid] = item
-            if dict_["is_assembly"]:
-                self.assembly_list.append(uid)
+        for uid in dm.label_dict:
+            self.add_component_item(uid)
+
+    def add_component_item(self, uid):
+        """Add the component with uid to the tree view, below its parent if that has already been added"""
+        dict_ = dm.label_dict[uid]
+        # dict: {keys: 'entry', 'name', 'parent_uid', 'ref_entry'}
+        name = dict_["name"]
+        parent_uid = dict_["parent_uid"]
+        if parent_uid not in self.component_item_dict:
+            parent_item = self.component_view_root
+        else:
+            parent_item = self.component_item_dict[parent_uid]
+
+        # create node in tree view
+        item_name = [name, uid]
+        item = QtWidgets.QTreeWidgetItem(parent_item, item_name)
+        item.setFlags(item.flags() | Qt.ItemIsTristate | Qt.ItemIsUserCheckable | Qt.ItemIsEditable)
+        if uid in self.hide_list:
+            item.setCheckState(0, Qt.Unchecked)
+        else:
+            item.setCheckState(0, Qt.Checked)
+        if uid in dm.lazy_parts:
+            item.setForeground(0, QtGui.QBrush(Qt.gray))  # Not loaded yet
+        self.tree_view.expandItem(item)
+        self.component_item_dict[uid] = item
+        if dict_["is_assembly"]:
+            self.assembly_list.append(uid)
 
     def adjust_draw_hide(self):
         """Erase from 3D display any item that gets unchecked, draw when checked."""
@@ -682,27 +702,24 @@ class MainWindow(QtWidgets.QMainWindow):
             self.registered_callback = None
             self.canvas._display.SetSelectionModeNeutral()
 
-    def merge_assembly_shapes(self, uid):
-        """Combine an assembly so that all its subcomponents become one shape"""
-        if uid in dm.part_dict:
-            return dm.part_dict[uid].shape
-
-        # Create an initial empty shape using TopoDS_Compound
-        builder = BRep_Builder()
-        compound_shape = TopoDS_Compound()
-        builder.MakeCompound(compound_shape)
-
-        if uid in dm.parent_dict:
-            for child_uid in dm.parent_dict[uid]:
-                child_shape = self.merge_assembly_shapes(child_uid)
-                # Make sure the child_shape is valid before fusing
-                if not child_shape.IsNull():
-                    # Fuse the child_shape with the existing compound_shape
-                    fused_shape = BRepAlgoAPI_Fuse(compound_shape, child_shape).Shape()
-                    # Update the compound_shape with the fused result
-                    compound_shape = fused_shape
-
-        return compound_shape
+    def combine_components(self, uids, loc, fuse=False):
+        """Combine the parts of the components uids into one Part with its local frame given by loc. The shapes are
+        put in a compound, or fused into one shape if fuse is set, and the mass properties are aggregated from those
+        of the parts (see model.combine). Returns None if there are no parts to combine or fusing failed."""
+        parts = [dm.part_dict[uid] for uid in collect_part_uids(uids, dm.part_dict, dm.parent_dict)]
+        if not parts:
+            return None
+        try:
+            shape, mass, mass_properties = combine_parts(parts, loc, fuse=fuse)
+        except RuntimeError as e:
+            print(f"Error: {e}")
+            return None
+        return Part(shape=shape,
+                    name="",
+                    color=Quantity_Color(Quantity_NOC_GRAY),
+                    loc=loc,
+                    mass=mass,
+                    mass_properties=mass_properties)
 
     def get_component_depth(self, uid):
         """Retrieves the depth of component with uid. The root component has depth 0, the root's children have depth
@@ -736,40 +753,10 @@ class MainWindow(QtWidgets.QMainWindow):
                     topmost_child_uid = uid
         return min_depth, topmost_child_uid, topmost_parent_uid
 
-    def merge_components_shapes(self):
+    def merge_components_shapes(self, fuse=False):
         """Combined all selected components into one shape"""
-        combined_shape = None
-        for uid in self.items_clicked_uid:
-            if uid in dm.part_dict:
-                shape = dm.part_dict[uid].shape
-                if combined_shape is None:
-                    combined_shape = shape
-                else:
-                    fusion = BRepAlgoAPI_Fuse(combined_shape, shape)
-                    if fusion.HasErrors():
-                        print("Error: Fusion operation failed.")
-                        return
-                    combined_shape = fusion.Shape()
-            elif dm.label_dict[uid]["is_assembly"]:
-                shape = self.merge_assembly_shapes(uid)
-                if combined_shape is None:
-                    combined_shape = shape
-                else:
-                    fusion = BRepAlgoAPI_Fuse(combined_shape, shape)
-                    if fusion.HasErrors():
-                        print("Error: Fusion operation failed.")
-                        return
-                    combined_shape = fusion.Shape()
-
-        # Create new component
         new_component_uid = f"combined_component_{self.combined_uid}"
         new_component_name = f"Combined Component {self.combined_uid}"
-        self.combined_uid += 1
-        # {uid: {keys: 'shape', 'name', 'color', 'loc', 'mass', 'density'}}
-        new_part = Part(shape=combined_shape,
-                        name=new_component_name,
-                        color=Quantity_Color(Quantity_NOC_GRAY),
-                        loc=TopLoc_Location(gp_Trsf()))
 
         # dict: {keys: 'entry', 'name', 'parent_uid', 'ref_entry'}
         new_label_dict = {
@@ -791,11 +778,18 @@ class MainWindow(QtWidgets.QMainWindow):
                 topmost_child_uid = topmost_child_uid_
                 min_depth = min_depth_
 
-        # If a topmost parent was found, make that parent the new parent of the combined component
+        # If a topmost parent was found, the combined component gets its parent, local frame and color
+        loc = TopLoc_Location(gp_Trsf())
+        if topmost_parent_uid is not None:
+            loc = dm.part_dict[topmost_child_uid].loc
+        new_part = self.combine_components(self.items_clicked_uid, loc, fuse=fuse)
+        if new_part is None:
+            return
+        self.combined_uid += 1
+        new_part.name = new_component_name
         if topmost_parent_uid is not None:
             new_label_dict["parent_uid"] = topmost_parent_uid
             new_part.color = dm.part_dict[topmost_child_uid].color
-            new_part.loc = dm.part_dict[topmost_child_uid].loc
 
         # Update part dictionary
         dm.part_dict[new_component_uid] = new_part
@@ -808,24 +802,25 @@ class MainWindow(QtWidgets.QMainWindow):
         self.draw_shape(new_component_uid)
         self.canvas._display.Context.UpdateCurrentViewer()
 
-    def merge_shapes(self):
-        """Merge shapes by combining all selected components into one shape"""
+    def merge_shapes(self, fuse=False):
+        """Merge shapes by combining all selected components into one shape. The shapes are put in a compound, which
+        is fast, or fused into one solid if fuse is set."""
         if "_datum_origin" in self.items_clicked_uid:
             return
         if len(self.items_clicked_uid) > 1:
-            self.merge_components_shapes()
+            self.merge_components_shapes(fuse)
         elif len(self.items_clicked_uid) == 1:
-            assembly_uid = self.items_clicked_uid.pop()
+            assembly_uid = next(iter(self.items_clicked_uid))
             if not dm.label_dict[assembly_uid]["is_assembly"]:  # Can't combine a single shape
                 return
-            combined_shape = self.merge_assembly_shapes(assembly_uid)
+            new_part = self.combine_components([assembly_uid], TopLoc_Location(gp_Trsf()), fuse=fuse)
+            if new_part is None:
+                return
+            self.items_clicked_uid.remove(assembly_uid)
             for child_uid in dm.parent_dict[assembly_uid]:
                 self.erase_assembly(child_uid)
-            new_component_name = dm.label_dict[assembly_uid]["name"]
-            dm.part_dict[assembly_uid] = Part(shape=combined_shape,
-                                              name=new_component_name,
-                                              color=Quantity_Color(Quantity_NOC_GRAY),
-                                              loc=TopLoc_Location(gp_Trsf()))
+            new_part.name = dm.label_dict[assembly_uid]["name"]
+            dm.part_dict[assembly_uid] = new_part
             dm.label_dict[assembly_uid]["is_assembly"] = False
             self.build_tree()
             self.draw_shape(assembly_uid)
@@ -922,33 +917,206 @@ class MainWindow(QtWidgets.QMainWindow):
                 dm.root_uid = uid
                 return
 
+    def start_step_loader(self, loader, title):
+        """Start loader, showing its progress in a dialog that allows cancelling it. The window can be used while
+        the model loads."""
+        if self.step_loader is not None:
+            self.step_loader.cancel()
+        self.step_loader = loader
+        dialog = QtWidgets.QProgressDialog(title, "Cancel", 0, 0, self)
+        dialog.setWindowTitle(title)
+        dialog.setWindowModality(Qt.NonModal)
+        dialog.setMinimumDuration(500)
+        dialog.canceled.connect(loader.cancel)
+
+        def finish():
+            dialog.close()
+            if self.step_loader is loader:
+                self.step_loader = None
+
+        def failed(message):
+            finish()
+            QtWidgets.QMessageBox.warning(self, title, f"Could not load {loader.f_path}:\n{message}")
+
+        loader.progress.connect(lambda message, done, total: dialog.setLabelText(message))
+        loader.finished.connect(finish)
+        loader.cancelled.connect(finish)
+        loader.failed.connect(failed)
+        loader.start()
+
+    def load_step_file(self, f_path, on_finished=None, structure_only=False):
+        """Load the STEP file as a new model without blocking the window. Components are added to the tree view and
+        the display as soon as they have been parsed. If the load is cancelled or fails, the previous model is
+        restored. With structure_only, only the product tree is loaded, see load_selected_components."""
+        previous_dm = DocModel(doc=dm.doc, app=dm.app)
+        previous_dm.copy_model_from(dm)
+        previous_joint_dict, previous_hide_list = self.joint_dict, self.hide_list
+        loader = StepLoader(f_path, dm, structure_only=structure_only, parent=self)
+
+        def parsing_started():
+            self.joint_dict = {}
+            self.hide_list = set()
+            self.canvas._display.Context.RemoveAll(False)
+            self.ais_shape_dict = {}
+            self.build_tree()
+            if self.display_origin:
+                self.display_datum_origin()
+
+        def restore():
+            if dm.doc is not previous_dm.doc:
+                close_doc(dm.doc, dm.app)  # Partially parsed new document
+            dm.copy_model_from(previous_dm)
+            self.joint_dict, self.hide_list = previous_joint_dict, previous_hide_list
+            self.build_tree()
+            self.redraw()
+
+        def finished():
+            previous_dm.close()
+            self.discard_saved_revision()
+            self.build_tree()
+            if on_finished is not None:
+                on_finished()
+
+        loader.parsing_started.connect(parsing_started)
+        loader.items_loaded.connect(self.show_loaded_items)
+        loader.finished.connect(finished)
+        loader.cancelled.connect(restore)
+        loader.failed.connect(lambda message: restore())
+        self.start_step_loader(loader, "Loading STEP file")
+
+    def show_loaded_items(self, uids):
+        """Add components that have just been parsed to the tree view and draw the parts among them"""
+        for uid in uids:
+            self.add_component_item(uid)
+            if uid in dm.part_dict:
+                self.draw_shape(uid)  # Tessellates the shape
+        self.canvas._display.Context.UpdateCurrentViewer()
+
+    def load_selected_components(self):
+        """Load and draw the parts of the selected components that have only been loaded as placeholders"""
+        loaded = []
+        for uid in self.items_clicked_uid:
+            if uid in dm.label_dict:
+                loaded.extend(dm.load_subtree(uid))
+        for uid in loaded:
+            if uid not in self.hide_list:
+                self.draw_shape(uid)
+        if loaded:
+            self.build_tree()
+            self.canvas._display.Context.UpdateCurrentViewer()
+
+    def load_all_components(self):
+        """Load and draw all parts that have only been loaded as placeholders, e.g. before saving the project"""
+        loaded = dm.load_all_parts()
+        for uid in loaded:
+            if uid not in self.hide_list:
+                self.draw_shape(uid)
+        if loaded:
+            self.build_tree()
+            self.canvas._display.Context.UpdateCurrentViewer()
+
+    def check_step_revision(self, f_path):
+        """Load the STEP file in the background and offer to update the model if it differs from the loaded one"""
+        new_dm = DocModel()
+        loader = StepLoader(f_path, new_dm, previous_label_dict=dm.label_dict, parent=self)
+
+        def finished():
+            if same_doc_model(dm, new_dm):
+                new_dm.close()
+            else:
+                self.show_update_model_popup(new_dm)
+
+        loader.finished.connect(finished)
+        loader.cancelled.connect(new_dm.close)
+        loader.failed.connect(lambda message: new_dm.close())
+        self.start_step_loader(loader, "Checking STEP file for changes")
+
+    def update_model(self, new_dm):
+        """Update dm to the revision new_dm. Only parts that were added, removed or modified are reloaded and
+        redrawn, unchanged parts keep their display, materials, joints and cached mass properties."""
+        diff = diff_doc_models(dm, new_dm)
+        print(f"Model update: {diff}")
+        if diff.is_empty():
+            new_dm.close()
+            return diff
+
+        context = self.canvas._display.Context
+        for uid in diff.removed + diff.modified:
+            if uid in self.ais_shape_dict:
+                context.Remove(self.ais_shape_dict.pop(uid), False)
+        removed_labels = [uid for uid in dm.label_dict if uid not in new_dm.label_dict]
+        for uid in removed_labels:
+            self.delete_joints_belonging_to_component(uid)
+            self.hide_list.discard(uid)
+
+        apply_model_diff(dm, new_dm, diff)
+        if diff.labels_changed:
+            self.build_tree()
+        for uid in diff.modified + diff.added:
+            if uid not in self.hide_list:
+                self.draw_shape(uid)
+        context.UpdateCurrentViewer()
+        return diff
+
+    @pyqtSlot()
+    def model_file_changed(self):
+        """The watched STEP file has changed and the Watcher has translated the new revision in the background"""
+        if self.pending_revision is None:
+            return
+        f_path, doc_path = self.pending_revision
+        self.pending_revision = None
+        if f_path != os.path.abspath(self.file_to_watch):
+            remove_doc_file(doc_path)
+            return
+        if doc_path is None:
+            new_dm = load_step_revision(dm, f_path)  # Translated into the XCAF cache by the Watcher
+        else:
+            revision = doccache.read_doc_file(doc_path)
+            remove_doc_file(doc_path)
+            if revision is None:
+                return
+            new_dm = parse_revision(dm, *revision)
+        if same_doc_model(dm, new_dm):
+            new_dm.close()
+            return
+        self.show_update_model_popup(new_dm)
+
     @pyqtSlot()
-    def show_update_model_popup(self):
+    def show_update_model_popup(self, new_dm=None):
+        """Ask whether to update the model to the changed STEP file. new_dm is the already parsed new revision, if
+        available"""
         self.model_update_widget.show()
         result = self.model_update_widget.exec_()
         if result == QtWidgets.QDialog.Accepted:
-            # Update the model
-            load_step_at_top_fpath(dm=dm, f_path=self.file_to_watch)
-            self.build_tree()
-            self.redraw()
+            if new_dm is None:
+                new_dm = load_step_revision(dm, self.file_to_watch)
+            self.update_model(new_dm)
             return True
         elif result == QtWidgets.QDialog.Rejected:
-            doc, app = load_step_fpath(f_path=self.file_to_watch)
+            if new_dm is None:
+                doc, app = load_step_fpath(f_path=self.file_to_watch)
+            else:
+                doc, app = new_dm.doc, new_dm.app
+                new_dm.release()  # Only the document is kept, the parts are parsed again when it is loaded
+            self.discard_saved_revision()
             self.saved_doc = doc
             self.saved_app = app
             return False
 
+    def discard_saved_revision(self):
+        """Close the document of a model update that was postponed, it has been superseded"""
+        close_doc(self.saved_doc, self.saved_app)
+        self.saved_doc = None
+        self.saved_app = None
+
     def load_saved_modified_step(self):
         if self.saved_doc is None or self.saved_app is None:
             return
-        dm.previous_label_dict = dm.label_dict
-        dm.doc = self.saved_doc
-        dm.app = self.saved_app
-        dm.parse_doc()
-        dm.previous_label_dict = None
-        self.build_tree()
-        self.redraw()
+        self.update_model(parse_revision(dm, self.saved_doc, self.saved_app))  # dm takes over saved_doc
 
         self.saved_doc = None
         self.saved_app = None
 
+    def show_memory_report(self):
+        report = memory_report(dm, self.ais_shape_dict)
+        QtWidgets.QMessageBox.information(self, "Memory report", format_memory_report(report))
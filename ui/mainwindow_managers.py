@@ -57,6 +57,7 @@ class MaterialManager:
         """The user specified a custom mass"""
         if dm.label_dict[uid]["is_assembly"] is False:
             dm.part_dict[uid].mass = float(self.change_material_group.input_mass_option.text())
+            dm.part_dict[uid].density = None  # Derived from the mass and the cached volume on export
             self._update_color_and_redraw(uid)
         else:
             for child_uid in dm.parent_dict[uid]:
@@ -65,6 +66,7 @@ class MaterialManager:
     def _change_material(self, uid, density):
         if dm.label_dict[uid]["is_assembly"] is False:
             dm.part_dict[uid].density = density
+            dm.part_dict[uid].mass = None  # A mass set before would override the new density
             self._update_color_and_redraw(uid)
         else:
             for child_uid in dm.parent_dict[uid]: